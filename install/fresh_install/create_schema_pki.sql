@@ -13,8 +13,12 @@ CREATE SCHEMA pki               -- DB schema for project "serverPKI"'
 
 CREATE TABLE Revision (
   id                SERIAL          PRIMARY KEY,            -- 'PK of Revision'
-  schemaVersion     int2            NOT NULL  DEFAULT 5,    -- 'Version of DB schema'
+  schemaVersion     int2            NOT NULL  DEFAULT 7,    -- 'Version of DB schema'
   keysEncrypted     BOOLEAN         NOT NULL  DEFAULT FALSE, -- 'Cert keys are encrypted'
+  keysRotatedUntil  int4            NULL,                   -- 'Last CertKeyData id re-encrypted by an unfinished key rotation'
+  rotationKeyHash   TEXT            NULL,                   -- 'sha256 of new DB encryption key of an unfinished key rotation'
+  prePublishTimedelta     int4      NULL,                   -- 'PRE_PUBLISH_TIMEDELTA, Certificates.next_action_at was computed with'
+  localIssueMailTimedelta int4      NULL,                   -- 'LOCAL_ISSUE_MAIL_TIMEDELTA, Certificates.next_action_at was computed with'
   updated           dd.updated                              -- 'time of record update'
 
 )
@@ -30,6 +34,7 @@ CREATE TABLE Certificates (     -- The certificate meta data class
   encryption_algo   dd.cert_encryption_algo         -- 'Encryption algorith for this certificate'
                              DEFAULT 'rsa' NOT NULL,
   ocsp_must_staple  boolean  DEFAULT false NOT NULL,-- 'OCSP staple protocol supported by server'
+  next_action_at    TIMESTAMP,                      -- 'scheduling may have work for cert after this, NULL if unknown'
   updated           dd.updated,                     -- 'time of record update'
   created           dd.created,                     -- 'time of record creation'
   remarks           TEXT                            -- 'Remarks'
@@ -193,6 +198,13 @@ CREATE TABLE Targets (    -- Target describes where and how certs and keys are d
 )
 
 
+CREATE INDEX CertInstances_certificate_state_not_after     -- 'Instances of cert by state and expiry date'
+    ON CertInstances (certificate, state, not_after)
+
+CREATE INDEX Certificates_next_action_at                   -- 'Certs due for scheduling'
+    ON Certificates (next_action_at)
+
+
 
 ;                       -- CREATE SCHEMA pki -----------------------------------
 
@@ -191,6 +191,47 @@ CREATE TRIGGER Update_updated_Subjects BEFORE UPDATE
     EXECUTE PROCEDURE Update_updated();
 
 
+------------------------------- ' invalidate next_action_at of cert, if its instances or targets change
+CREATE OR REPLACE FUNCTION Invalidate_next_action_at() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            UPDATE Certificates SET next_action_at = NULL
+                WHERE id = OLD.certificate AND next_action_at IS NOT NULL;
+            RETURN OLD;
+        END IF;
+        UPDATE Certificates SET next_action_at = NULL
+            WHERE id = NEW.certificate AND next_action_at IS NOT NULL;
+        RETURN NEW;
+    END;
+$$ LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS Invalidate_next_action_at_Certinstances ON Certinstances;
+CREATE TRIGGER Invalidate_next_action_at_Certinstances AFTER INSERT OR UPDATE OR DELETE
+    ON Certinstances FOR EACH ROW
+    EXECUTE PROCEDURE Invalidate_next_action_at();
+
+DROP TRIGGER IF EXISTS Invalidate_next_action_at_Targets ON Targets;
+CREATE TRIGGER Invalidate_next_action_at_Targets AFTER INSERT OR UPDATE OR DELETE
+    ON Targets FOR EACH ROW
+    EXECUTE PROCEDURE Invalidate_next_action_at();
+
+------------------------------- ' invalidate next_action_at of cert, if it is enabled/disabled or authorized
+CREATE OR REPLACE FUNCTION Invalidate_own_next_action_at() RETURNS TRIGGER AS $$
+    BEGIN
+        IF NEW.disabled IS DISTINCT FROM OLD.disabled OR
+                NEW.authorized_until IS DISTINCT FROM OLD.authorized_until THEN
+            NEW.next_action_at := NULL;
+        END IF;
+        RETURN NEW;
+    END;
+$$ LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS Invalidate_own_next_action_at ON Certificates;
+CREATE TRIGGER Invalidate_own_next_action_at BEFORE UPDATE
+    ON Certificates FOR EACH ROW
+    EXECUTE PROCEDURE Invalidate_own_next_action_at();
+
+
                         -- Views --------------------------------------------
 
 DROP VIEW IF EXISTS pki.certs;
@@ -631,7 +672,7 @@ GRANT EXECUTE ON ALL FUNCTIONS IN SCHEMA pki TO "serverPKI";
 
 GRANT USAGE ON SCHEMA pki TO "serverPKI";
 
-INSERT INTO Revision(schemaversion, keysencrypted) values(5,false);
+INSERT INTO Revision(schemaversion, keysencrypted) values(7,false);
 
 INSERT INTO Certificates(id,type,disabled,remarks) VALUES(1,'local',true,'Placeholder to resolve chicken-egg-problem');
 INSERT INTO Subjects(id,type,name,isAltname,certificate,remarks) VALUES(1,'CA','No cert',false,1, 'Placeholder to resolve chicken-egg-problem');
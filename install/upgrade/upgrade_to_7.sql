@@ -0,0 +1,66 @@
+-- upgrade_to_7.sql
+
+START TRANSACTION; 
+
+SET search_path = pki, dd, public, pg_catalog;
+
+
+ALTER TABLE Revision
+    ADD COLUMN keysRotatedUntil  int4  NULL,   -- 'Last CertKeyData id re-encrypted by an unfinished key rotation'
+    ADD COLUMN rotationKeyHash   TEXT  NULL,   -- 'sha256 of new DB encryption key of an unfinished key rotation'
+    ADD COLUMN prePublishTimedelta      int4  NULL,   -- 'PRE_PUBLISH_TIMEDELTA, Certificates.next_action_at was computed with'
+    ADD COLUMN localIssueMailTimedelta  int4  NULL;   -- 'LOCAL_ISSUE_MAIL_TIMEDELTA, Certificates.next_action_at was computed with'
+
+CREATE INDEX CertInstances_certificate_state_not_after
+    ON CertInstances (certificate, state, not_after);
+
+ALTER TABLE Certificates
+    ADD COLUMN next_action_at TIMESTAMP NULL;  -- 'scheduling may have work for cert after this, NULL if unknown'
+
+CREATE INDEX Certificates_next_action_at
+    ON Certificates (next_action_at);
+
+
+------------------------------- ' invalidate next_action_at of cert, if its instances or targets change
+CREATE OR REPLACE FUNCTION Invalidate_next_action_at() RETURNS TRIGGER AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            UPDATE Certificates SET next_action_at = NULL
+                WHERE id = OLD.certificate AND next_action_at IS NOT NULL;
+            RETURN OLD;
+        END IF;
+        UPDATE Certificates SET next_action_at = NULL
+            WHERE id = NEW.certificate AND next_action_at IS NOT NULL;
+        RETURN NEW;
+    END;
+$$ LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS Invalidate_next_action_at_Certinstances ON Certinstances;
+CREATE TRIGGER Invalidate_next_action_at_Certinstances AFTER INSERT OR UPDATE OR DELETE
+    ON Certinstances FOR EACH ROW
+    EXECUTE PROCEDURE Invalidate_next_action_at();
+
+DROP TRIGGER IF EXISTS Invalidate_next_action_at_Targets ON Targets;
+CREATE TRIGGER Invalidate_next_action_at_Targets AFTER INSERT OR UPDATE OR DELETE
+    ON Targets FOR EACH ROW
+    EXECUTE PROCEDURE Invalidate_next_action_at();
+
+------------------------------- ' invalidate next_action_at of cert, if it is enabled/disabled or authorized
+CREATE OR REPLACE FUNCTION Invalidate_own_next_action_at() RETURNS TRIGGER AS $$
+    BEGIN
+        IF NEW.disabled IS DISTINCT FROM OLD.disabled OR
+                NEW.authorized_until IS DISTINCT FROM OLD.authorized_until THEN
+            NEW.next_action_at := NULL;
+        END IF;
+        RETURN NEW;
+    END;
+$$ LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS Invalidate_own_next_action_at ON Certificates;
+CREATE TRIGGER Invalidate_own_next_action_at BEFORE UPDATE
+    ON Certificates FOR EACH ROW
+    EXECUTE PROCEDURE Invalidate_own_next_action_at();
+    
+UPDATE Revision SET schemaVersion=7 WHERE id=1;
+
+COMMIT;
@@ -20,7 +20,7 @@ along with serverPKI.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 __version__ = (0, 9, 11)
-__schema_version__ =6
+__schema_version__ =7
 __author__ = "Axel Rau <Axel.Rau@Chaos1.DE>"
 __licence__ = "Apache License V2.0"
 
@@ -23,11 +23,16 @@ along with serverPKI.  If not, see <http://www.gnu.org/licenses/>.
 
 # --------------- imported modules --------------
 import binascii
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+import os
 from functools import total_ordering
-from pathlib import Path
+import hashlib
 import sys
-from typing import Union, Optional, Dict, List, Tuple
+from threading import Lock
+import time
+from typing import Callable, Union, Optional, Dict, List, Set, Tuple
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePrivateKey
@@ -46,12 +51,13 @@ from postgresql import driver as db_conn
 # --------------- local imports --------------
 from serverPKI import get_version, get_schema_version
 from serverPKI.db import DBStoreException
-from serverPKI.utils import Pathes, sld, sli, sln, sle
+from serverPKI.utils import Pathes, Misc, sld, sli, sln, sle
 
 # ---------------  prepared SQL queries for class Certificate  --------------
 
-q_all_cert_meta = """
- SELECT s1.type AS subject_type,
+q_cert_meta = """
+ SELECT s1.name::TEXT AS name,
+    s1.type AS subject_type,
     c.id AS c_id,
     c.disabled AS c_disabled,
     c.type AS c_type,
@@ -82,9 +88,16 @@ q_all_cert_meta = """
      LEFT JOIN disthosts d ON t.disthost = d.id
      LEFT JOIN jails j ON t.jail = j.id
      LEFT JOIN places p ON t.place = p.id
+"""
+q_all_cert_meta = q_cert_meta + """
   WHERE s1.name = $1
   ORDER BY s1.name, s2.name, d.fqdn;
 """
+# same for a list of cert names (bulk load)
+q_cert_metas = q_cert_meta + """
+  WHERE s1.name = ANY($1::CITEXT[])
+  ORDER BY s1.name, s2.name, d.fqdn;
+"""
 # return row_ids of certinstances, ordered by row_id
 q_instances = """
 SELECT id
@@ -92,6 +105,19 @@ SELECT id
     WHERE certificate = $1::INT
     ORDER BY id;
 """
+# return instances with their cert key data and name of CA cert of a list of certificates (bulk load)
+q_instances_of_certs = """
+SELECT ci.id, ci.certificate AS cm_id, ci.state::TEXT, ci.ocsp_must_staple, ci.not_before, ci.not_after,
+                        ci.CAcert AS ca_cert_ci_id, cas.name::TEXT AS ca_name,
+                        d.id AS ckd_id, d.encryption_algo::TEXT, d.cert, d.key, d.hash
+    FROM CertInstances ci
+    LEFT JOIN CertInstances ca ON ci.CAcert = ca.id
+    LEFT JOIN Subjects cas     ON cas.certificate = ca.certificate AND NOT cas.isaltname
+    LEFT JOIN CertKeyData d    ON d.certinstance = ci.id
+    WHERE
+        ci.certificate = ANY($1::INT[])
+    ORDER BY ci.id, d.id;
+"""
 
 q_insert_cacert = """
     INSERT INTO Certificates(type)
@@ -122,7 +148,9 @@ SELECT s.name::TEXT
 """
 
 ps_all_cert_meta = None
+ps_cert_metas = None
 ps_instances = None
+ps_instances_of_certs = None
 ps_insert_cacert = None
 ps_insert_cacert_subject = None
 ps_update_authorized_until = None
@@ -133,14 +161,23 @@ ps_fqdn_from_serial = None
 
 def init_module_cert():
 
-    Certificate._all_CMs = {}
-    CertKeyStore._cert_key_stores = {}
+    # registries are cleared in place: __del__ of their entries removes them from the registry
+    Certificate._all_CMs.clear()
+    Certificate._ca_instances.clear()
+    Certificate._zones = None
+    CertKeyStore._cert_key_stores.clear()
+    CertKeyStore.clear_key_cache()
 
     global ps_all_cert_meta
     ps_all_cert_meta = None
 
+    global ps_cert_metas
+    ps_cert_metas = None
+
     global ps_instances
     ps_instances = None
+    global ps_instances_of_certs
+    ps_instances_of_certs = None
 
     global ps_insert_cacert
     ps_insert_cacert = None
@@ -173,10 +210,25 @@ def init_module_cert():
     DB_Encryption.in_use = False
     DB_Encryption.key = None
 
+    UnitOfWork.depth = 0
+    UnitOfWork.db = None
+    UnitOfWork.dirty_instances = {}
+    UnitOfWork.dirty_key_stores = {}
+
     global ps_select_revision
     ps_select_revision = None
     global ps_update_revision
     ps_update_revision = None
+    global ps_select_rotation
+    ps_select_rotation = None
+    global ps_update_rotation
+    ps_update_rotation = None
+    global ps_select_keys_chunk
+    ps_select_keys_chunk = None
+    global ps_count_keys
+    ps_count_keys = None
+    global ps_update_key
+    ps_update_key = None
 
 # ------------------------ Some string checking classes -------------------------
 # From: https://stackoverflow.com/questions/7255655/how-to-subclass-str-in-python?answertab=votes#tab-top
@@ -228,8 +280,13 @@ class Certificate(object):
     Certificate meta data class.
     In-memory representation of DB backed meta information.
     """
+    __slots__ = ('db', 'name', 'altnames', 'tlsaprefixes', 'disthosts', 'row_id', 'cert_instances',
+                 '_ci_by_row_id', '_ci_by_state', '_max_row_id', '_zones_and_fqdns',
+                 'cert_type', 'disabled', 'authorized_until', 'subject_type', 'encryption_algo', 'ocsp_must_staple')
 
     _all_CMs = {}
+    _ca_instances = {}              # row_id -> CertInstance of all CA cert metas loaded so far
+    _zones: Optional[Set[str]] = None   # names of zones on DNS master, read once per run
 
 
     @staticmethod
@@ -246,6 +303,20 @@ class Certificate(object):
 
 
 
+    @staticmethod
+    def ca_instance(db: db_conn, row_id: int, ca_name: str) -> Optional['CertInstance']:
+        """
+        Obtain the instance of a CA cert by row_id. The CA cert meta is loaded on first use.
+        :param db: opened DB connection
+        :param row_id: row_id of the CA cert instance
+        :param ca_name: subject name of the CA cert
+        :return: the CertInstance or None if not found
+        """
+        if row_id in Certificate._ca_instances:
+            return Certificate._ca_instances[row_id]
+        ca_cert_meta = Certificate.create_or_load_cert_meta(db, ca_name)
+        return ca_cert_meta.instance_from_row_id(row_id)
+
     @staticmethod
     def fqdn_from_instance_serial(db: db_conn, serial: int):
         """
@@ -334,15 +405,77 @@ class Certificate(object):
             names.append(name)
         return names
 
+    @staticmethod
+    def load_many(db: db_conn, names: List[str]) -> Dict[str, 'Certificate']:
+        """
+        Bulk load cert metas with all their instances and cert key stores.
+        Needs one query for the meta data of all certs and one for all instances and their cert key data.
+        CA cert metas, referenced by the instances and not yet loaded, are loaded first the same way.
+        :param db:      opened database connection
+        :param names:   list of cert names to load
+        :return:        dict of cert metas found in DB, with cert name as key
+        """
+
+        global ps_cert_metas, ps_instances_of_certs
+
+        to_be_loaded = [name for name in names if name not in Certificate._all_CMs]
+
+        if to_be_loaded:
+            sld('Certificate.load_many: loading {} cert metas'.format(len(to_be_loaded)))
+            new_cms = {}
+            with db.xact(isolation='SERIALIZABLE', mode='READ ONLY'):
+                if not ps_cert_metas:
+                    ps_cert_metas = db.prepare(q_cert_metas)
+                for row in ps_cert_metas(to_be_loaded):
+                    if row['name'] not in new_cms:
+                        new_cms[row['name']] = Certificate(db, row['name'], bulk=True)
+                    new_cms[row['name']]._add_meta_row(row)
+
+                if not ps_instances_of_certs:
+                    ps_instances_of_certs = db.prepare(q_instances_of_certs)
+                instance_rows = ps_instances_of_certs([cm.row_id for cm in new_cms.values()])
+
+            # collect rows per cert meta and instance (rows are ordered by instance id)
+            rows_by_cm = {}
+            ca_names = set()
+            for row in instance_rows:
+                ci_rows = rows_by_cm.setdefault(row['cm_id'], {})
+                ci_rows.setdefault(row['id'], []).append(row)
+                if row['ca_name'] not in new_cms:
+                    ca_names.add(row['ca_name'])
+
+            # CA cert metas must be there, before instances issued by them can be loaded
+            if ca_names:
+                Certificate.load_many(db, list(ca_names))
+
+            for cm in sorted(new_cms.values(), key=lambda cm: cm.subject_type != SubjectType('CA')):
+                for row_id, rows in rows_by_cm.get(cm.row_id, {}).items():
+                    ca_cert_ci = None
+                    if cm.subject_type != SubjectType('CA'):
+                        ca_cert_ci = Certificate.ca_instance(db, rows[0]['ca_cert_ci_id'], rows[0]['ca_name'])
+                        assert ca_cert_ci, '? No CI for CA cert found, while loading CI of {}:{}'.format(
+                            cm.name, row_id)
+                    ci = CertInstance(row_id=row_id, cert_meta=cm, ca_cert_ci=ca_cert_ci, rows=rows)
+                    cm._add_instance(ci)
+            sld('Certificate.load_many: loaded {} cert metas and {} cert instances'.format(
+                len(new_cms), sum([len(ci_rows) for ci_rows in rows_by_cm.values()])))
+
+        result = {}
+        for name in names:
+            if name in Certificate._all_CMs:
+                result[name] = Certificate._all_CMs[name]
+        return result
+
     def __del__(self):
         if self.name in Certificate._all_CMs:
             del Certificate._all_CMs[self.name]
 
-    def __init__(self, db: db_conn, name: str):
+    def __init__(self, db: db_conn, name: str, bulk: bool = False):
         """
         Create or load a certificate meta instance.
         :param db: opened database connection
         :param name: subject name of certificate, ignored, if serial present
+        :param bulk: do not query the DB, meta data and instances are filled in by Certificate.load_many
         :param serial: row_id of instance, whose cert meta we are creating  # FIXME # ???
         """
 
@@ -357,84 +490,23 @@ class Certificate(object):
 
         self.altnames = []
         self.tlsaprefixes = {}
-        self.disthosts = {}
+        self.disthosts: Dict[str, DistHost] = {}
 
         self.row_id = None
+        self.cert_instances = []
+        self._ci_by_row_id = {}             # row_id -> CertInstance
+        self._ci_by_state = {}              # state -> {row_id -> CertInstance}
+        self._max_row_id = None             # row_id of most recent instance
+        self._zones_and_fqdns = None        # memoized result of zone_and_FQDN_from_altnames
+
+        if bulk:
+            return
 
         with self.db.xact(isolation='SERIALIZABLE', mode='READ ONLY'):
             if not ps_all_cert_meta:
                 ps_all_cert_meta = db.prepare(q_all_cert_meta)
             for row in ps_all_cert_meta(self.name):
-                self.row_id = row['c_id']
-                self.cert_type = CertType(row['c_type'])
-                self.disabled = row['c_disabled']
-                self.authorized_until = row['authorized_until']
-                self.subject_type = SubjectType(row['subject_type'])
-                self.encryption_algo = EncAlgo(row['encryption_algo'])
-                self.ocsp_must_staple = row['ocsp_must_staple']
-                sld('----------- {}\t{}\t{}\t{}\t{}\t{}\t{}'.format(
-                    self.row_id,
-                    self.name,
-                    self.cert_type,
-                    self.disabled,
-                    self.authorized_until,
-                    self.subject_type,
-                    self.encryption_algo,
-                    self.ocsp_must_staple)
-                )
-                if row['alt_name']: self.altnames.append(row['alt_name'])
-                if row['tlsaprefix']: self.tlsaprefixes[row['tlsaprefix']] = 1
-
-                # crate a tree from rows:  dh1... -> jl1... -> pl1..., )
-
-                if row['dist_host']:
-                    if row['dist_host'] in self.disthosts:
-                        dh = self.disthosts[row['dist_host']]
-                    else:
-                        dh = {'jails': {}}
-                        self.disthosts[row['dist_host']] = dh
-                        jr = ''
-                        if row['jailroot']: jr = row['jailroot']
-                        self.disthosts[row['dist_host']]['jailroot'] = jr
-
-                    if row['jail']:
-                        if row['jail'] == '':
-                            raise Exception('Empty jail name of disthost {} in DB - '
-                                            'Jail names must not be empty'.format(row['dist_host']))
-                        jail_name = row['jail']
-                    else:
-                        jail_name = ''
-
-                    if jail_name in dh['jails']:
-                        jl = dh['jails'][jail_name]
-                    else:
-                        jl = {'places': {}}
-                        dh['jails'][jail_name] = jl
-
-                    if row['place']:
-                        if row['place'] not in jl['places']:
-                            p = Place(
-                                name=row['place'],
-                                cert_file_type=row['cert_file_type'],
-                                cert_path=row['cert_path'],
-                                key_path=row['key_path'],
-                                uid=row['uid'],
-                                gid=row['gid'],
-                                mode=row['mode'],
-                                chownboth=row['chownboth'],
-                                pglink=row['pglink'],
-                                reload_command=row['reload_command']
-                            )
-                            jl['places'][row['place']] = p
-                    else:
-                        sln('Missing Place in Disthost {}'.format(row['dist_host']))
-
-                sld('altname:{}\tdisthost:{}\tjail:{}\tplace:{}'.format(
-                    row['alt_name'] if row['alt_name'] else '',
-                    row['dist_host'] if row['dist_host'] else '',
-                    row['jail'] if row['jail'] else '',
-                    row['place'] if row['place'] else '')
-                )
+                self._add_meta_row(row)
             sld('tlsaprefixes of {}: {}'.format(self.name, self.tlsaprefixes))
 
             # End of meta data tree creation. Now do cert instances
@@ -442,11 +514,83 @@ class Certificate(object):
             if not ps_instances:
                 ps_instances = db.prepare(q_instances)
 
-            self.cert_instances = []
             for row in ps_instances(self.row_id):
                 ci = CertInstance(row_id=row['id'], cert_meta=self)
-                self.cert_instances.append(ci)
+                self._add_instance(ci)
+
+    def _add_meta_row(self, row) -> None:
+        """
+        Add one row of the meta data query to this cert meta
+        :param row: row of q_all_cert_meta or q_cert_metas
+        :return:
+        """
+        self.row_id = row['c_id']
+        self.cert_type = CertType(row['c_type'])
+        self.disabled = row['c_disabled']
+        self.authorized_until = row['authorized_until']
+        self.subject_type = SubjectType(row['subject_type'])
+        self.encryption_algo = EncAlgo(row['encryption_algo'])
+        self.ocsp_must_staple = row['ocsp_must_staple']
+        sld('----------- {}\t{}\t{}\t{}\t{}\t{}\t{}'.format(
+            self.row_id,
+            self.name,
+            self.cert_type,
+            self.disabled,
+            self.authorized_until,
+            self.subject_type,
+            self.encryption_algo,
+            self.ocsp_must_staple)
+        )
+        if row['alt_name']: self.altnames.append(row['alt_name'])
+        if row['tlsaprefix']: self.tlsaprefixes[row['tlsaprefix']] = 1
+
+        # crate a tree from rows:  dh1... -> jl1... -> pl1..., )
+
+        if row['dist_host']:
+            if row['dist_host'] in self.disthosts:
+                dh = self.disthosts[row['dist_host']]
+            else:
+                dh = DistHost(fqdn=row['dist_host'], jailroot=row['jailroot'] if row['jailroot'] else '')
+                self.disthosts[row['dist_host']] = dh
+
+            if row['jail']:
+                if row['jail'] == '':
+                    raise Exception('Empty jail name of disthost {} in DB - '
+                                    'Jail names must not be empty'.format(row['dist_host']))
+                jail_name = row['jail']
+            else:
+                jail_name = ''
 
+            if jail_name in dh.jails:
+                jl = dh.jails[jail_name]
+            else:
+                jl = Jail(name=jail_name)
+                dh.jails[jail_name] = jl
+
+            if row['place']:
+                if row['place'] not in jl.places:
+                    p = Place(
+                        name=row['place'],
+                        cert_file_type=row['cert_file_type'],
+                        cert_path=row['cert_path'],
+                        key_path=row['key_path'],
+                        uid=row['uid'],
+                        gid=row['gid'],
+                        mode=row['mode'],
+                        chownboth=row['chownboth'],
+                        pglink=row['pglink'],
+                        reload_command=row['reload_command']
+                    )
+                    jl.places[row['place']] = p
+            else:
+                sln('Missing Place in Disthost {}'.format(row['dist_host']))
+
+        sld('altname:{}\tdisthost:{}\tjail:{}\tplace:{}'.format(
+            row['alt_name'] if row['alt_name'] else '',
+            row['dist_host'] if row['dist_host'] else '',
+            row['jail'] if row['jail'] else '',
+            row['place'] if row['place'] else '')
+        )
 
     def create_instance(self,
                         state: Optional[CertState],
@@ -468,14 +612,37 @@ class Certificate(object):
                           ca_cert_ci=ca_cert_ci,
                           cert_key_stores=cert_key_stores)
         ci._save()                             # obtain a row_id to make it unique
-        for a_ci in self.cert_instances:
-            assert ci.row_id != a_ci.row_id, '?Duplicate CI found with row_id={} and cert meta={}'.format(
-                ci.row_id, self.name)
-        assert ci not in self.cert_instances, '?Attempted to create CI a 2nd time with row_id={} and cert meta={}'.format(
+        assert ci.row_id not in self._ci_by_row_id, '?Duplicate CI found with row_id={} and cert meta={}'.format(
                 ci.row_id, self.name)
-        self.cert_instances.append(ci)
+        self._add_instance(ci)
         return ci
 
+    def _add_instance(self, ci: 'CertInstance') -> None:
+        """
+        Append a loaded or newly created instance to self.cert_instances and index it by row_id and state
+        :param ci: the CertInstance, must have a row_id
+        :return:
+        """
+        self.cert_instances.append(ci)
+        self._ci_by_row_id[ci.row_id] = ci
+        self._ci_by_state.setdefault(ci.state, {})[ci.row_id] = ci
+        if self._max_row_id is None or ci.row_id > self._max_row_id:
+            self._max_row_id = ci.row_id
+        if self.subject_type == SubjectType('CA'):
+            Certificate._ca_instances[ci.row_id] = ci
+
+    def _reindex_instance(self, ci: 'CertInstance', old_state: Optional[CertState]) -> None:
+        """
+        Move an instance to the index of its new state. Called by CertInstance on state change.
+        :param ci: the CertInstance, whose state has changed
+        :param old_state: previous state of ci
+        :return:
+        """
+        if self._ci_by_row_id.get(ci.row_id) is not ci:
+            return                          # not yet added
+        self._ci_by_state.get(old_state, {}).pop(ci.row_id, None)
+        self._ci_by_state.setdefault(ci.state, {})[ci.row_id] = ci
+
     def save_instance(self, ci: 'CertInstance'):
         """
         Save a new instance of CertInstance in DB backend and store it in self.cert_instances
@@ -497,8 +664,12 @@ class Certificate(object):
         'with row_id={} and cert meta={}'.format(
             ci.row_id, self.name)
         result = ci._delete()
-        if ci in self.cert_instances:
+        if self._ci_by_row_id.pop(ci.row_id, None):
+            Certificate._ca_instances.pop(ci.row_id, None)
             self.cert_instances.remove(ci)
+            self._ci_by_state[ci.state].pop(ci.row_id, None)
+            if ci.row_id == self._max_row_id:
+                self._max_row_id = max(self._ci_by_row_id) if self._ci_by_row_id else None
         return result
 
     @property
@@ -518,9 +689,9 @@ class Certificate(object):
     @property
     def most_recent_active_instance(self) -> Optional['CertInstance']:
 
-        if not self.cert_instances:
+        if self._max_row_id is None:
             return None
-        return sorted(self.cert_instances, key=lambda ci: ci.row_id)[-1]
+        return self._ci_by_row_id[self._max_row_id]
 
     @property
     def active_instances(self) -> dict:
@@ -531,28 +702,61 @@ class Certificate(object):
          """
         ret_dict = {}
 
-        for ci in (self.cert_instances):
-            if ci.active:
-                ret_dict[ci.state] = ci
+        for (state, cis) in self._ci_by_state.items():
+            active = [ci for ci in cis.values() if ci.active]
+            if active:
+                ret_dict[state] = max(active)       # most recent, if more than one
 
         return ret_dict
 
+    def instances_in_state(self, state: CertState) -> List['CertInstance']:
+        """
+        Return instances in given state
+        :param state: the state
+        :return: list of CertInstances, ordered by row_id
+        """
+        return sorted(self._ci_by_state.get(state, {}).values())
+
     def instance_from_row_id(self, row_id: int) -> Optional['CertInstance']:
         """
         Obtain the instance by DB row_id
         :param row_id:
-        :return: the CertInstance of an issued certificate
-        :exception: raises AssertionError if CI not found
+        :return: the CertInstance of an issued certificate or None if not found
         """
-        for ci in (self.cert_instances):
-            if ci.row_id == row_id:
-                return ci
+        return self._ci_by_row_id.get(row_id)
+
+    @staticmethod
+    def zones() -> Set[str]:
+        """
+        Names of zones on DNS master, either configured with DNS_ZONES or,
+        if not configured, the names of the subdirectories of zone_file_root.
+        Determined once per run.
+        :return: Set of zone names
+        """
+        if Certificate._zones is None:
+            if Misc.DNS_ZONES:
+                Certificate._zones = set([zone.rstrip('.') for zone in Misc.DNS_ZONES])
+            else:
+                try:
+                    with os.scandir(str(Pathes.zone_file_root)) as it:
+                        Certificate._zones = set([entry.name for entry in it if entry.is_dir()])
+                except OSError as e:
+                    sln('Unable to read zones from {} [{}]'.format(Pathes.zone_file_root, str(e)))
+                    Certificate._zones = set()
+            sld('Zones of DNS master: {}'.format(', '.join(sorted(Certificate._zones))))
+        return Certificate._zones
 
     def zone_and_FQDN_from_altnames(self) -> List[Optional[Tuple[str, str]]]:
         """
         Retrieve zone and FQDN of TLSA RRs.
+        The zone of a FQDN is its longest suffix found in Certificate.zones().
+        Result is computed once per cert meta.
         :return: List of tuples, each containing 2 strings: zone name and fqdn of TLSA RR
         """
+        if self._zones_and_fqdns is not None:
+            return self._zones_and_fqdns
+
+        zones = Certificate.zones()
         retval = []
         alt_names = [self.name, ]
         if len(self.altnames) > 0:
@@ -560,12 +764,13 @@ class Certificate(object):
 
         for fqdn in alt_names:
             fqdn_tags = fqdn.split(sep='.')
-            for i in range(1, len(fqdn_tags) + 1):
-                zone = '.'.join(fqdn_tags[-i::])
-                if (Path(Pathes.zone_file_root) / zone).exists():
-                    sld('{}'.format(str(Path(Pathes.zone_file_root) / zone)))
+            for i in range(len(fqdn_tags)):
+                zone = '.'.join(fqdn_tags[i:])
+                if zone in zones:
+                    sld('Zone of {} is {}'.format(fqdn, zone))
                     retval.append((zone, fqdn))
                     break
+        self._zones_and_fqdns = retval
         return retval
 
     def TLSA_hashes(self, cert_instance: Optional['CertInstance']) -> Optional[Dict[EncAlgoCKS, str]]:
@@ -578,7 +783,7 @@ class Certificate(object):
         """
         ci = None
         if cert_instance:
-            assert cert_instance in self.cert_instances
+            assert self._ci_by_row_id.get(cert_instance.row_id) is cert_instance
             ci = cert_instance
         else:
             for ci in reversed(self.cert_instances):
@@ -645,6 +850,8 @@ class Place(object):
     It may be re-used at multiple target hosts.
     Backed up in DB table Places'
     """
+    __slots__ = ('name', 'cert_file_type', 'cert_path', 'key_path', 'uid', 'gid', 'mode',
+                 'chownBoth', 'pgLink', 'reload_command')
 
     def __init__(self, name: str = None,
                  cert_file_type=None,
@@ -681,15 +888,53 @@ class Place(object):
         self.reload_command = reload_command
 
 
+# --------------- classes DistHost and Jail --------------
+
+class Jail(object):
+    """
+    Jail (or the host itself, if name is empty) on a DistHost, where
+    cert and key files of a cert meta are deployed.
+    """
+    __slots__ = ('name', 'places')
+
+    def __init__(self, name: str):
+        """
+
+        :param name: Name of Jail, empty if cert is deployed to the disthost itself
+        """
+        self.name = name
+        self.places: Dict[str, Place] = {}
+
+
+class DistHost(object):
+    """
+    Target host of a cert meta with its jails.
+    Backed up in DB tables DistHosts and Jails
+    """
+    __slots__ = ('fqdn', 'jailroot', 'jails')
+
+    def __init__(self, fqdn: str, jailroot: str = ''):
+        """
+
+        :param fqdn: FQDN of DistHost
+        :param jailroot: Path to root of jails, may be empty
+        """
+        self.fqdn = fqdn
+        self.jailroot = jailroot
+        self.jails: Dict[str, Jail] = {}
+
+
 # part module for classes CertInstance and CertKeyStore
 
 # ---------------  prepared SQL queries for class CertInstance  --------------
 
 q_load_instance = """
     SELECT ci.id, ci.certificate AS cm_id, ci.state::TEXT, ci.ocsp_must_staple, ci.not_before, ci.not_after,
-                        ci.CAcert AS ca_cert_ci_id, d.id AS ckd_id, d.encryption_algo::TEXT, d.cert, d.key, d.hash
+                        ci.CAcert AS ca_cert_ci_id, cas.name::TEXT AS ca_name,
+                        d.id AS ckd_id, d.encryption_algo::TEXT, d.cert, d.key, d.hash
             FROM CertInstances ci
             LEFT JOIN CertInstances ca ON ci.CAcert = ca.id
+            LEFT JOIN Subjects cas     ON cas.certificate = ca.certificate AND NOT cas.isaltname
             LEFT JOIN CertKeyData d    ON d.certinstance = ci.id
             WHERE
                 ci.id = $1::INT;
@@ -735,6 +980,7 @@ class CertInstance(object):
     Issued certificate instance class.
     In-memory representation of DB backend CertInstances.
     """
+    __slots__ = ('cm', '_state', 'ocsp_ms', 'not_before', 'not_after', 'ca_cert_ci', 'cksd', 'row_id')
 
     def __init__(self,
                  cert_meta: Certificate,
@@ -744,7 +990,8 @@ class CertInstance(object):
                  not_before: datetime.datetime = None,
                  not_after: datetime.datetime = None,
                  ca_cert_ci: Optional['CertInstance'] = None,
-                 cert_key_stores: Dict[EncAlgoCKS, 'CertKeyStore'] = {}):
+                 cert_key_stores: Dict[EncAlgoCKS, 'CertKeyStore'] = {},
+                 rows: Optional[list] = None):
         """
         Load or create a certificate instance (CI), which may be incomplete and may be updated later
         :param cert_meta: Our Certificate meta instance (required)
@@ -755,6 +1002,7 @@ class CertInstance(object):
         :param not_after:
         :param ca_cert_ci:  Must be supplied, if row_id is empty and cert meta is not a CA
         :param cert_key_stores:
+        :param rows: Rows of this instance, already queried by Certificate.load_many, requires row_id
         """
 
         global ps_load_instance
@@ -774,7 +1022,8 @@ class CertInstance(object):
         self.cksd = cert_key_stores if cert_key_stores else {}
         if row_id:
             self.row_id = row_id
-            rows = ps_load_instance(self.row_id)
+            if not rows:
+                rows = ps_load_instance(self.row_id)
             if not rows:
                 raise AssertionError('CertInstance: row_id {} does not exist'.format(self.row_id))
 
@@ -788,10 +1037,8 @@ class CertInstance(object):
                     self.not_after = row['not_after']
                     if self.cm.subject_type == SubjectType('CA'):       # are we a CA ?
                         self.ca_cert_ci = self                          # yes - we are issued from our self
-                    else:
-                        ca_cert_fqdn = Certificate.fqdn_from_instance_serial(cert_meta.db, row['ca_cert_ci_id'])
-                        ca_cert_meta = Certificate.create_or_load_cert_meta(cert_meta.db, ca_cert_fqdn)   # This have been loaded already by operate.execute_from_command_line
-                        self.ca_cert_ci = ca_cert_meta.instance_from_row_id(row['ca_cert_ci_id'])
+                    elif not ca_cert_ci:                                # not resolved by Certificate.load_many?
+                        self.ca_cert_ci = Certificate.ca_instance(cert_meta.db, row['ca_cert_ci_id'], row['ca_name'])
                         assert self.ca_cert_ci, '? No CI for CA cert found, while loading CI of {}:{}'.format(cert_meta.name, self.row_id)
                     sld('Loaded CertInstance row_id={}, state={}, ocsp_ms={}, not_before={}, not_after={}, ca_cert_ci_id={}'
                         .format(self.row_id, self.state, self.ocsp_ms,
@@ -814,6 +1061,22 @@ class CertInstance(object):
                 self.ca_cert_ci = self
 
 
+    @property
+    def state(self) -> CertState:
+        return self._state
+
+    @state.setter
+    def state(self, state: str) -> None:
+        """
+        Set state and keep the state index of our cert meta up to date
+        :param state: the new state
+        :return:
+        """
+        old_state = getattr(self, '_state', None)
+        self._state = CertState(state)
+        if old_state is not None and old_state != self._state:
+            self.cm._reindex_instance(self, old_state)
+
     def __str__(self):
         return str(self.row_id if self.row_id else self.cm.name + 'instance')
 
@@ -826,6 +1089,19 @@ class CertInstance(object):
     def __hash__(self):
         return self.row_id
 
+    def _update_row(self) -> tuple:
+        """
+        Return parameters of q_update_instance for this instance
+        :return:
+        """
+        return (self.cm.row_id,
+                self.state,
+                self.ocsp_ms,
+                self.not_before,
+                self.not_after,
+                self.ca_cert_ci.row_id,
+                self.row_id)
+
     def _delete(self) -> int:
         """
         Delete this instance of CertInstance in DB backend and all its CertKeyStores (per cascaded delete)
@@ -833,6 +1109,10 @@ class CertInstance(object):
         """
         global ps_delete_instance
 
+        UnitOfWork.dirty_instances.pop(self.row_id, None)       # no update of deleted rows
+        for cks in self.cksd.values():
+            UnitOfWork.dirty_key_stores.pop(cks.row_id, None)
+
         if not ps_delete_instance:
             ps_delete_instance = self.cm.db.prepare(q_delete_instance)
         sld('CI._delete called for row_id {}'.format(self.row_id))
@@ -850,6 +1130,10 @@ class CertInstance(object):
         """
         global ps_store_instance, ps_update_instance, ps_store_cacert_instance
 
+        if self.row_id and UnitOfWork.depth:    # update is deferred until end of phase
+            UnitOfWork.dirty_instances[self.row_id] = self
+            return
+
         if not ps_store_instance:
             ps_store_instance = self.cm.db.prepare(q_store_instance)
         if not ps_update_instance:
@@ -863,13 +1147,7 @@ class CertInstance(object):
             self.ca_cert_ci.row_id
         ))
         if self.row_id:
-            result = ps_update_instance.first(self.cm.row_id,
-                                        self.state,
-                                        self.ocsp_ms,
-                                        self.not_before,
-                                        self.not_after,
-                                        self.ca_cert_ci.row_id,
-                                        self.row_id)
+            result = ps_update_instance.first(*self._update_row())
             assert result==1,'?Failed to update CI with row_id {} of cert {}'.format(self.row_id, self.cm.name)
         else:
             if self.ca_cert_ci == self:     # we are a CI of a CA cert meta
@@ -981,9 +1259,32 @@ class CertKeyStore(object):
     Cert key data store class class.
     In-memory representation of DB backend CertKeyData.
     """
+    __slots__ = ('ci', 'algo', 'row_id', '_cert', '_key', 'hash')
 
     _cert_key_stores = {}  # ensures that we have only one cert key store per hash
 
+    max_decrypted_keys = 64             # LRU cache of decrypted keys (PEM text), per run
+    _decrypted_keys: 'OrderedDict[int, str]' = OrderedDict()
+    _decrypted_keys_lock = Lock()
+
+    @staticmethod
+    def clear_key_cache() -> None:
+        """
+        Forget all cached decrypted keys
+        :return:
+        """
+        with CertKeyStore._decrypted_keys_lock:
+            CertKeyStore._decrypted_keys.clear()
+
+    @staticmethod
+    def _evict_key(row_id: int) -> None:
+        """
+        Forget one cached decrypted key (caller must hold _decrypted_keys_lock)
+        :param row_id: row_id of CertKeyStore
+        :return:
+        """
+        CertKeyStore._decrypted_keys.pop(row_id, None)
+
     @staticmethod
     def hash_from_cert(cert: Union[x509.Certificate, bytes]) -> str:
         """
@@ -1106,9 +1407,21 @@ class CertKeyStore(object):
         """
         if self.ci.cm.cert_type == 'CA':
             return None
-        else:
-            clear_key = self._decrypt_key(self._key)
-            return clear_key.decode('ascii')
+        if not self.row_id:
+            return self._decrypt_key(self._key).decode('ascii')
+
+        with CertKeyStore._decrypted_keys_lock:
+            clear_key = CertKeyStore._decrypted_keys.get(self.row_id)
+            if clear_key:
+                CertKeyStore._decrypted_keys.move_to_end(self.row_id)
+                return clear_key
+
+        clear_key = self._decrypt_key(self._key).decode('ascii')
+        with CertKeyStore._decrypted_keys_lock:
+            CertKeyStore._decrypted_keys[self.row_id] = clear_key
+            while len(CertKeyStore._decrypted_keys) > CertKeyStore.max_decrypted_keys:
+                CertKeyStore._evict_key(next(iter(CertKeyStore._decrypted_keys)))
+        return clear_key
 
     @property
     def key_for_ca(self) -> bytes:
@@ -1144,17 +1457,16 @@ class CertKeyStore(object):
 
         sld('CertKeyStore._save(): cm.name={}, row_id={}, ci.row_id={}, algo={}, hash={}'.format(
             self.ci.cm.name, self.row_id, self.ci.row_id, self.algo, self.hash))
+        if self.row_id:                         # key may have changed
+            with CertKeyStore._decrypted_keys_lock:
+                CertKeyStore._evict_key(self.row_id)
+        if self.row_id and UnitOfWork.depth:    # update is deferred until end of phase
+            UnitOfWork.dirty_key_stores[self.row_id] = self
+            return
         if self.row_id:
             if not ps_update_certkeydata:
                 ps_update_certkeydata = self.ci.cm.db.prepare(q_update_certkeydata)
-            updates = ps_update_certkeydata(
-                self.row_id,
-                self.ci.row_id,
-                self.algo,
-                self._cert,
-                self._key,
-                self.hash
-            )
+            updates = ps_update_certkeydata(*self._update_row())
             if updates[1] != 1:
                 raise DBStoreException('?Failed to update CertKeyStore in DB')
         else:
@@ -1170,6 +1482,18 @@ class CertKeyStore(object):
             if not self.row_id and not isinstance(self.row_id, int):
                 raise DBStoreException('?Failed to store CertKeyStore in DB: returned id={}'.format(self.row_id))
 
+    def _update_row(self) -> tuple:
+        """
+        Return parameters of q_update_certkeydata for this instance
+        :return:
+        """
+        return (self.row_id,
+                self.ci.row_id,
+                self.algo,
+                self._cert,
+                self._key,
+                self.hash)
+
     def _key_to_PEM(self, key: RSAPrivateKeyWithSerialization) -> bytes:
         """
         Serialize a key to PEM format
@@ -1224,6 +1548,66 @@ class CertKeyStore(object):
         return key_pem
 
 
+class UnitOfWork(object):
+    """
+    Collects updates of CertInstances and CertKeyStores during a phase (e.g. scheduling)
+    and flushes them at end of phase in one transaction with one batch per table.
+    Usage:
+        with UnitOfWork(db):
+            ...
+    Nested units of work are flushed by the outermost one.
+    Inserts are not deferred, because they obtain the row_id.
+    """
+    depth = 0
+    db: Optional[db_conn] = None
+    dirty_instances: Dict[int, 'CertInstance'] = {}
+    dirty_key_stores: Dict[int, 'CertKeyStore'] = {}
+
+    def __init__(self, db: db_conn):
+        self.db = db
+
+    def __enter__(self) -> 'UnitOfWork':
+        if UnitOfWork.depth == 0:
+            UnitOfWork.db = self.db
+        UnitOfWork.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        UnitOfWork.depth -= 1
+        if UnitOfWork.depth == 0:
+            UnitOfWork.flush()
+        return False
+
+    @staticmethod
+    def flush() -> None:
+        """
+        Write all collected updates to DB in one transaction
+        :return:
+        """
+        global ps_update_instance, ps_update_certkeydata
+
+        instances = list(UnitOfWork.dirty_instances.values())
+        key_stores = list(UnitOfWork.dirty_key_stores.values())
+        UnitOfWork.dirty_instances = {}
+        UnitOfWork.dirty_key_stores = {}
+        if not instances and not key_stores:
+            return
+
+        db = UnitOfWork.db
+        start = time.monotonic()
+        if not ps_update_instance:
+            ps_update_instance = db.prepare(q_update_instance)
+        if not ps_update_certkeydata:
+            ps_update_certkeydata = db.prepare(q_update_certkeydata)
+        with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+            if instances:
+                ps_update_instance.load_rows([ci._update_row() for ci in instances])
+            if key_stores:
+                ps_update_certkeydata.load_rows([cks._update_row() for cks in key_stores])
+        sli('Flushed {} cert instances and {} cert key stores in {:.3f} seconds'.format(
+            len(instances), len(key_stores), time.monotonic() - start))
+
+
 # ---------------  db encrypt/decrypt functions  --------------
 
 class DB_Encryption(object):
@@ -1267,12 +1651,33 @@ SELECT schemaVersion, keysEncrypted FROM Revision WHERE id = 1
 q_update_revision = """
 UPDATE Revision set schemaVersion=$1, keysEncrypted=$2 WHERE id = 1
 """
+q_select_rotation = """
+SELECT keysRotatedUntil, rotationKeyHash FROM Revision WHERE id = 1
+"""
+q_update_rotation = """
+UPDATE Revision set keysRotatedUntil=$1, rotationKeyHash=$2 WHERE id = 1
+"""
 
-q_select_all_keys = """
-SELECT id,key FROM CertInstances FOR UPDATE
+q_select_keys_chunk = """
+SELECT k.id::INT AS id, k.key
+    FROM CertKeyData k, CertInstances i
+    WHERE
+        k.id > $1::INT AND
+        k.certinstance = i.id AND
+        NOT EXISTS (SELECT 1 FROM Subjects s WHERE s.certificate = i.certificate AND s.type = 'CA')
+    ORDER BY k.id
+    LIMIT $2::INT
+"""
+q_count_keys = """
+SELECT count(*)::INT
+    FROM CertKeyData k, CertInstances i
+    WHERE
+        k.id > $1::INT AND
+        k.certinstance = i.id AND
+        NOT EXISTS (SELECT 1 FROM Subjects s WHERE s.certificate = i.certificate AND s.type = 'CA')
 """
 q_update_key = """
-UPDATE CertInstances SET key = $2 WHERE id = $1
+UPDATE CertKeyData SET key = $2 WHERE id = $1::INT
 """
 q_cacert = """
 SELECT s.type
@@ -1285,8 +1690,11 @@ SELECT s.type
 
 ps_select_revision = None
 ps_update_revision = None
+ps_select_rotation = None
+ps_update_rotation = None
 
-ps_select_all_keys = None
+ps_select_keys_chunk = None
+ps_count_keys = None
 ps_update_key = None
 
 
@@ -1327,58 +1735,51 @@ def load_all_CMs(db: db_conn):
     :return:
     """
     all_cert_names = Certificate.names(db)
-    for name in all_cert_names:
-        cm = Certificate.create_or_load_cert_meta(db, name)
+    Certificate.load_many(db, all_cert_names)
 
 
 def encrypt_all_keys(db: db_conn) -> bool:
     """
     Encrypt keys in DB, using configured DB encryption key.
-    Run in one trynsaction.
+    Keys are re-encrypted in chunks by recrypt_all_keys, each chunk in its own transaction.
+    Revision.keysEncrypted is set after all keys have been encrypted.
+    If interrupted, repeating the command resumes with the keys not yet encrypted.
     :param db:  Open DB handle
     :return:    True if successfully encrypted all keys
     """
 
-    load_all_CMs(db)                                # CMS are loaded in transactions
-
-    with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+    result = get_revision(db)
+    (schemaVersion, keysEncrypted) = result
+    if keysEncrypted:
+        sle('Cert keys are already encrypted.')
+        return False
 
-        result = get_revision(db)
-        (schemaVersion, keysEncrypted) = result
-        if keysEncrypted:
-            sle('Cert keys are already encrypted.')
-            return False
+    read_db_encryption_key(db)
+    if not DB_Encryption.key:
+        sle('Needing db_encryption_key to encrypt all keys (see config).')
+        sli('Create it like so: ssh-keygen -t ed25519 -m PEM -f {}'.format(Pathes.db_encryption_key))
+        sli('<ENTER> for empty passphrase.')
+        DB_Encryption.in_use = False
+        return False
 
-        set_revision(db, schemaVersion, True)       # set "keysEncrypted in transaction
-        read_db_encryption_key(db)
-        if not DB_Encryption.key:
-            sle('Needing db_encryption_key to encrypt all keys (see config).')
-            sli('Create it like so: ssh-keygen -t ed25519 -m PEM -f {}'.format(Pathes.db_encryption_key))
-            sli('<ENTER> for empty passphrase.')
-            DB_Encryption.in_use = False
-            return False
-            
-        # all CMs should have been loaded above,
-        # otherwise we get an OperationError exception "configured transaction used inside a transaction block".
-        # In this rare case, user should repeat the command and avoid concurrent operations. (-;
-        load_all_CMs(db)
-
-        for cks in CertKeyStore._cert_key_stores.values():
-            if cks.ci.cm.subject_type == SubjectType('CA'): # CA key?
-                continue                                    # yes: do not encrypt it again
-            sld('Encrypting cleartext key from CKS {}'.format(cks.row_id))
-
-            k = load_pem_private_key(
-                cks._key,
-                password=None,
-                backend=default_backend())
-            cks._key = cks._encrypt_key(k)                  # DB_Encryption.in_use was set by read_db_encryption_key()
-            cks._save()
+    if not recrypt_all_keys(db, None, DB_Encryption.key):
+        return False
 
+    with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+        set_revision(db, schemaVersion, True)       # set "keysEncrypted"
+    DB_Encryption.in_use = True
     return True
 
 
 def decrypt_all_keys(db: db_conn):
+    """
+    Decrypt keys in DB, using configured DB encryption key.
+    Keys are re-encrypted in chunks by recrypt_all_keys, each chunk in its own transaction.
+    Revision.keysEncrypted is cleared after all keys have been decrypted.
+    If interrupted, repeating the command resumes with the keys not yet decrypted.
+    :param db:  Open DB handle
+    :return:    True if successfully decrypted all keys
+    """
 
     if not DB_Encryption.key:
         sle('Needing db_encryption_key to decrypt all keys (see config).')
@@ -1392,26 +1793,234 @@ def decrypt_all_keys(db: db_conn):
         sle('Cert keys are already decrypted.')
         return False
 
-    load_all_CMs(db)                                # CMS are loaded in transactions
+    if not recrypt_all_keys(db, DB_Encryption.key, None):
+        return False
 
     with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
-
-        # all CMs should have been loaded above,
-        # otherwise we get an OperationError exception "configured transaction used inside a transaction block".
-        # In this rare case, user should repeat the command and avoid concurrent operations. (-;
-        load_all_CMs(db)
-
-        for cks in CertKeyStore._cert_key_stores.values():
-            if cks.ci.cm.subject_type == SubjectType('CA'): # CA key?
-                continue                                    # yes: do not decrypt it
-            sld('Decrypting key from CKS {}'.format(cks.row_id))
-            try:
-                cks._key = cks._decrypt_key(cks._key)
-                cks._save()
-            except TypeError as e:
-                sln("Couln't decrypt Key [CKD/CI] {}/{} for {}, because {}".format(
-                                                        cks.row_id, cks.ci.row_id, cks.ci.cm.name, e))
-
         set_revision(db, schemaVersion, False)
     DB_Encryption.in_use = False
     return True
+
+
+def rotate_db_key(db: db_conn, new_key_file: str) -> bool:
+    """
+    Re-encrypt keys in DB from configured DB encryption key to key read from new_key_file.
+    Keys are re-encrypted in chunks by recrypt_all_keys, each chunk in its own transaction,
+    which also records the row_id of the last key of the chunk in Revision.keysRotatedUntil.
+    If interrupted, repeating the command with the same new_key_file resumes after that row_id.
+    After all keys have been re-encrypted, Revision.rotationKeyHash is kept until the configured
+    db_encryption_key has been replaced by new_key_file (see check_db_key_rotation).
+    :param db:              Open DB handle
+    :param new_key_file:    Path of file with new DB encryption key
+    :return:                True if successfully re-encrypted all keys
+    """
+    global ps_select_rotation, ps_update_rotation
+
+    try:
+        result = get_revision(db)
+    except MyException:
+        return False
+    (schemaVersion, keysEncrypted) = result
+    if not keysEncrypted:
+        sle('Cert keys are not encrypted. Use --encrypt-keys instead.')
+        return False
+    if not DB_Encryption.key:
+        sle('Needing db_encryption_key to rotate DB key (see config).')
+        return False
+    try:
+        with open(new_key_file, 'rb') as f:
+            new_key = f.read()
+    except Exception:
+        sle('New DB encryption key not available, because {} [{}]'.format(
+            sys.exc_info()[0].__name__,
+            str(sys.exc_info()[1])))
+        return False
+    if not new_key:
+        sle('New DB encryption key in {} is empty.'.format(new_key_file))
+        return False
+    if new_key == DB_Encryption.key:
+        sle('New DB encryption key in {} is the same as the configured one.'.format(new_key_file))
+        return False
+    new_key_hash = hashlib.sha256(new_key).hexdigest()
+
+    if not ps_select_rotation:
+        ps_select_rotation = db.prepare(q_select_rotation)
+    if not ps_update_rotation:
+        ps_update_rotation = db.prepare(q_update_rotation)
+
+    with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+        (rotated_until, rotation_key_hash) = ps_select_rotation.first()
+        if rotation_key_hash and rotation_key_hash != new_key_hash:
+            sle('Unfinished rotation to another DB encryption key found (up to CKS {}). '
+                'Resume it with that key first.'.format(rotated_until))
+            return False
+        if rotation_key_hash and rotated_until is None:
+            sli('All keys already re-encrypted with new DB encryption key.')
+            sli('Now replace {} by {}.'.format(Pathes.db_encryption_key, new_key_file))
+            return True
+        if rotation_key_hash:
+            start_after = rotated_until
+            sli('Resuming DB key rotation after CKS {}'.format(start_after))
+        else:
+            start_after = 0
+            ps_update_rotation(0, new_key_hash)
+
+    if not recrypt_all_keys(db, DB_Encryption.key, new_key, start_after=start_after,
+                            on_chunk=lambda last_id: ps_update_rotation(last_id, new_key_hash)):
+        sle('DB key rotation incomplete. Repeat it with the same key file to resume.')
+        return False
+
+    with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+        ps_update_rotation(None, new_key_hash)     # finished, but key file not yet replaced
+    DB_Encryption.key = new_key
+    sln('All keys re-encrypted with new DB encryption key.')
+    sli('Now replace {} by {}.'.format(Pathes.db_encryption_key, new_key_file))
+    return True
+
+
+def check_db_key_rotation(db: db_conn) -> bool:
+    """
+    Check, that keys in DB can be decrypted with the configured DB encryption key.
+    They can't, while a rotation by rotate_db_key is unfinished, and after it,
+    until the configured db_encryption_key has been replaced by the new key.
+    Then the record of the finished rotation is cleared.
+    :param db:  Open DB handle
+    :return:    True if no rotation is pending
+    """
+    global ps_select_rotation, ps_update_rotation
+
+    if not ps_select_rotation:
+        ps_select_rotation = db.prepare(q_select_rotation)
+    if not ps_update_rotation:
+        ps_update_rotation = db.prepare(q_update_rotation)
+
+    (rotated_until, rotation_key_hash) = ps_select_rotation.first()
+    if not rotation_key_hash:
+        return True
+    if rotated_until is not None:
+        sle('Unfinished DB key rotation found (up to CKS {}). '
+            'Resume it with --rotate-db-key first.'.format(rotated_until))
+        return False
+    if not DB_Encryption.key or hashlib.sha256(DB_Encryption.key).hexdigest() != rotation_key_hash:
+        sle('Keys in DB have been re-encrypted with a new DB encryption key. '
+            'Replace {} by it first.'.format(Pathes.db_encryption_key))
+        return False
+    with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+        ps_update_rotation(None, None)
+    sli('DB key rotation completed, new DB encryption key in use.')
+    return True
+
+
+def recrypt_all_keys(db: db_conn,
+                     old_password: Optional[bytes],
+                     new_password: Optional[bytes],
+                     start_after: int = 0,
+                     chunk_size: int = 64,
+                     on_chunk: Optional[Callable[[int], None]] = None) -> bool:
+    """
+    Re-encrypt all keys in DB (except those of CA certs) from old_password to new_password.
+    Keys are read in chunks of chunk_size per worker, ordered by row_id,
+    decrypted and encrypted by a process pool across all cores and written back
+    with one batch per chunk in its own transaction.
+    Keys which are already encrypted with new_password (or unencrypted if new_password is None)
+    are skipped. Therefore an interrupted run may be resumed by repeating it.
+    :param db:              Open DB handle
+    :param old_password:    Current password of keys or None if keys are not encrypted
+    :param new_password:    New password of keys or None to decrypt them
+    :param start_after:     Start with keys with row_id greater than this
+    :param chunk_size:      Number of keys per worker and chunk
+    :param on_chunk:        Called with row_id of last key of each chunk inside the transaction,
+                            which writes the chunk (used to record progress).
+                            Not called any more, after a key could not be re-encrypted.
+    :return:                True if all keys could be re-encrypted
+    """
+    global ps_select_keys_chunk, ps_count_keys, ps_update_key
+
+    if not ps_select_keys_chunk:
+        ps_select_keys_chunk = db.prepare(q_select_keys_chunk)
+    if not ps_count_keys:
+        ps_count_keys = db.prepare(q_count_keys)
+    if not ps_update_key:
+        ps_update_key = db.prepare(q_update_key)
+
+    workers = os.cpu_count()
+    total = ps_count_keys.first(start_after)
+    sli('Re-encrypting {} keys with {} processes'.format(total, workers))
+
+    done = 0
+    updated = 0
+    failed = 0
+    last_id = start_after
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            with db.xact():
+                rows = [(row['id'], row['key']) for row in ps_select_keys_chunk(last_id, chunk_size * workers)]
+            if not rows:
+                break
+            chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+            results = []
+            for (recrypted, errors) in executor.map(_recrypt_keys,
+                                                    chunks,
+                                                    [old_password] * len(chunks),
+                                                    [new_password] * len(chunks)):
+                results.extend(recrypted)
+                for (row_id, error) in errors:
+                    sle("Couldn't re-encrypt key of CKS {}, because {}".format(row_id, error))
+                    failed += 1
+            last_id = rows[-1][0]
+            record_progress = on_chunk and not failed
+            if results or record_progress:
+                with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+                    if results:
+                        ps_update_key.load_rows(results)
+                    if record_progress:
+                        on_chunk(last_id)
+            done += len(rows)
+            updated += len(results)
+            sli('Re-encrypted {} of {} keys ({} changed), last row_id {}, {:.1f} seconds'.format(
+                done, total, updated, last_id, time.monotonic() - start))
+
+    CertKeyStore.clear_key_cache()
+    if failed:
+        sle('{} keys could not be re-encrypted'.format(failed))
+        return False
+    return True
+
+
+def _recrypt_keys(rows: List[Tuple[int, bytes]],
+                  old_password: Optional[bytes],
+                  new_password: Optional[bytes]) -> Tuple[List[Tuple[int, bytes]], List[Tuple[int, str]]]:
+    """
+    Re-encrypt a chunk of keys in a process of recrypt_all_keys
+    :param rows:            list of tuples (row_id, key in PEM format)
+    :param old_password:    Current password of keys or None if keys are not encrypted
+    :param new_password:    New password of keys or None to decrypt them
+    :return:                Tuple of list of tuples (row_id, re-encrypted key) of changed keys and
+                            list of tuples (row_id, error message) of keys, which could not be re-encrypted
+    """
+    recrypted = []
+    errors = []
+    for (row_id, key_pem) in rows:
+        if not key_pem:
+            continue
+        key_pem = bytes(key_pem)
+        is_encrypted = b'ENCRYPTED' in key_pem
+        if not is_encrypted and not new_password:
+            continue                        # already decrypted
+        try:
+            key = load_pem_private_key(key_pem,
+                                       password=old_password if is_encrypted else None,
+                                       backend=default_backend())
+        except (TypeError, ValueError) as e:
+            if is_encrypted and new_password and new_password != old_password:
+                try:                            # already re-encrypted?
+                    load_pem_private_key(key_pem, password=new_password, backend=default_backend())
+                    continue
+                except (TypeError, ValueError):
+                    pass
+            errors.append((row_id, str(e)))
+            continue
+        encryption = BestAvailableEncryption(new_password) if new_password else NoEncryption()
+        recrypted.append((row_id, key.private_bytes(Encoding.PEM, PrivateFormat.TraditionalOpenSSL, encryption)))
+    return (recrypted, errors)
@@ -23,24 +23,34 @@ along with serverPKI.  If not, see <http://www.gnu.org/licenses/>.
 # Certificate distribution module.
 
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
 import sys
 from io import StringIO
+from threading import Lock
 from pathlib import PurePath, Path
 from os.path import expanduser
 from os import chdir
 from socket import timeout
-from typing import Union, List, Dict, Optional, Tuple
+import time
+from typing import Union, List, Dict, Optional, Set, Tuple
 
-from dns import rdatatype
+from dns import rdata, rdataclass, rdatatype
+from dns import flags as dns_flags
+from dns import message as dns_message
+from dns.exception import TooBig
 from dns import query as dns_query
+from dns import rcode as dns_rcode
 
-from paramiko import SSHClient, HostKeys, AutoAddPolicy
+from paramiko import SSHClient, SFTPClient, HostKeys, AutoAddPolicy
 from postgresql import driver as db_conn
 
 from serverPKI.cert import Certificate, CertInstance, EncAlgoCKS, CertState, CertType, PlaceCertFileType, SubjectType
+from serverPKI.cert import UnitOfWork
 from serverPKI.utils import get_options
 from serverPKI.utils import sld, sli, sln, sle,  Pathes, Misc
-from serverPKI.utils import updateSOAofUpdatedZones, ddns_update
+from serverPKI.utils import updateSOAofUpdatedZones, updateZoneCache, ddns_update
 
 
 class MyException(Exception):
@@ -57,24 +67,24 @@ def export_instance(db: db_conn) -> bool:
 
     name = Certificate.fqdn_from_instance_serial(db, opts.cert_serial)
     cert_meta = Certificate.create_or_load_cert_meta(db, name)
-    for ci in cert_meta.cert_instances:
-        if ci.row_id == opts.cert_serial:
-            for cks in ci.cksd.values():
-                algo = cks.algo
-                cert = cks.cert
-                key = cks.key
-
-                cert_path = Path(Pathes.work) / 'cert-{}-{}.pem'.format(opts.cert_serial, algo)
-                with open(str(cert_path), 'w') as fde:
-                    fde.write(cert)
-
-                key_path = Path(Pathes.work) / 'key-{}-{}.pem'.format(opts.cert_serial, algo)
-                with open(str(key_path), 'w') as fde:
-                    fde.write(key)
-                    key_path.chmod(0o400)
+    ci = cert_meta.instance_from_row_id(opts.cert_serial)
+    if ci:
+        for cks in ci.cksd.values():
+            algo = cks.algo
+            cert = cks.cert
+            key = cks.key
+
+            cert_path = Path(Pathes.work) / 'cert-{}-{}.pem'.format(opts.cert_serial, algo)
+            with open(str(cert_path), 'w') as fde:
+                fde.write(cert)
+
+            key_path = Path(Pathes.work) / 'key-{}-{}.pem'.format(opts.cert_serial, algo)
+            with open(str(key_path), 'w') as fde:
+                fde.write(key)
+                key_path.chmod(0o400)
     
-                sli('Cert and {} key for {} exported to {} and {}'.
-                                format(algo, cert_meta.name, str(cert_path), str(key_path)))
+            sli('Cert and {} key for {} exported to {} and {}'.
+                            format(algo, cert_meta.name, str(cert_path), str(key_path)))
     return True
 
 
@@ -115,13 +125,17 @@ def consolidate_cert(cert_meta: Certificate):
 
 def deployCerts(cert_metas: Dict[str, Certificate],
                 cert_instances: Optional[Tuple[CertInstance]] = None,
-                allowed_states: Tuple[CertState]=(CertState('issued'),)) -> bool:
+                allowed_states: Tuple[CertState]=(CertState('issued'),),
+                planned_states: Optional[Dict[CertInstance, CertState]] = None) -> bool:
     """
     Deploy a list of (certificates. keys and TLSA RRs, using paramiko/sftp) and dyn DNS (or zone files).
     Restart service at target host and reload nameserver (if using zone files).
+    All files bound for one disthost are collected first and then pushed in order by one worker.
+    With --parallel, up to opts.parallel disthosts are served concurrently.
     :param cert_metas: Dict of cert metas, telling which certs to deploy, key is cert subject name
-    :param cert_instances: Optional list of CertInstance instances
+    :param cert_instances: Optional list of CertInstance instances, each of one of the cert metas
     :param allowed_states: States describing CertInstance states to act on
+    :param planned_states: Optional dict with the only state to act on per CertInstance, overriding allowed_states
     :return: True if successfully deployed certs
     """
 
@@ -139,18 +153,36 @@ def deployCerts(cert_metas: Dict[str, Certificate],
     
     sld('limit_hosts={}, only_host={}, skip_host={}'.format(
                                             limit_hosts, only_host, skip_host))
-    
+
+    # files to distribute per disthost, in order of distribution:
+    #   list of tuples (ci, file contents, dest_dir, file_name, place, jail)
+    host_transfers: Dict[str, List[tuple]] = {}
+    # cert instances to act on, after files have been distributed:
+    #   list of tuples (cert_meta, ci, TLSA hashes, host_omitted)
+    deployed_instances: List[tuple] = []
+
     for cert_meta in cert_metas.values():
          
         if len(cert_meta.disthosts) == 0: continue
 
+        if not check_disthosts(cert_meta):
+            sle('Skipping distribution of {} because of invalid disthost configuration'.format(cert_meta.name))
+            error_found = True
+            continue
+
         the_instances = []
         hashes = []
 
         ##FIXME## highly speculative!
-        insts = cert_instances if cert_instances else [y for (x,y) in cert_meta.active_instances.items()]
+        if cert_instances:
+            insts = [ci for ci in cert_instances if ci.cm is cert_meta]
+        else:
+            insts = [y for (x,y) in cert_meta.active_instances.items()]
         for ci in insts:
-            if ci.state in allowed_states:
+            if planned_states and ci in planned_states:
+                if ci.state == planned_states[ci]:
+                    the_instances.append(ci)
+            elif ci.state in allowed_states:
                 the_instances.append(ci)
 
         if len(the_instances) == 0:
@@ -190,33 +222,23 @@ def deployCerts(cert_metas: Dict[str, Certificate],
 
                     sld('{}: {}'.format(cert_meta.name, fqdn))
 
-                    for jail in ( dh['jails'].keys() or ('',) ):   # jail is empty if no jails
+                    transfers = host_transfers.setdefault(fqdn, [])
 
-                        if '/' in jail:
-                            sle('"/" in jail name "{}" not allowed with subject {}.'.format(jail, cert_meta.name))
-                            error_found = True
-                            return False
+                    for jail in ( dh.jails.keys() or ('',) ):   # jail is empty if no jails
 
-                        jailroot = dh['jailroot'] if jail != '' else '' # may also be empty
+                        jailroot = dh.jailroot if jail != '' else '' # may also be empty
                         dest_path = PurePath('/', jailroot, jail)
                         sld('{}: {}: {}'.format(cert_meta.name, fqdn, dest_path))
 
-                        the_jail = dh['jails'][jail]
+                        the_jail = dh.jails[jail]
 
-                        if len(the_jail['places']) == 0:
-                            sle('{} subject has no place attribute.'.format(cert_meta.name))
-                            error_found = True
-                            return False
-
-                        for place in the_jail['places'].values():
+                        for place in the_jail.places.values():
 
                             sld('Handling jail "{}" and place {}'.format(jail, place.name))
 
-                            fd_key = StringIO(key_text)
-                            fd_cert = StringIO(cert_text)
-
                             key_file_name = key_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
                             cert_file_name = cert_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
+                            the_cert_text = cert_text
 
                             pcp = place.cert_path
                             if '{}' in pcp:     # we have a home directory named like the subject
@@ -230,69 +252,381 @@ def deployCerts(cert_metas: Dict[str, Certificate],
                             sld('Handling fqdn {} and dest_dir "{}" in deployCerts'.format(
                                 fqdn, dest_dir))
 
-                            try:
-
-                                if place.key_path:
-                                    key_dest_dir = PurePath(dest_path, place.key_path)
-                                    distribute_cert(fd_key, fqdn, key_dest_dir, key_file_name, place, None)
-
-                                elif place.cert_file_type == 'separate':
-                                    distribute_cert(fd_key, fqdn, dest_dir, key_file_name, place, None)
-                                    if cert_meta.cert_type == 'LE':
-                                        chain_file_name = cert_cacert_chain_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
-                                        fd_chain = StringIO(cert_text + cacert_text)
-                                        distribute_cert(fd_chain, fqdn, dest_dir, chain_file_name, place, jail)
-
-                                elif place.cert_file_type == 'combine key':
-                                    cert_file_name = key_cert_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
-                                    fd_cert = StringIO(key_text + cert_text)
-                                    if cert_meta.cert_type == 'LE':
-                                        chain_file_name = key_cert_cacert_chain_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
-                                        fd_chain = StringIO(key_text + cert_text + cacert_text)
-                                        distribute_cert(fd_chain, fqdn, dest_dir, chain_file_name, place, jail)
-
-                                elif place.cert_file_type == 'combine both':
-                                    cert_file_name = key_cert_cacert_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
-                                    fd_cert = StringIO(key_text + cert_text + cacert_text)
-
-                                elif place.cert_file_type == 'combine cacert':
-                                    cert_file_name = cert_cacert_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
-                                    fd_cert = StringIO(cert_text + cacert_text)
-                                    distribute_cert(fd_key, fqdn, dest_dir, key_file_name, place, None)
-
-                                # this may be redundant in case of LE, where the cert was in chained file
-                                distribute_cert(fd_cert, fqdn, dest_dir, cert_file_name, place, jail)
-
-                            except IOError:         # distribute_cert may error out
-                                error_found = True
-                                break               # no cert - no TLSA
-            
+                            if place.key_path:
+                                key_dest_dir = PurePath(dest_path, place.key_path)
+                                transfers.append((ci, key_text, key_dest_dir, key_file_name, place, None))
+
+                            elif place.cert_file_type == 'separate':
+                                transfers.append((ci, key_text, dest_dir, key_file_name, place, None))
+                                if cert_meta.cert_type == 'LE':
+                                    chain_file_name = cert_cacert_chain_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
+                                    transfers.append((ci, cert_text + cacert_text, dest_dir, chain_file_name, place, jail))
+
+                            elif place.cert_file_type == 'combine key':
+                                cert_file_name = key_cert_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
+                                the_cert_text = key_text + cert_text
+                                if cert_meta.cert_type == 'LE':
+                                    chain_file_name = key_cert_cacert_chain_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
+                                    transfers.append((ci, key_text + cert_text + cacert_text, dest_dir, chain_file_name, place, jail))
+
+                            elif place.cert_file_type == 'combine both':
+                                cert_file_name = key_cert_cacert_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
+                                the_cert_text = key_text + cert_text + cacert_text
+
+                            elif place.cert_file_type == 'combine cacert':
+                                cert_file_name = cert_cacert_name(cert_meta.name, cert_meta.subject_type, encryption_algo)
+                                the_cert_text = cert_text + cacert_text
+                                transfers.append((ci, key_text, dest_dir, key_file_name, place, None))
+
+                            # this may be redundant in case of LE, where the cert was in chained file
+                            transfers.append((ci, the_cert_text, dest_dir, cert_file_name, place, jail))
+
+            deployed_instances.append((cert_meta, ci, list(hashes), host_omitted))
+
+    failed_instances = _distribute_to_hosts(host_transfers, opts.parallel if opts.parallel else 1)
+
+    if deployed_instances:
+        to_be_promoted = []
+        for (cert_meta, ci, hashes, host_omitted) in deployed_instances:
+
             sli('')
 
+            if ci in failed_instances:  # distribute_cert errored out
+                error_found = True
+                sle('Distribution of {}:{} failed. Skipping TLSA and state transition.'.format(
+                    cert_meta.name, ci.row_id))
+                continue                # no cert - no TLSA
+
             if opts.sync_disk:      # skip TLSA stuff if doing consolidate
                 continue
 
             if not opts.no_TLSA:
                 distribute_tlsa_rrs(cert_meta, hashes)
+            to_be_promoted.append((cert_meta, ci, host_omitted))
+
+        TLSAUpdates.flush()         # one DNS update per zone for all certs
+
+        with UnitOfWork(deployed_instances[0][0].db):      # state transitions are written at once
+            for (cert_meta, ci, host_omitted) in to_be_promoted:
+
+                if not opts.no_TLSA and TLSAUpdates.failed(cert_meta):
+                    error_found = True
+                    sle('DNS update of TLSA RRs of {}:{} failed. Skipping state transition.'.format(
+                        cert_meta.name, ci.row_id))
+                    continue
+
+                if not host_omitted and not cert_meta.subject_type == 'CA':
+                    ci.state = CertState('deployed')
+                    cert_meta.save_instance(ci)
+                else:
+                    sln('State of cert {} not promoted to DEPLOYED, '
+                        'because hosts where limited or skipped'.format(
+                                    cert_meta.name))
+                # clear mail-sent-time if local cert.
+                if cert_meta.cert_type == CertType('local'): cert_meta.update_authorized_until(None)
 
-            if not host_omitted and not cert_meta.subject_type == 'CA':
-                ci.state = CertState('deployed')
-                cert_meta.save_instance(ci)
-            else:
-                sln('State of cert {} not promoted to DEPLOYED, '
-                    'because hosts where limited or skipped'.format(
-                                cert_meta.name))
-            # clear mail-sent-time if local cert.
-            if cert_meta.cert_type == CertType('local'): cert_meta.update_authorized_until(None)
-        
-    updateSOAofUpdatedZones()
     return not error_found
 
 
+def check_disthosts(cert_meta: Certificate) -> bool:
+    """
+    Check jails and places of the disthosts of a cert meta, which are not excluded
+    by --only-host or --skip-host.
+    :param cert_meta: cert meta
+    :return: True if the cert can be distributed to all its disthosts
+    """
+    opts = get_options()
+    only_host = opts.only_host if opts.only_host else []
+    skip_host = opts.skip_host if opts.skip_host else []
+
+    result = True
+    for fqdn, dh in cert_meta.disthosts.items():
+        if fqdn in skip_host or (only_host and fqdn not in only_host):
+            continue
+        for jail in (dh.jails.keys() or ('',)):
+            if '/' in jail:
+                sle('"/" in jail name "{}" not allowed with subject {}.'.format(jail, cert_meta.name))
+                result = False
+            elif len(dh.jails[jail].places) == 0:
+                sle('{} subject has no place attribute.'.format(cert_meta.name))
+                result = False
+    return result
+
+
+def _distribute_to_hosts(host_transfers: Dict[str, List[tuple]], workers: int) -> Set[CertInstance]:
+    """
+    Distribute collected files to their disthosts.
+    Files of one disthost are distributed in order by one worker.
+    :param host_transfers: Dict with fqdn of disthost as key and list of transfer tuples
+                            (ci, file contents, dest_dir, file_name, place, jail) as value
+    :param workers: Number of disthosts to serve concurrently
+    :return: Set of CertInstances, whose files could not be distributed
+    """
+    failed_instances = set()
+
+    if workers > 1 and len(host_transfers) > 1:
+        sli('Distributing to {} disthosts with {} workers'.format(len(host_transfers), workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_distribute_to_host, dest_host, transfers)
+                       for dest_host, transfers in host_transfers.items()]
+            for future in futures:
+                failed_instances |= future.result()
+    else:
+        for dest_host, transfers in host_transfers.items():
+            failed_instances |= _distribute_to_host(dest_host, transfers)
+
+    return failed_instances
+
+
+def _distribute_to_host(dest_host: str, transfers: List[tuple]) -> Set[CertInstance]:
+    """
+    Distribute all files bound for one disthost in order of transfers.
+    After a failure, remaining files of the same CertInstance are skipped.
+    Reload commands of places are collected per jail and executed once
+    after all files have been distributed to the disthost.
+    A reload command is skipped, if files of any CertInstance needing it failed.
+    Any other error (e.g. ssh authentication or host key) fails all CertInstances
+    of the disthost, without affecting other disthosts.
+    :param dest_host: fqdn of disthost
+    :param transfers: List of tuples (ci, file contents, dest_dir, file_name, place, jail)
+    :return: Set of CertInstances, whose files could not be distributed
+    """
+    failed_instances = set()
+    reloads: Dict[Tuple[str, str], Set[CertInstance]] = {}     # key is (jail, command)
+
+    try:
+        for (ci, text, dest_dir, file_name, place, jail) in transfers:
+            if ci in failed_instances:
+                continue
+            try:
+                distribute_cert(StringIO(text), dest_host, dest_dir, file_name, place)
+            except IOError:         # distribute_cert may error out
+                failed_instances.add(ci)
+                continue
+            cmd = reload_command(place, jail)
+            if cmd:
+                reloads.setdefault((jail, cmd), set()).add(ci)
+
+        for (jail, cmd), instances in reloads.items():
+            if instances & failed_instances:
+                sln('Not executing "{}" on host {}, because distribution of files failed'.format(cmd, dest_host))
+                continue
+            remote_execute(dest_host, cmd)
+
+    except Exception:
+        sle('Distribution to host {} failed because {} [{}]'.format(
+            dest_host,
+            sys.exc_info()[0].__name__,
+            str(sys.exc_info()[1])))
+        failed_instances |= {transfer[0] for transfer in transfers}
+
+    return failed_instances
+
+
+class SSHConnectionPool(object):
+    """
+    Per run pool of ssh connections to disthosts.
+    Holds one authenticated transport and one sftp session per disthost,
+    which are reused for all files and certs distributed to that host.
+    Must be closed with close_all() at end of run.
+    """
+    host_keys: Optional[HostKeys] = None
+    clients: Dict[str, SSHClient] = {}
+    sftp_sessions: Dict[str, SFTPClient] = {}
+    lock = Lock()
+
+    @staticmethod
+    def client(dest_host: str) -> SSHClient:
+        """
+        Return the connected ssh client of a disthost, connecting if necessary
+        :param dest_host: fqdn of target host
+        :return: paramiko.SSHClient (connected transport)
+        :exceptions: If unable to connect
+        """
+        with SSHConnectionPool.lock:
+            client = SSHConnectionPool.clients.get(dest_host)
+        if client:
+            transport = client.get_transport()
+            if transport and transport.is_active():
+                return client
+            sln('Connection to host {} lost - reconnecting'.format(dest_host))
+            SSHConnectionPool.close(dest_host)
+
+        client = ssh_connection(dest_host)
+        with SSHConnectionPool.lock:
+            SSHConnectionPool.clients[dest_host] = client
+        return client
+
+    @staticmethod
+    def sftp(dest_host: str) -> SFTPClient:
+        """
+        Return the sftp session of a disthost, opening it if necessary
+        :param dest_host: fqdn of target host
+        :return: paramiko.SFTPClient
+        :exceptions: If unable to connect
+        """
+        client = SSHConnectionPool.client(dest_host)
+        with SSHConnectionPool.lock:
+            sftp = SSHConnectionPool.sftp_sessions.get(dest_host)
+        if sftp and sftp.get_channel() and not sftp.get_channel().closed:
+            return sftp
+
+        sftp = client.open_sftp()
+        with SSHConnectionPool.lock:
+            SSHConnectionPool.sftp_sessions[dest_host] = sftp
+        return sftp
+
+    @staticmethod
+    def close(dest_host: str) -> None:
+        """
+        Close sftp session and ssh connection of one disthost
+        :param dest_host: fqdn of target host
+        :return:
+        """
+        with SSHConnectionPool.lock:
+            sftp = SSHConnectionPool.sftp_sessions.pop(dest_host, None)
+            client = SSHConnectionPool.clients.pop(dest_host, None)
+        if sftp:
+            sftp.close()
+        if client:
+            client.close()
+            sld('Closed connection to host {}'.format(dest_host))
+
+    @staticmethod
+    def close_all() -> None:
+        """
+        Close all sftp sessions and ssh connections of this run
+        :return:
+        """
+        with SSHConnectionPool.lock:
+            dest_hosts = list(SSHConnectionPool.clients.keys())
+        for dest_host in dest_hosts:
+            SSHConnectionPool.close(dest_host)
+
+
+class TLSAUpdates(object):
+    """
+    Per run accumulator of updates of TLSA RRs.
+    distribute_tlsa_rrs and delete_TLSA queue their changes per zone.
+    With ddns, flush() reduces them to the difference against the TLSA RRs served by
+    the local DNS master and sends them as one TSIG signed update per zone
+    (more only, if the update would exceed the maximum DNS message size).
+    With zone files, flush() writes the changed TLSA include files of all zones
+    and updates the SOA of those zones only.
+    Zones without differences are not updated at all.
+    Zones, whose update failed, are remembered for the rest of the run.
+    """
+    max_message_size = 65535
+    zones: Dict[str, List[Tuple[str, Optional[int], int, List[str]]]] = {}
+    files: Dict[str, Dict[str, str]] = {}        # zone -> fqdn -> contents of TLSA include file
+    failed_zones: Set[str] = set()
+    lock = Lock()
+
+    @staticmethod
+    def replace(zone: str, owner: str, ttl: int, rdtype: int, rdatas: List[str]) -> None:
+        """
+        Queue replacement of all RRs of rdtype of owner by rdatas
+        :param zone: name of zone
+        :param owner: owner name of RRs
+        :param ttl: ttl of new RRs
+        :param rdtype: rdatatype of RRs
+        :param rdatas: list of rdatas as text
+        :return:
+        """
+        with TLSAUpdates.lock:
+            TLSAUpdates.zones.setdefault(zone, []).append((owner, rdtype, ttl, rdatas))
+
+    @staticmethod
+    def delete(zone: str, owner: str) -> None:
+        """
+        Queue deletion of all RRs of owner
+        :param zone: name of zone
+        :param owner: owner name of RRs
+        :return:
+        """
+        with TLSAUpdates.lock:
+            TLSAUpdates.zones.setdefault(zone, []).append((owner, None, 0, []))
+
+    @staticmethod
+    def write(zone: str, fqdn: str, text: str) -> None:
+        """
+        Queue writing of the TLSA include file of fqdn (zone_file mode)
+        :param zone: name of zone
+        :param fqdn: fqdn of TLSA RRs
+        :param text: contents of file, empty to remove all TLSA RRs of fqdn
+        :return:
+        """
+        with TLSAUpdates.lock:
+            TLSAUpdates.files.setdefault(zone, {})[fqdn] = text
+
+    @staticmethod
+    def flush() -> Set[str]:
+        """
+        Send all queued changes, one update per zone
+        :return: Set of zones, whose update failed during this run
+        """
+        with TLSAUpdates.lock:
+            zones = TLSAUpdates.zones
+            files = TLSAUpdates.files
+            TLSAUpdates.zones = {}
+            TLSAUpdates.files = {}
+
+        for zone, texts in files.items():
+            start = time.monotonic()
+            try:
+                written = [fqdn for fqdn, text in texts.items()
+                           if _write_if_changed(Pathes.zone_file_root / zone / (fqdn + '.tlsa'), text)]
+            except OSError as e:
+                sle('Writing TLSA include files of zone {} failed [{}]'.format(zone, str(e)))
+                with TLSAUpdates.lock:
+                    TLSAUpdates.failed_zones.add(zone)
+                continue
+            if not written:
+                sli('TLSA include files of zone {} are up to date'.format(zone))
+                continue
+            updateZoneCache(zone)
+            sli('Writing {} of {} TLSA include files of zone {} took {:.3f} seconds'.format(
+                len(written), len(texts), zone, time.monotonic() - start))
+        updateSOAofUpdatedZones()
+
+        for zone, changes in zones.items():
+            start = time.monotonic()
+            try:
+                changes = _reconcile_tlsa(changes)
+                if not changes:
+                    sli('TLSA RRs in zone {} are up to date'.format(zone))
+                    continue
+                messages = _send_tlsa_update(zone, changes)
+            except Exception as e:
+                sle('DNS update of TLSA RRs in zone {} failed [{}]'.format(zone, str(e)))
+                with TLSAUpdates.lock:
+                    TLSAUpdates.failed_zones.add(zone)
+                continue
+            sli('DNS update of {} TLSA RRsets in zone {} with {} message(s) took {:.3f} seconds'.format(
+                len(changes), zone, messages, time.monotonic() - start))
+
+        with TLSAUpdates.lock:
+            return set(TLSAUpdates.failed_zones)
+
+    @staticmethod
+    def failed(cert_meta: Certificate) -> bool:
+        """
+        Tell, if any update of a zone with TLSA RRs of a cert meta failed during this run
+        :param cert_meta: cert meta
+        :return: True if TLSA RRs of cert_meta may be missing or outdated
+        """
+        with TLSAUpdates.lock:
+            if not TLSAUpdates.failed_zones:
+                return False
+            return any(zone in TLSAUpdates.failed_zones
+                       for (zone, fqdn) in cert_meta.zone_and_FQDN_from_altnames())
+
+
 def ssh_connection(dest_host):
 
     """
     Open a ssh connection.
+    known_hosts is read only once per run.
     
     @param dest_host:   fqdn of target host
     @type dest_host:    string
@@ -301,8 +635,13 @@ def ssh_connection(dest_host):
     If unable to connect
     """
 
+    with SSHConnectionPool.lock:
+        if SSHConnectionPool.host_keys is None:
+            SSHConnectionPool.host_keys = HostKeys(expanduser('~/.ssh/known_hosts'))
+        host_keys = SSHConnectionPool.host_keys
+
     client = SSHClient()
-    client.load_host_keys(expanduser('~/.ssh/known_hosts'))
+    client.get_host_keys().update(host_keys)
     sld('Connecting to {}'.format(dest_host))
     try:
          client.connect(dest_host, username=Misc.SSH_CLIENT_USER_NAME)
@@ -311,16 +650,17 @@ def ssh_connection(dest_host):
             format(dest_host,
                    sys.exc_info()[0].__name__,
                    str(sys.exc_info()[1])))
+        client.close()
         raise
     else:
         sld('Connected to host {}'.format(dest_host))
         return client
     
-def distribute_cert(fd, dest_host, dest_dir, file_name, place, jail):
+def distribute_cert(fd, dest_host, dest_dir, file_name, place):
 
     """
     Distribute cert and key to a host, jail (if any) and place.
-    Optional reload the service.
+    Reloading the service is left to the caller (see reload_command and remote_execute).
     If global opts.extract set, instead of distributing to a host,
     certificat and key are written to the local work directory.
     
@@ -334,107 +674,130 @@ def distribute_cert(fd, dest_host, dest_dir, file_name, place, jail):
     @type file_name:    string
     @param place:       place with details about setting mode and uid/gid of file
     @type place:        serverPKI.cert.Place instance
-    @param jail:        name of jail for service to reload
-    @type jail:         string or None
     @rtype:             not yet any
     @exceptions:        IOError
     """
 
     sld('Handling dest_host {} and dest_dir "{}" in distribute_cert'.format(
                                                         dest_host, dest_dir))
-    with ssh_connection(dest_host) as client:
-        
-        with client.open_sftp() as sftp:
+    sftp = SSHConnectionPool.sftp(dest_host)
+
+    try:
+        sftp.chdir(str(dest_dir))
+    except IOError:
+        sln('{}:{} does not exist - creating\n\t{}'.format(
+                    dest_host, dest_dir, sys.exc_info()[0].__name__))
+        try:
+            sftp.mkdir(str(dest_dir))   
+        except IOError:
+            sle('Cant create {}:{}: Missing parent?\n\t{}'.format(
+                    dest_host,
+                    dest_dir,
+                    sys.exc_info()[0].__name__,
+                    str(sys.exc_info()[1])))
+            raise
+        sftp.chdir(str(dest_dir))
+    
+    sli('{} => {}:{}'.format(file_name, dest_host, dest_dir))
+    fat = sftp.putfo(fd, file_name, confirm=True)
+    sld('size={}, uid={}, gid={}, mtime={}'.format(
+                fat.st_size, fat.st_uid, fat.st_gid, fat.st_mtime))
+
+    if 'key' in file_name:
+        sld('Setting mode to 0o400 of {}:{}/{}'.format(
+                            dest_host, dest_dir, file_name))
+        mode = 0o400
+        if place.mode:
+            mode = place.mode
+            sld('Setting mode of key at target to {}'.format(oct(place.mode)))
+        sftp.chmod(file_name, mode)
+        if place.pgLink:
             try:
-                sftp.chdir(str(dest_dir))
+                sftp.unlink('postgresql.key')
             except IOError:
-                sln('{}:{} does not exist - creating\n\t{}'.format(
-                            dest_host, dest_dir, sys.exc_info()[0].__name__))
+                pass            # none exists: ignore
+            sftp.symlink(file_name, 'postgresql.key')
+            sld('{} => postgresql.key'.format(file_name))
+         
+    if 'key' in file_name or place.chownBoth:
+        uid = gid = 0
+        if place.uid: uid = place.uid
+        if place.gid: gid = place.gid
+        if uid != 0 or gid != 0:
+            sld('Setting uid/gid to {}:{} of {}:{}/{}'.format(
+                            uid, gid, dest_host, dest_dir, file_name))
+            sftp.chown(file_name, uid, gid)
+    elif place.pgLink:
+        try:
+            sftp.unlink('postgresql.crt')
+        except IOError:
+            pass            # none exists: ignore
+        sftp.symlink(file_name, 'postgresql.crt')
+        sld('{} => postgresql.crt'.format(file_name))
+
+
+def reload_command(place, jail) -> Optional[str]:
+    """
+    Return the command to reload the service of a place in a jail.
+
+    @param place:       place with reload command
+    @type place:        serverPKI.cert.Place instance
+    @param jail:        name of jail for service to reload
+    @type jail:         string or None
+    @rtype:             command as string or None if no reload required
+    """
+    if not (jail and place.reload_command):
+        return None
+    try:
+        cmd = str((place.reload_command).format(jail))
+    except:             #No "{}" in reload command: means no jail
+        cmd = place.reload_command
+    return cmd
+
+
+def remote_execute(dest_host, cmd):
+    """
+    Execute a command on a host, using the pooled connection to it.
+
+    @param dest_host:   fqdn of target host
+    @type dest_host:    string
+    @param cmd:         command to execute
+    @type cmd:          string
+    @rtype:             None
+    """
+    client = SSHConnectionPool.client(dest_host)
+    sli('Executing "{}" on host {}'.format(cmd, dest_host))
+
+    with client.get_transport().open_session() as chan:
+        chan.settimeout(10.0)
+        chan.set_combine_stderr(True)
+        chan.exec_command(cmd)
+        
+        remote_result_msg = ''
+        timed_out = False
+        while not chan.exit_status_ready():
+             if timed_out: break
+             if chan.recv_ready():
                 try:
-                    sftp.mkdir(str(dest_dir))   
-                except IOError:
-                    sle('Cant create {}:{}: Missing parent?\n\t{}'.format(
-                            dest_host,
-                            dest_dir,
-                            sys.exc_info()[0].__name__,
-                            str(sys.exc_info()[1])))
-                    raise
-                sftp.chdir(str(dest_dir))
-            
-            sli('{} => {}:{}'.format(file_name, dest_host, dest_dir))
-            fat = sftp.putfo(fd, file_name, confirm=True)
-            sld('size={}, uid={}, gid={}, mtime={}'.format(
-                        fat.st_size, fat.st_uid, fat.st_gid, fat.st_mtime))
-
-            if 'key' in file_name:
-                sld('Setting mode to 0o400 of {}:{}/{}'.format(
-                                    dest_host, dest_dir, file_name))
-                mode = 0o400
-                if place.mode:
-                    mode = place.mode
-                    sld('Setting mode of key at target to {}'.format(oct(place.mode)))
-                sftp.chmod(file_name, mode)
-                if place.pgLink:
+                    data = chan.recv(1024)
+                except (timeout):
+                    sle('Timeout on remote execution of "{}" on host {}'.format(cmd, dest_host))
+                    break
+                while data:
+                    remote_result_msg += (data.decode('ascii'))
                     try:
-                        sftp.unlink('postgresql.key')
-                    except IOError:
-                        pass            # none exists: ignore
-                    sftp.symlink(file_name, 'postgresql.key')
-                    sld('{} => postgresql.key'.format(file_name))
-                 
-            if 'key' in file_name or place.chownBoth:
-                uid = gid = 0
-                if place.uid: uid = place.uid
-                if place.gid: gid = place.gid
-                if uid != 0 or gid != 0:
-                    sld('Setting uid/gid to {}:{} of {}:{}/{}'.format(
-                                    uid, gid, dest_host, dest_dir, file_name))
-                    sftp.chown(file_name, uid, gid)
-            elif place.pgLink:
-                try:
-                    sftp.unlink('postgresql.crt')
-                except IOError:
-                    pass            # none exists: ignore
-                sftp.symlink(file_name, 'postgresql.crt')
-                sld('{} => postgresql.crt'.format(file_name))
-        
-        if jail and place.reload_command:
-            try:
-                cmd = str((place.reload_command).format(jail))
-            except:             #No "{}" in reload command: means no jail
-                cmd = place.reload_command
-            sli('Executing "{}" on host {}'.format(cmd, dest_host))
-
-            with client.get_transport().open_session() as chan:
-                chan.settimeout(10.0)
-                chan.set_combine_stderr(True)
-                chan.exec_command(cmd)
-                
-                remote_result_msg = ''
-                timed_out = False
-                while not chan.exit_status_ready():
-                     if timed_out: break
-                     if chan.recv_ready():
-                        try:
-                            data = chan.recv(1024)
-                        except (timeout):
-                            sle('Timeout on remote execution of "{}" on host {}'.format(cmd, dest_host))
-                            break
-                        while data:
-                            remote_result_msg += (data.decode('ascii'))
-                            try:
-                                data = chan.recv(1024)
-                            except (timeout):
-                                sle('Timeout on remote execution of "{}" on host {}'.format(cmd, dest_host))
-                                tmp = timed_out
-                                timed_out = True
-                                break
-                es = int(chan.recv_exit_status())
-                if es != 0:
-                    sln('Remote execution failure of "{}" on host {}\texit={}, because:\n\r{}'
-                            .format(cmd, dest_host, es, remote_result_msg))
-                else:
-                    sli(remote_result_msg)
+                        data = chan.recv(1024)
+                    except (timeout):
+                        sle('Timeout on remote execution of "{}" on host {}'.format(cmd, dest_host))
+                        tmp = timed_out
+                        timed_out = True
+                        break
+        es = int(chan.recv_exit_status())
+        if es != 0:
+            sln('Remote execution failure of "{}" on host {}\texit={}, because:\n\r{}'
+                    .format(cmd, dest_host, es, remote_result_msg))
+        else:
+            sli(remote_result_msg)
 
 
 def key_name(subject, subject_type, encryption_algo):
@@ -495,9 +858,9 @@ def consolidate_TLSA(cert_meta):
     
     prepublished_TLSA = {}
     if prepublished_ci:
-        prepublished_TLSA = cert_meta.TLSA_hash(prepublished_ci)
+        prepublished_TLSA = cert_meta.TLSA_hashes(prepublished_ci)
     
-    deployed_TLSA = cert_meta.TLSA_hash(deployed_ci)
+    deployed_TLSA = cert_meta.TLSA_hashes(deployed_ci)
 
     distribute_tlsa_rrs(cert_meta, tuple(deployed_TLSA.values()) + tuple(prepublished_TLSA.values()))
 
@@ -514,37 +877,17 @@ def delete_TLSA(cert_meta: Certificate) -> None:
         if Misc.LE_ZONE_UPDATE_METHOD == 'zone_file':
 
             for (zone, fqdn) in cert_meta.zone_and_FQDN_from_altnames():
-                filename = fqdn + '.tlsa'
-                dest = str(Pathes.zone_file_root / zone / filename)
-    
-                #just open for write without writing, which makes file empty 
-                with open(dest, 'w') as fd: 
-                    sli('Truncating {}'.format(dest))
-                updateZoneCache(zone)
+                sli('Truncating {}.tlsa'.format(fqdn))
+                TLSAUpdates.write(zone, fqdn, '')     # empty file removes all TLSA RRs
     
         elif Misc.LE_ZONE_UPDATE_METHOD == 'ddns':
 
-            zones = {}
             for (zone, fqdn) in cert_meta.zone_and_FQDN_from_altnames():
-                if zone in zones:
-                    if fqdn not in zones[zone]: zones[zone].append(fqdn)
-                else:
-                    zones[zone] = [fqdn] 
-            for zone in zones:
-                the_update = ddns_update(zone)
-                for fqdn in zones[zone]:
-                    for prefix in cert_meta.tlsaprefixes.keys():
-                        tag = str(prefix.format(fqdn)).split(maxsplit=1)[0]
-                        sld('Deleting TLSA with tag {} an fqdn {} in zone {}'.
-                            format(tag, fqdn, zone))
-                        the_update.delete(tag)
-                response = dns_query.tcp(the_update,'127.0.0.1', timeout=10)
-                rc = response.rcode()
-                if rc != 0:
-                    sle('DNS update failed for zone {} with rcode: {}:\n{}'.
-                                        format(zone, response.rcode.to_text(rc), response.rcode))
-                    raise Exception('DNS update failed for zone {} with rcode: {}'.
-                                        format(zone, response.rcode.to_text(rc)))
+                for prefix in cert_meta.tlsaprefixes.keys():
+                    tag = str(prefix.format(fqdn)).split(maxsplit=1)[0]
+                    sld('Deleting TLSA with tag {} an fqdn {} in zone {}'.
+                        format(tag, fqdn, zone))
+                    TLSAUpdates.delete(zone, tag)
         
 
     
@@ -566,53 +909,31 @@ def distribute_tlsa_rrs(cert_meta: Certificate, hashes: Union[Tuple[str],List[st
         
         if Misc.LE_ZONE_UPDATE_METHOD == 'zone_file':
 
-            for (zone, fqdn) in zone_and_FQDN_from_altnames(cert_meta): 
-                filename = fqdn + '.tlsa'
-                dest = str(Pathes.zone_file_root / zone / filename)
-                sli('{} => {}'.format(filename, dest))
+            for (zone, fqdn) in cert_meta.zone_and_FQDN_from_altnames():
+                sld('Queueing {}.tlsa of zone {}'.format(fqdn, zone))
                 tlsa_lines = []
                 for prefix in cert_meta.tlsaprefixes.keys():
                     for hash in hashes:
                         tlsa_lines.append(str(prefix.format(fqdn) +
                                              ' ' +hash + '\n'))
-                with open(dest, 'w') as fd:
-                    fd.writelines(tlsa_lines)
-                updateZoneCache(zone)
+                TLSAUpdates.write(zone, fqdn, ''.join(tlsa_lines))
     
         
         elif Misc.LE_ZONE_UPDATE_METHOD == 'ddns':
     
             tlsa_datatype = rdatatype.from_text('TLSA')
-            zones = {}
+            fqdns = []
             for (zone, fqdn) in cert_meta.zone_and_FQDN_from_altnames():
-                if zone in zones:
-                    if fqdn not in zones[zone]: zones[zone].append(fqdn)
-                else:
-                    zones[zone] = [fqdn] 
-            for zone in zones:
-                the_update = ddns_update(zone)
-                for fqdn in zones[zone]:
-                    for prefix in cert_meta.tlsaprefixes.keys():
-                        pf_with_fqdn = str(prefix.format(fqdn))
-                        fields = pf_with_fqdn.split(maxsplit=4)
-                        sld('Deleting possible old TLSAs: {}'.
-                            format(fields[0]))
-                        the_update.delete(fields[0], tlsa_datatype)
-                        
-                        for hash in hashes:
-                            sld('Adding TLSA: {} {} {} {}'.
-                                format(fields[0], int(fields[1]), fields[3],
-                                                fields[4] + ' ' +hash ))
-                            the_update.add(fields[0], int(fields[1]), fields[3],
-                                                fields[4] + ' ' +hash )
-
-                response = dns_query.tcp(the_update,'127.0.0.1', timeout=10)
-                rc = response.rcode()
-                if rc != 0:
-                    sle('DNS update failed for zone {} with rcode: {}:\n{}'.
-                                        format(zone, response.rcode.to_text(rc), response.rcode))
-                    raise Exception('DNS update add failed for zone {} with rcode: {}'.
-                                        format(zone, response.rcode.to_text(rc)))
+                if (zone, fqdn) not in fqdns: fqdns.append((zone, fqdn))
+            for (zone, fqdn) in fqdns:
+                for prefix in cert_meta.tlsaprefixes.keys():
+                    pf_with_fqdn = str(prefix.format(fqdn))
+                    fields = pf_with_fqdn.split(maxsplit=4)
+                    sld('Replacing TLSAs of {} by {} {} {}'.
+                        format(fields[0], int(fields[1]), fields[3], ', '.join(
+                            [fields[4] + ' ' + hash for hash in hashes])))
+                    TLSAUpdates.replace(zone, fields[0], int(fields[1]), tlsa_datatype,
+                                        [fields[4] + ' ' + hash for hash in hashes])
 
 
     else:                           # remote DNS master ( **INCOMPLETE**)
@@ -633,3 +954,138 @@ def distribute_tlsa_rrs(cert_meta: Certificate, hashes: Union[Tuple[str],List[st
                                         fat.st_size, fat.st_uid, fat.st_gid, fat.st_mtime))
 
 
+def _write_if_changed(dest: Path, text: str) -> bool:
+    """
+    Atomically replace a file by a temporary file with new contents, if contents (sha256) differ.
+    Mode and ownership of an existing file are retained, new files get zone_tlsa_inc_mode,
+    zone_tlsa_inc_uid and zone_tlsa_inc_gid.
+    :param dest: path of file
+    :param text: new contents
+    :return: True if file was written, False if it was up to date
+    :exceptions: OSError if file can't be written
+    """
+    new_contents = text.encode('ascii')
+    try:
+        with dest.open('rb') as fd:
+            if hashlib.sha256(fd.read()).digest() == hashlib.sha256(new_contents).digest():
+                sld('{} is up to date'.format(dest))
+                return False
+        st = os.stat(str(dest))
+        (mode, uid, gid) = (st.st_mode & 0o7777, st.st_uid, st.st_gid)
+    except FileNotFoundError:
+        (mode, uid, gid) = (Pathes.zone_tlsa_inc_mode, Pathes.zone_tlsa_inc_uid, Pathes.zone_tlsa_inc_gid)
+
+    tmp = dest.with_name('.' + dest.name + '.tmp')
+    with tmp.open('wb') as fd:
+        fd.write(new_contents)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.chmod(str(tmp), mode)
+    st = os.stat(str(tmp))
+    if (uid, gid) != (st.st_uid, st.st_gid):
+        try:
+            os.chown(str(tmp), uid, gid)
+        except OSError as e:
+            sln('Unable to set ownership of {} to {}:{} [{}]'.format(dest, uid, gid, str(e)))
+    os.replace(str(tmp), str(dest))
+    sli('Wrote {}'.format(dest))
+    return True
+
+
+def _reconcile_tlsa(changes: List[Tuple[str, Optional[int], int, List[str]]]) -> List[tuple]:
+    """
+    Reduce queued changes of one zone to the difference against the RRsets served by the local DNS master.
+    RRsets, which can't be queried, are replaced completely, as are RRsets, whose ttl changes.
+    :param changes: List of tuples (owner, rdtype or None to delete all RRs of owner, ttl, rdatas as text)
+    :return: List of tuples (owner, rdtype or None to delete all RRs of owner, ttl,
+                rdatas to delete or None to delete the RRset, rdatas to add)
+    """
+    known = {}          # RRsets of owners after changes so far, key is owner, value is (ttl, set of rdatas)
+    result = []
+    for (owner, rdtype, ttl, rdatas) in changes:
+        if rdtype is None:
+            result.append((owner, None, 0, None, []))
+            known[owner] = (0, set())
+            continue
+
+        expected = set([rdata.from_text(rdataclass.IN, rdtype, text) for text in rdatas])
+        current = known[owner] if owner in known else _query_rrset(owner, rdtype)
+        known[owner] = (ttl, expected)
+
+        if current is None:
+            result.append((owner, rdtype, ttl, None, list(expected)))
+            continue
+        (current_ttl, current_rdatas) = current
+        if current_rdatas and current_ttl != ttl:
+            result.append((owner, rdtype, ttl, None, list(expected)))
+        elif current_rdatas != expected:
+            result.append((owner, rdtype, ttl, list(current_rdatas - expected), list(expected - current_rdatas)))
+        else:
+            sld('TLSA RRs of {} are up to date'.format(owner))
+    return result
+
+
+def _query_rrset(owner: str, rdtype: int) -> Optional[Tuple[int, Set[rdata.Rdata]]]:
+    """
+    Query the local DNS master for an RRset
+    :param owner: owner name of RRset
+    :param rdtype: rdatatype of RRset
+    :return: Tuple of ttl and set of rdatas (empty if there is no such RRset) or None if query failed
+    """
+    query = dns_message.make_query(owner, rdtype)
+    try:
+        response = dns_query.udp(query, '127.0.0.1', timeout=10)
+        if response.flags & dns_flags.TC:
+            response = dns_query.tcp(query, '127.0.0.1', timeout=10)
+    except Exception as e:
+        sln('Query of {} RRs of {} failed [{}]'.format(rdatatype.to_text(rdtype), owner, str(e)))
+        return None
+    rc = response.rcode()
+    if rc not in (dns_rcode.NOERROR, dns_rcode.NXDOMAIN):
+        sln('Query of {} RRs of {} failed with rcode: {}'.format(
+            rdatatype.to_text(rdtype), owner, dns_rcode.to_text(rc)))
+        return None
+    for rrset in response.answer:
+        if rrset.rdtype == rdtype and rrset.name == query.question[0].name:
+            return (rrset.ttl, set(rrset))
+    return (0, set())
+
+
+def _send_tlsa_update(zone: str, changes: List[tuple]) -> int:
+    """
+    Send changes of one zone as dynamic DNS update.
+    If the update would exceed TLSAUpdates.max_message_size, changes are split in halves
+    (a single change is never split).
+    :param zone: name of zone
+    :param changes: List of tuples (owner, rdtype or None to delete all RRs of owner, ttl,
+                rdatas to delete or None to delete the RRset, rdatas to add), as returned by _reconcile_tlsa
+    :return: Number of messages sent
+    :exceptions: Exception if DNS server responds with an error
+    """
+    the_update = ddns_update(zone)
+    for (owner, rdtype, ttl, removed, added) in changes:
+        if rdtype is None:
+            the_update.delete(owner)
+            continue
+        if removed is None:
+            the_update.delete(owner, rdtype)
+        else:
+            for the_rdata in removed:
+                the_update.delete(owner, the_rdata)
+        for the_rdata in added:
+            the_update.add(owner, ttl, the_rdata)
+
+    try:
+        the_update.to_wire(max_size=TLSAUpdates.max_message_size)
+    except TooBig:
+        if len(changes) == 1:
+            raise
+        half = len(changes) // 2
+        sld('DNS update of zone {} too large, splitting {} changes'.format(zone, len(changes)))
+        return _send_tlsa_update(zone, changes[:half]) + _send_tlsa_update(zone, changes[half:])
+
+    response = dns_query.tcp(the_update, '127.0.0.1', timeout=10)
+    rc = response.rcode()
+    if rc != 0:
+        raise Exception('DNS update failed for zone {} with rcode: {}'.format(zone, dns_rcode.to_text(rc)))
+    return 1
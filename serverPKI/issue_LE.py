@@ -27,17 +27,18 @@ This module uses code from https://github.com/candango/automatoes
 # --------------- imported modules --------------
 import binascii
 import datetime
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
 import logging
 import os
 import re
+import socket
 import sys
 import time
 
+from dns import message as dns_message
 from dns import rdatatype
 from dns import query as dns_query
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.backends import default_backend
 from cryptography import x509
 
 from postgresql import driver as db_conn
@@ -62,7 +63,8 @@ from automatoes import errors as manuale_errors
 
 # --------------- local imports --------------
 from serverPKI.cacert import create_CAcert_meta
-from serverPKI.cert import Certificate, CertInstance, CertKeyStore, EncAlgo, EncAlgoCKS, CertState
+from serverPKI.cert import Certificate, CertInstance, CertKeyStore, EncAlgo, EncAlgoCKS, CertState, CertType
+from serverPKI.keypool import KeyPool
 from serverPKI.utils import sld, sli, sln, sle, Pathes, X509atts, Misc
 from serverPKI.utils import updateSOAofUpdatedZones, get_options
 from serverPKI.utils import updateZoneCache, print_order, ddns_update
@@ -72,6 +74,8 @@ from serverPKI.utils import updateZoneCache, print_order, ddns_update
 
 ##logger = logging.getLogger(__name__)  ##FIXME##
 
+logging_initialized = False
+
 # --------------- classes --------------
 
 class DBStoreException(Exception):
@@ -97,16 +101,79 @@ def issue_LE_cert(cert_meta: Certificate) -> Optional[CertInstance]:
     :return: Instance of new cert
     """
 
-    # Set up logging
+    return issue_LE_certs([cert_meta], 1)[cert_meta.name]
+
+
+def issue_LE_certs(cert_metas: List[Certificate], workers: int) -> Dict[str, Optional[CertInstance]]:
+    """
+    Try to issue Letsencrypt certificates for a list of cert metas.
+    All certs are authorized in one batch with one DNS update per zone and one propagation wait.
+    Then up to workers ACME orders are finalized concurrently in threads.
+    Results are stored in the DB by the calling thread, which is the only user of the DB connection.
+    :param cert_metas: Descriptions of certificates to issue
+    :param workers: Number of ACME orders to run concurrently
+    :return: Dict with cert name as key and instance of new cert or None as value
+    """
+
+    account = _load_account()
+    if not account:
+        return {cert_meta.name: None for cert_meta in cert_metas}
+
+    # keys are generated in background, while we are waiting for ACME and DNS
+    for encryption_algo in (EncAlgoCKS('rsa'), EncAlgoCKS('ec')):
+        count = len([cert_meta for cert_meta in cert_metas if encryption_algo in _encryption_algos(cert_meta)])
+        if count:
+            KeyPool.prefill(encryption_algo, X509atts.bits, count)
+
+    authorizations = _authorize_many(cert_metas, account)
+
+    def issue(cert_meta: Certificate) -> Optional[List[dict]]:
+        return _issue_cert(cert_meta, account, authorizations[cert_meta.name])
+
+    cert_instances = {}
+    if workers < 2 or len(cert_metas) < 2:
+        for cert_meta in cert_metas:
+            cert_instances[cert_meta.name] = _store_result(cert_meta, lambda: issue(cert_meta))
+        return cert_instances
+
+    sli('Issuing {} Letsencrypt certs with {} workers'.format(len(cert_metas), workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(issue, cert_meta): cert_meta for cert_meta in cert_metas}
+        for future in as_completed(futures):
+            cert_meta = futures[future]
+            cert_instances[cert_meta.name] = _store_result(cert_meta, future.result)
+
+    return cert_instances
+
+
+# --------------- private functions --------------
+
+def _setup_logging() -> None:
+    """
+    Set up logging of automatoes (once)
+    :return:
+    """
+    global logging_initialized
+
+    if logging_initialized:
+        return
     root = logging.getLogger('automatoes')
     root.setLevel(logging.INFO)
     handler = logging.StreamHandler(sys.stderr)
     handler.setFormatter(logging.Formatter("%(message)s"))
     root.addHandler(handler)
+    logging_initialized = True
 
-    os.chdir(str(Pathes.work))  ##FIXME## remove this ?
 
-    sli('Creating certificate for {} and crypto algo {}'.format(cert_meta.name, cert_meta.encryption_algo))
+def _load_account() -> Optional[Account]:
+    """
+    Load our account at Letsencrypt
+    :return: the account or None
+    """
+
+    _setup_logging()
+
+    os.chdir(str(Pathes.work))  ##FIXME## remove this ?
 
     try:
         account: Account = manuale_cli.load_account(str(Pathes.le_account))
@@ -114,26 +181,91 @@ def issue_LE_cert(cert_meta: Certificate) -> Optional[CertInstance]:
         sle('Problem with Lets Encrypt account data at {}'.
             format(Pathes.le_account))
         return None
+    return account
 
-    if cert_meta.encryption_algo == EncAlgo('rsa plus ec'):
-        encryption_algos = (EncAlgoCKS('rsa'), EncAlgoCKS('ec'))
-    else:
-        encryption_algos = (cert_meta.encryption_algo,)
+
+def _issue_cert(cert_meta: Certificate,
+                account: Account,
+                authorization: Tuple[List[Order], Optional[datetime.datetime]]) -> Optional[List[dict]]:
+    """
+    Issue a Letsencrypt certificate for all encryption algorithms of cert meta.
+    Does not access the DB and may therefore run in a worker thread.
+    :param cert_meta: Description of certificate to issue
+    :param account: our account at Letsencrypt
+    :param authorization: orders (one per encryption algorithm) and expiration of authorization,
+                          as returned by _authorize_many
+    :return: None or list of dicts, as returned by _issue_cert_for_one_algo, one per algo
+    """
+
+    (orders, authorized_until) = authorization
+    if not orders:
+        return None
+
+    sli('Creating certificate for {} and crypto algo {}'.format(cert_meta.name, cert_meta.encryption_algo))
 
     results = []
 
-    for encryption_algo in encryption_algos:
+    for (encryption_algo, order) in zip(_encryption_algos(cert_meta), orders):
 
-        result = _issue_cert_for_one_algo(encryption_algo, cert_meta, account)
+        result = _issue_cert_for_one_algo(encryption_algo, cert_meta, account, order)
         if not result:
             return None
         else:
             results.append(result)
 
+    results[0]['AuthorizedUntil'] = authorized_until
+    return results
+
+
+def _encryption_algos(cert_meta: Certificate) -> Tuple[EncAlgoCKS, ...]:
+    """
+    Return encryption algorithms of the cert key stores of cert meta
+    :param cert_meta: Description of certificate
+    :return: Tuple of encryption algorithms, one per cert key store
+    """
+    if cert_meta.encryption_algo == EncAlgo('rsa plus ec'):
+        return (EncAlgoCKS('rsa'), EncAlgoCKS('ec'))
+    else:
+        return (cert_meta.encryption_algo,)
+
+
+def _store_result(cert_meta: Certificate, issue: Callable[[], Optional[List[dict]]]) -> Optional[CertInstance]:
+    """
+    Obtain result of issue and store it in DB.
+    :param cert_meta: Description of certificate to issue
+    :param issue: function, returning result of _issue_cert
+    :return: Instance of new cert or None
+    """
+    try:
+        results = issue()
+    except Exception:
+        sle('Issuance of {} failed, because {} [{}]'.format(
+            cert_meta.name,
+            sys.exc_info()[0].__name__,
+            str(sys.exc_info()[1])))
+        return None
+    if not results:
+        return None
+    return _store_cert(cert_meta, results)
+
+
+def _store_cert(cert_meta: Certificate, results: List[dict]) -> CertInstance:
+    """
+    Store certificates and keys, issued by _issue_cert in DB.
+    :param cert_meta: Description of issued certificate
+    :param results: list of dicts, as returned by _issue_cert_for_one_algo, one per algo
+    :return: Instance of new cert
+    """
+
     # loop ensures to store either all cks in DB or none:
     ci = None
     for result in results:
 
+        if result.get('AuthorizedUntil'):   # remember new expiration date of authorization in DB
+            updates = cert_meta.update_authorized_until(result['AuthorizedUntil'])
+            if updates != 1:
+                sln('Failed to update DB with new authorized_until timestamp')
+
         if not ci:
             cacert_ci = _get_intermediate_instance(db=cert_meta.db, int_cert=result['Intermediate'])
             ci = cert_meta.create_instance(state=CertState('issued'),
@@ -153,16 +285,18 @@ def issue_LE_cert(cert_meta: Certificate) -> Optional[CertInstance]:
     return ci
 
 
-# --------------- private functions --------------
-
-def _issue_cert_for_one_algo(encryption_algo: EncAlgoCKS, cert_meta: Certificate, account: Account) -> Optional[dict]:
+def _issue_cert_for_one_algo(encryption_algo: EncAlgoCKS,
+                             cert_meta: Certificate,
+                             account: Account,
+                             order: Order) -> Optional[dict]:
     """
     Try to issue a Letsencrypt certificate for one encryption algorithm.
-    Does authorization if necessary.
+    Authorization must have been done by _authorize_many.
 
     :param encryption_algo: encryption algo to use
     :param cert_meta: description of cert
     :param account: our account at Letsencrypt
+    :param order: authorized order for this encryption algo
     :return: None or dict: dict layout as follows:
              {'Cert': certificate, 'Key': certificate_key, 'Intermediate': intcert, 'Algo': encryption_algo}
     """
@@ -177,15 +311,8 @@ def _issue_cert_for_one_algo(encryption_algo: EncAlgoCKS, cert_meta: Certificate
         cert_meta.subject_type,
         cert_meta.name))
 
-    order = _authorize(cert_meta, account)
-    if not order:
-        return None
-
-    if encryption_algo == EncAlgoCKS('rsa'):
-        certificate_key = manuale_crypto.generate_rsa_key(X509atts.bits)
-    elif encryption_algo == EncAlgoCKS('ec'):
-        crypto_backend = default_backend()
-        certificate_key = ec.generate_private_key(ec.SECP384R1(), crypto_backend)
+    if encryption_algo in (EncAlgoCKS('rsa'), EncAlgoCKS('ec')):
+        certificate_key = KeyPool.take(encryption_algo, X509atts.bits)
     else:
         raise ValueError('Wrong encryption_algo {} in _issue_cert_for_one_algo for {}'.format(encryption_algo,
                                                                                               cert_meta.name))
@@ -278,19 +405,215 @@ def _get_intermediate_instance(db: db_conn, int_cert: x509.Certificate) -> CertI
     return ci
 
 
-def _authorize(cert_meta: Certificate, account: Account) -> Optional[Order]:
+def _authorize_many(cert_metas: List[Certificate],
+                    account: Account) -> Dict[str, Tuple[List[Order], Optional[datetime.datetime]]]:
     """
-    Try to prove the control about a DNS object.
-
-    @param cert_meta:   Cert meta instance to issue an certificate for
-    @type cert_meta:    Cert meta instance
+    Try to prove the control about the DNS objects of a list of certs.
+    Challenge responses of all certs are published with one DNS update per zone,
+    followed by one wait for DNS propagation and verification of all challenges.
+    Certs with more than one encryption algorithm are authorized once. Their
+    additional orders are placed after authorization and reuse it.
+    Does not access the DB.
+
+    @param cert_metas:  Cert meta instances to issue certificates for
+    @type cert_metas:   list of Cert meta instances
     @param account:     Our letsencrypt account
     @type account:      manuale_cli.load_account instance
-    @rtype:             True if all fqdns could be authorized, False otherwise
+    @rtype:             Dict with cert name as key and as value a tuple of list of orders,
+                        one per encryption algo (empty, if not all fqdns could be authorized)
+                        and new expiration date of authorization (None if no new authorization)
     @exceptions:        manuale_errors.AutomatoesError on Network or other fatal error
     """
     acme = AcmeV2(Misc.LE_SERVER, account)
 
+    authorizations = {}
+    pending = []  # list of tuples (cert_meta, order, challenges)
+    zones = {}  # key = zone, value = list of fqdns
+    fqdn_challenges = {}  # key = fqdn, value = list of challenges
+
+    for cert_meta in cert_metas:
+        try:
+            (order, challenges) = _new_order(cert_meta, acme)
+        except (manuale_errors.AutomatoesError, AcmeError) as e:
+            sle('{}: Placing order failed. Giving up. [{}]'.format(cert_meta.name, str(e)))
+            authorizations[cert_meta.name] = ([], None)
+            continue
+        if not order or not challenges:
+            authorizations[cert_meta.name] = (order, None)
+            continue
+        pending.append((cert_meta, order, challenges))
+
+        # find zones by fqdn
+        sld('Calling zone_and_FQDN_from_altnames()')
+        for (zone, fqdn) in Certificate.zone_and_FQDN_from_altnames(cert_meta):
+            for challenge in challenges:
+                if challenge.domain == fqdn:
+                    if zone in zones:
+                        if fqdn not in zones[zone]: zones[zone].append(fqdn)
+                    else:
+                        zones[zone] = [fqdn]
+                    fqdn_challenges.setdefault(fqdn, [])
+                    # same fqdn in more than one cert or listed twice: publish each token once
+                    if challenge.contents['token'] not in [c.contents['token'] for c in fqdn_challenges[fqdn]]:
+                        fqdn_challenges[fqdn].append(challenge)
+    sld('zones: {}'.format(zones))
+
+    if pending:
+        try:
+            create_challenge_responses_in_dns(zones, fqdn_challenges)
+
+            sld('{} completed DNS setup on hidden primary for all pending FQDNs'.
+                format(datetime.datetime.utcnow().isoformat()))
+            _wait_for_propagation(zones, fqdn_challenges)
+
+            for (cert_meta, order, challenges) in pending:
+                try:
+                    authorizations[cert_meta.name] = _verify_challenges(cert_meta, acme, order, challenges)
+                except (manuale_errors.AutomatoesError, AcmeError) as e:
+                    sle('{}: Verification of challenges failed. Giving up. [{}]'.format(cert_meta.name, str(e)))
+                    authorizations[cert_meta.name] = ([], None)
+        except Exception as e:
+            sle('Publishing challenge responses in DNS failed. Giving up. [{}]'.format(str(e)))
+        finally:
+            try:
+                delete_challenge_responses_in_dns(zones)
+            except Exception as e:
+                sle('Removing challenge responses from DNS failed. [{}]'.format(str(e)))
+
+        for (cert_meta, order, challenges) in pending:
+            if cert_meta.name not in authorizations:
+                sle('{}: Not authorized, because challenge responses could not be published.'.format(
+                    cert_meta.name))
+                authorizations[cert_meta.name] = ([], None)
+
+    # one order per encryption algo: additional orders reuse the authorization of the first one
+    for cert_meta in cert_metas:
+        (order, authorized_until) = authorizations[cert_meta.name]
+        orders = []
+        if order:
+            orders.append(order)
+            for encryption_algo in _encryption_algos(cert_meta)[1:]:
+                try:
+                    (order, challenges) = _new_order(cert_meta, acme)
+                except (manuale_errors.AutomatoesError, AcmeError) as e:
+                    sle('{}: Placing additional order failed [{}]'.format(cert_meta.name, str(e)))
+                    (order, challenges) = (None, [])
+                if not order or challenges:
+                    sle('{}: Additional order for {} not authorized. Giving up.'.format(
+                        cert_meta.name, encryption_algo))
+                    orders = []
+                    break
+                orders.append(order)
+        authorizations[cert_meta.name] = (orders, authorized_until)
+
+    return authorizations
+
+
+def _wait_for_propagation(zones: Dict[str, List[str]], fqdn_challenges: Dict[str, list]) -> None:
+    """
+    Wait until challenge responses are visible on all authoritative servers of their zones.
+    Polls with exponential backoff, but not longer than Misc.LE_PROPAGATION_TIMEOUT seconds.
+
+    @param zones:           dict of zones, where each zone has a list of fqdns
+                            as values
+    @type zones:            dict()
+    @param fqdn_challenges: dict of fqdns, containing list of challenges
+                            of fqdn (one per order)
+    @type fqdn_challenges:  dict()
+    @rtype:                 None
+    """
+    timeout = int(Misc.LE_PROPAGATION_TIMEOUT)
+    pending = set()  # set of tuples (server, fqdn)
+    for zone in zones.keys():
+        for server in _authoritative_servers(zone):
+            for fqdn in zones[zone]:
+                pending.add((server, fqdn))
+
+    start = time.monotonic()
+    delay = 0.1
+    attempt = 0
+    while True:
+        attempt += 1
+        for (server, fqdn) in list(pending):
+            if _challenge_visible(server, fqdn, [challenge.key for challenge in fqdn_challenges[fqdn]]):
+                pending.remove((server, fqdn))
+        elapsed = time.monotonic() - start
+        sld('Propagation probe {}: {} challenge response(s) pending after {:.2f} seconds'.
+            format(attempt, len(pending), elapsed))
+        if not pending:
+            sli('Challenge responses visible on all authoritative servers after {:.2f} seconds'.
+                format(elapsed))
+            return
+        if elapsed >= timeout:
+            sln('Challenge responses not visible after {} seconds: {}'.
+                format(timeout, ', '.join(['{}@{}'.format(fqdn, server) for (server, fqdn) in sorted(pending)])))
+            return
+        time.sleep(min(delay, timeout - elapsed))
+        delay *= 2
+
+
+def _authoritative_servers(zone: str) -> List[str]:
+    """
+    Obtain addresses of authoritative servers of a zone from the NS RRset on the local primary.
+
+    @param zone:        name of zone
+    @type zone:         str
+    @rtype:             list of addresses, local primary if none found
+    """
+    servers = []
+    try:
+        response = dns_query.tcp(dns_message.make_query(zone, rdatatype.NS), '127.0.0.1', timeout=5)
+        ns_names = [rr.target.to_text() for rrset in response.answer for rr in rrset if rrset.rdtype == rdatatype.NS]
+    except Exception:
+        sln('Failed to query NS RRs of zone {} on local primary [{}]'.format(zone, str(sys.exc_info()[1])))
+        ns_names = []
+    for ns_name in ns_names:
+        try:
+            servers.append(socket.getaddrinfo(ns_name, 53, socket.AF_INET, socket.SOCK_DGRAM)[0][4][0])
+        except OSError:
+            sln('Failed to resolve address of name server {} of zone {}'.format(ns_name, zone))
+    if not servers:
+        servers = ['127.0.0.1']
+    sld('Authoritative servers of zone {}: {}'.format(zone, servers))
+    return servers
+
+
+def _challenge_visible(server: str, fqdn: str, keys: List[str]) -> bool:
+    """
+    Check, if all challenge responses of an fqdn are served by a name server.
+
+    @param server:      address of name server
+    @type server:       str
+    @param fqdn:        FQDN, whose challenge responses are checked
+    @type fqdn:         str
+    @param keys:        expected challenge responses
+    @type keys:         list of str
+    @rtype:             True if all challenge responses are visible
+    """
+    try:
+        response = dns_query.udp(dns_message.make_query('_acme-challenge.{}.'.format(fqdn), rdatatype.TXT),
+                                 server, timeout=2)
+    except Exception:
+        return False
+    values = set()
+    for rrset in response.answer:
+        if rrset.rdtype == rdatatype.TXT:
+            for rr in rrset:
+                values.update([string.decode('ascii') for string in rr.strings])
+    return set(keys) <= values
+
+
+def _new_order(cert_meta: Certificate, acme: AcmeV2) -> Tuple[Optional[Order], list]:
+    """
+    Place a new order for cert_meta and obtain its pending challenges.
+
+    @param cert_meta:   Cert meta instance to issue an certificate for
+    @type cert_meta:    Cert meta instance
+    @param acme:        ACME client with our letsencrypt account
+    @type acme:         AcmeV2 instance
+    @rtype:             Tuple of order (None, if order failed) and list of pending challenges
+    @exceptions:        manuale_errors.AutomatoesError on Network or other fatal error
+    """
     FQDNS = dict()
     FQDNS[cert_meta.name] = 0
     for name in cert_meta.altnames:
@@ -302,7 +625,7 @@ def _authorize(cert_meta: Certificate, account: Account) -> Optional[Order]:
         order: Order = acme.new_order(domains, 'dns')
     except AcmeError as e:
         print(e)
-        return None
+        return (None, [])
     returned_order = acme.query_order(order)
     sld('new_order for {} returned\n{}'.
         format(cert_meta.name, print_order(returned_order)))
@@ -310,54 +633,55 @@ def _authorize(cert_meta: Certificate, account: Account) -> Optional[Order]:
         sle("{}: Order is {} {}. Giving up.".
             format(cert_meta.name, 'invalid' if order.invalid else '',
                    'expired' if order.expired else ''))
-        return None
+        return (None, [])
 
     returned_fqdns = [idf['value'] for idf in order.contents['identifiers']]
     if set(domains) != set(returned_fqdns):
         sle("{}: List of FQDNS returned by order does not match ordered FQDNs:\n{}\n{}".
             format(cert_meta.name, returned_fqdns, domains))
-        return None
+        return (None, [])
 
     if order.contents['status'] != 'pending':
-        return order  # all done, if now challenge pending
+        return (order, [])  # all done, if now challenge pending
 
-    fqdn_challenges = {}  # key = domain, value = chllenge
-    pending_challenges = acme.get_order_challenges(order)
-    for challenge in pending_challenges:
+    challenges = []
+    for challenge in acme.get_order_challenges(order):
         if challenge.status == 'valid':
             sli("    {} is already authorized until {}.".format(
                 challenge.domain, challenge.expires))
             continue
+        challenges.append(challenge)
 
-        fqdn_challenges[challenge.domain] = challenge
-
-        # find zones by fqdn
-        zones = {}
-        sld('Calling zone_and_FQDN_from_altnames()')
-        for (zone, fqdn) in Certificate.zone_and_FQDN_from_altnames(cert_meta):
-            if fqdn in fqdn_challenges:
-                if zone in zones:
-                    if fqdn not in zones[zone]: zones[zone].append(fqdn)
-                else:
-                    zones[zone] = [fqdn]
-        sld('zones: {}'.format(zones))
-
-    if not fqdn_challenges:
+    if not challenges:
         server_order = acme.query_order(order)
         order.contents = server_order.contents
         sli("All Altnames of {} are already authorized.Order status = {}".
             format(cert_meta.name, order.contents['status']))
-        return order
 
-    create_challenge_responses_in_dns(zones, fqdn_challenges)
+    return (order, challenges)
+
 
-    sld('{} completed DNS setup on hidden primary for all pending FQDNs'.
-        format(datetime.datetime.utcnow().isoformat()))
-    # Validate challenges
+def _verify_challenges(cert_meta: Certificate,
+                       acme: AcmeV2,
+                       order: Order,
+                       challenges: list) -> Tuple[Optional[Order], Optional[datetime.datetime]]:
+    """
+    Verify challenges of one order, whose responses have been published in DNS.
+
+    @param cert_meta:   Cert meta instance to issue an certificate for
+    @type cert_meta:    Cert meta instance
+    @param acme:        ACME client with our letsencrypt account
+    @type acme:         AcmeV2 instance
+    @param order:       order of cert_meta
+    @type order:        Order instance
+    @param challenges:  pending challenges of order
+    @type challenges:   list of challenges
+    @rtype:             Tuple of order (None, if not all fqdns could be authorized) and
+                        new expiration date of authorization
+    @exceptions:        manuale_errors.AutomatoesError on Network or other fatal error
+    """
     authorized_until = None
-    sli('Waiting 15 seconds for dns propagation')
-    time.sleep(15)
-    for challenge in pending_challenges:
+    for challenge in challenges:
 
         # wait maximum 2 minutes
         sld('{} starting verification of {}'.
@@ -378,31 +702,25 @@ def _authorize(cert_meta: Certificate, account: Account) -> Optional[Order]:
                 response['error']['type'])
             )
             # we need either all challenges or none: repeat with next cron cacle
-            return None
+            return (None, None)
         else:
             sln("{}: Challenge returned status {}".format(
                 challenge.domain,
                 response['status']))
             # we need either all challenges or none: repeat with next cron cacle
-            return None
+            return (None, None)
 
     server_order = acme.query_order(order)
     order.contents = server_order.contents
     sld("All Altnames of {} authorized.Order status = {}".
         format(cert_meta.name, order.contents['status']))
 
-    # remember new expiration date in DB
+    # new expiration date is stored in DB by caller
     if authorized_until:
-        updates = cert_meta.update_authorized_until(
-            datetime.datetime.fromisoformat(re.sub('Z', '', authorized_until)))
-        if updates != 1:
-            sln('Failed to update DB with new authorized_until timestamp')
-
-    delete_challenge_responses_in_dns(zones)
-
+        authorized_until = datetime.datetime.fromisoformat(re.sub('Z', '', authorized_until))
 
-    sli("FQDNs authorized. Let's Encrypt!")
-    return order
+    sli("FQDNs of {} authorized. Let's Encrypt!".format(cert_meta.name))
+    return (order, authorized_until)
 
 
 def create_challenge_responses_in_dns(zones, fqdn_challenges):
@@ -412,8 +730,8 @@ def create_challenge_responses_in_dns(zones, fqdn_challenges):
     @param zones:           dict of zones, where each zone has a list of fqdns
                             as values
     @type zones:            dict()
-    @param fqdn_challenges: dict of zones, containing challenge response
-                            (key) of zone
+    @param fqdn_challenges: dict of fqdns, containing list of challenges
+                            of fqdn (one per order)
     @type fqdn_challenges:  dict()
     @rtype:                 None
     @exceptions             Can''t parse ddns key or
@@ -427,8 +745,9 @@ def create_challenge_responses_in_dns(zones, fqdn_challenges):
             lines = []
             for fqdn in zones[zone]:
                 sld('fqdn: {}'.format(fqdn))
-                lines.append(str('_acme-challenge.{}.  IN TXT  \"{}\"\n'.
-                                 format(fqdn, fqdn_challenges[fqdn].key)))
+                for challenge in fqdn_challenges[fqdn]:
+                    lines.append(str('_acme-challenge.{}.  IN TXT  \"{}\"\n'.
+                                     format(fqdn, challenge.key)))
             sli('Writing RRs: {}'.format(lines))
             with open(dest, 'w') as file:
                 file.writelines(lines)
@@ -445,12 +764,13 @@ def create_challenge_responses_in_dns(zones, fqdn_challenges):
             for fqdn in zones[zone]:
                 the_update.delete('_acme-challenge.{}.'.format(fqdn),
                                   txt_datatape)
-                the_update.add('_acme-challenge.{}.'.format(fqdn),
-                               60,
-                               txt_datatape,
-                               fqdn_challenges[fqdn].key)
-                sld('DNS update of RR: {}'.format('_acme-challenge.{}.  60 TXT  \"{}\"'.
-                                                  format(fqdn, fqdn_challenges[fqdn].key)))
+                for challenge in fqdn_challenges[fqdn]:
+                    the_update.add('_acme-challenge.{}.'.format(fqdn),
+                                   60,
+                                   txt_datatape,
+                                   challenge.key)
+                    sld('DNS update of RR: {}'.format('_acme-challenge.{}.  60 TXT  \"{}\"'.
+                                                      format(fqdn, challenge.key)))
             response = dns_query.tcp(the_update, '127.0.0.1', timeout=10)
             sld('DNS update delete/add returned response: {}'.format(response))
             rc = response.rcode()
@@ -23,21 +23,27 @@ along with serverPKI.  If not, see <http://www.gnu.org/licenses/>.
 
 
 # --------------- imported modules --------------
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import datetime
-from typing import Optional
+import os
+import sys
+from typing import Dict, List, Optional, Tuple
 
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography import x509
 from cryptography.x509.oid import NameOID
 
 # --------------- local imports --------------
-from serverPKI.cert import Certificate, CertInstance, CertState
+from serverPKI.cert import Certificate, CertInstance, CertState, EncAlgoCKS
 from serverPKI.cacert import get_cacert_and_key
+from serverPKI.keypool import KeyPool
 from serverPKI.utils import sld, sli, sln, sle,  Pathes, X509atts
 
 
+worker_ca = None        # (cacert, cakey, bits, lifetime) in processes of issue_local_certs
+
 # --------------- public functions --------------
 
 
@@ -56,6 +62,7 @@ def issue_local_cert(cert_meta: Certificate) -> Optional[CertInstance]:
     :rtype:             cert instance id in DB of new cert or None
     """
 
+    KeyPool.prefill(EncAlgoCKS('rsa'), X509atts.bits, 1)    # generated while asking for CA passphrase
     cacert, cakey, cacert_ci = get_cacert_and_key(cert_meta.db)
 
     sli('Creating key ({} bits) and cert for {} {}. Using CA cert {}'.format(
@@ -64,17 +71,131 @@ def issue_local_cert(cert_meta: Certificate) -> Optional[CertInstance]:
         cert_meta.name,
         cacert_ci.row_id)
     )
-    serial = x509.random_serial_number()
-    # Generate our key
-    key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=int(X509atts.bits),
-        backend=default_backend()
+    # Obtain our key
+    key = KeyPool.take(EncAlgoCKS('rsa'), X509atts.bits)
+
+    (cert, not_valid_before, not_valid_after, serial) = _build_cert(
+        cert_meta.name, cert_meta.subject_type, cert_meta.altnames, key, cacert, cakey, X509atts.lifetime)
+
+    ci = cert_meta.create_instance(state=CertState('issued'),
+                                   not_before=not_valid_before,
+                                   not_after=not_valid_after,
+                                   ca_cert_ci=cacert_ci
+                                   )
+    ci.store_cert_key(algo=cert_meta.encryption_algo, cert=cert, key=key)
+    cert_meta.save_instance(ci)
+
+    sli('Certificate for {} {}, serial {}, valid until {} created.'.format(
+        cert_meta.subject_type,
+        cert_meta.name,
+        serial,
+        not_valid_after.isoformat())
+    )
+
+    return ci
+
+
+def issue_local_certs(cert_metas: List[Certificate]) -> Dict[str, Optional[CertInstance]]:
+    """
+    Ask local CA to issue certificates for a list of cert metas.
+    The CA key is unlocked once. Keys are generated and certs signed
+    in a process pool across all cores. All instances are inserted into
+    the DB in one transaction.
+
+    :param cert_metas:  Cert meta instances to issue certificates for
+    :return:            Dict with cert name as key and instance of new cert or None as value
+    """
+    if len(cert_metas) < 2:
+        return {cert_meta.name: issue_local_cert(cert_meta) for cert_meta in cert_metas}
+
+    db = cert_metas[0].db
+    cacert, cakey, cacert_ci = get_cacert_and_key(db)
+
+    workers = os.cpu_count()
+    sli('Creating keys ({} bits) and certs for {} local certs with {} processes. Using CA cert {}'.format(
+        int(X509atts.bits),
+        len(cert_metas),
+        workers,
+        cacert_ci.row_id)
     )
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(cacert.public_bytes(serialization.Encoding.PEM),
+                                       cakey.private_bytes(encoding=serialization.Encoding.PEM,
+                                                           format=serialization.PrivateFormat.PKCS8,
+                                                           encryption_algorithm=serialization.NoEncryption()),
+                                       int(X509atts.bits),
+                                       X509atts.lifetime)) as executor:
+        futures = {executor.submit(_issue_in_worker,
+                                   cert_meta.name,
+                                   str(cert_meta.subject_type),
+                                   list(cert_meta.altnames)): cert_meta for cert_meta in cert_metas}
+        for future in as_completed(futures):
+            cert_meta = futures[future]
+            try:
+                results[cert_meta.name] = future.result()
+            except Exception:
+                sle('Issuance of {} failed, because {} [{}]'.format(
+                    cert_meta.name,
+                    sys.exc_info()[0].__name__,
+                    str(sys.exc_info()[1])))
+
+    cert_instances = {}
+    with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+        for cert_meta in cert_metas:
+            if cert_meta.name not in results:
+                cert_instances[cert_meta.name] = None
+                continue
+            (cert_pem, key_pem, not_valid_before, not_valid_after, serial) = results[cert_meta.name]
+            ci = cert_meta.create_instance(state=CertState('issued'),
+                                           not_before=not_valid_before,
+                                           not_after=not_valid_after,
+                                           ca_cert_ci=cacert_ci
+                                           )
+            ci.store_cert_key(algo=cert_meta.encryption_algo,
+                              cert=x509.load_pem_x509_certificate(cert_pem, default_backend()),
+                              key=serialization.load_pem_private_key(key_pem, password=None,
+                                                                     backend=default_backend()))
+            cert_meta.save_instance(ci)
+            cert_instances[cert_meta.name] = ci
+
+            sli('Certificate for {} {}, serial {}, valid until {} created.'.format(
+                cert_meta.subject_type,
+                cert_meta.name,
+                serial,
+                not_valid_after.isoformat())
+            )
+
+    return cert_instances
+
+
+# --------------- private functions --------------
+
+def _build_cert(name: str,
+                subject_type: str,
+                altnames: List[str],
+                key: rsa.RSAPrivateKey,
+                cacert: x509.Certificate,
+                cakey: rsa.RSAPrivateKey,
+                lifetime: int) -> Tuple[x509.Certificate, datetime.datetime, datetime.datetime, int]:
+    """
+    Build a certificate and sign it with the local CA key.
+
+    :param name:            subject name of cert
+    :param subject_type:    subject type of cert ('server' or 'client')
+    :param altnames:        list of alternate names of cert
+    :param key:             private key of new cert
+    :param cacert:          local CA cert
+    :param cakey:           private key of local CA cert
+    :param lifetime:        lifetime of new cert in days
+    :return:                Tuple of cert, not_valid_before, not_valid_after and serial
+    """
+    serial = x509.random_serial_number()
 
     builder = x509.CertificateBuilder()
     builder = builder.subject_name(x509.Name([
-        x509.NameAttribute(NameOID.COMMON_NAME, cert_meta.name),
+        x509.NameAttribute(NameOID.COMMON_NAME, name),
     ]))
     builder = builder.issuer_name(x509.Name(
         cacert.subject,
@@ -83,7 +204,7 @@ def issue_local_cert(cert_meta: Certificate) -> Optional[CertInstance]:
     not_valid_before = datetime.datetime.utcnow() - datetime.timedelta(
         days=1)
     not_valid_after = datetime.datetime.utcnow() + datetime.timedelta(
-        days=X509atts.lifetime)
+        days=lifetime)
     builder = builder.not_valid_before(not_valid_before)
     builder = builder.not_valid_after(not_valid_after)
     builder = builder.serial_number(serial)
@@ -114,12 +235,12 @@ def issue_local_cert(cert_meta: Certificate) -> Optional[CertInstance]:
     except x509.extensions.ExtensionNotFound:
         sle('Could not add a AuthorityKeyIdentifier, because CA has no SubjectKeyIdentifier')
 
-    if cert_meta.subject_type == 'client':
-        alt_names = [x509.RFC822Name(cert_meta.name), ]
+    if subject_type == 'client':
+        alt_names = [x509.RFC822Name(name), ]
     else:
-        alt_names = [x509.DNSName(cert_meta.name), ]
-    for n in cert_meta.altnames:
-        if cert_meta.subject_type == 'client':
+        alt_names = [x509.DNSName(name), ]
+    for n in altnames:
+        if subject_type == 'client':
             alt_names.append(x509.RFC822Name(n))
         else:
             alt_names.append(x509.DNSName(n))
@@ -132,7 +253,7 @@ def issue_local_cert(cert_meta: Certificate) -> Optional[CertInstance]:
     builder = builder.add_extension(
         x509.KeyUsage(
             digital_signature=True,
-            key_encipherment=True if cert_meta.subject_type == 'server' else False,
+            key_encipherment=True if subject_type == 'server' else False,
             content_commitment=False,
             data_encipherment=False,
             key_agreement=False,
@@ -145,9 +266,9 @@ def issue_local_cert(cert_meta: Certificate) -> Optional[CertInstance]:
     )
 
     eku = None
-    if cert_meta.subject_type == 'server':
+    if subject_type == 'server':
         eku = x509.oid.ExtendedKeyUsageOID.SERVER_AUTH
-    elif cert_meta.subject_type == 'client':
+    elif subject_type == 'client':
         eku = x509.oid.ExtendedKeyUsageOID.CLIENT_AUTH
     if eku:
         builder = builder.add_extension(
@@ -161,19 +282,48 @@ def issue_local_cert(cert_meta: Certificate) -> Optional[CertInstance]:
         private_key=cakey, algorithm=hashes.SHA384(),
         backend=default_backend()
     )
-    ci = cert_meta.create_instance(state=CertState('issued'),
-                                   not_before=not_valid_before,
-                                   not_after=not_valid_after,
-                                   ca_cert_ci=cacert_ci
-                                   )
-    ci.store_cert_key(algo=cert_meta.encryption_algo, cert=cert, key=key)
-    cert_meta.save_instance(ci)
 
-    sli('Certificate for {} {}, serial {}, valid until {} created.'.format(
-        cert_meta.subject_type,
-        cert_meta.name,
-        serial,
-        not_valid_after.isoformat())
-    )
+    return (cert, not_valid_before, not_valid_after, serial)
 
-    return ci
+
+def _init_worker(cacert_pem: bytes, cakey_pem: bytes, bits: int, lifetime: int) -> None:
+    """
+    Initialize a process of issue_local_certs with the unlocked local CA cert and key.
+    The CA key is handed over through the pipe of the process pool and kept in memory only.
+
+    :param cacert_pem:  local CA cert in PEM format
+    :param cakey_pem:   private key of local CA cert in PEM format
+    :param bits:        key size of new certs
+    :param lifetime:    lifetime of new certs in days
+    :return:
+    """
+    global worker_ca
+
+    worker_ca = (x509.load_pem_x509_certificate(cacert_pem, default_backend()),
+                 serialization.load_pem_private_key(cakey_pem, password=None, backend=default_backend()),
+                 bits,
+                 lifetime)
+
+
+def _issue_in_worker(name: str,
+                     subject_type: str,
+                     altnames: List[str]) -> Tuple[bytes, bytes, datetime.datetime, datetime.datetime, int]:
+    """
+    Generate key and signed cert in a process of issue_local_certs.
+
+    :param name:            subject name of cert
+    :param subject_type:    subject type of cert ('server' or 'client')
+    :param altnames:        list of alternate names of cert
+    :return:                Tuple of cert and key in PEM format, not_valid_before, not_valid_after and serial
+    """
+    (cacert, cakey, bits, lifetime) = worker_ca
+    key = rsa.generate_private_key(public_exponent=65537, key_size=bits, backend=default_backend())
+    (cert, not_valid_before, not_valid_after, serial) = _build_cert(
+        name, subject_type, altnames, key, cacert, cakey, lifetime)
+    return (cert.public_bytes(serialization.Encoding.PEM),
+            key.private_bytes(encoding=serialization.Encoding.PEM,
+                              format=serialization.PrivateFormat.PKCS8,
+                              encryption_algorithm=serialization.NoEncryption()),
+            not_valid_before,
+            not_valid_after,
+            serial)
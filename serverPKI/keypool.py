@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (C) 2015-2020  Axel Rau <axel.rau@chaos1.de>
+
+This file is part of serverPKI.
+
+serverPKI is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Foobar is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with serverPKI.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Pool of pre-generated private keys for new certs
+
+
+# --------------- imported modules --------------
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import os
+from threading import Lock
+import time
+from typing import Deque, Dict, Optional, Tuple, Union
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+# --------------- local imports --------------
+from serverPKI.cert import EncAlgoCKS
+from serverPKI.utils import sld, sli, sln
+
+
+PrivateKey = Union[rsa.RSAPrivateKey, ec.EllipticCurvePrivateKey]
+
+
+# --------------- classes --------------
+
+class KeyPool(object):
+    """
+    Per run pool of private keys, generated in background processes.
+    Issuers announce the keys they will need with prefill() before doing
+    slow work (ACME/DNS round trips, asking for the CA passphrase) and obtain
+    them with take(). Keys are held per (algo, bits) in bounded queues.
+    Keys not taken are discarded by shutdown() at end of run.
+    """
+    max_keys = 16           # per (algo, bits)
+    executor: Optional[ProcessPoolExecutor] = None
+    queues: Dict[Tuple[str, int], Deque[Future]] = {}
+    stats: Dict[Tuple[str, int], Dict[str, float]] = {}
+    lock = Lock()
+
+    @staticmethod
+    def prefill(algo: EncAlgoCKS, bits: int, count: int) -> None:
+        """
+        Start background generation of keys
+        :param algo: encryption algo of keys
+        :param bits: key size for rsa (ignored for ec)
+        :param count: number of keys needed
+        :return:
+        """
+        kind = (str(algo), int(bits) if algo == EncAlgoCKS('rsa') else 0)
+        with KeyPool.lock:
+            queue = KeyPool.queues.setdefault(kind, deque())
+            missing = min(count, KeyPool.max_keys) - len(queue)
+            if missing > 0 and not KeyPool.executor:
+                # no more processes than keys needed by first issuer (one for a single local cert)
+                KeyPool.executor = ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, missing))
+            for i in range(missing):
+                queue.append(KeyPool.executor.submit(_generate_key, kind[0], kind[1]))
+        if missing > 0:
+            sld('KeyPool: generating {} {} keys in background'.format(missing, kind))
+
+    @staticmethod
+    def take(algo: EncAlgoCKS, bits: int) -> PrivateKey:
+        """
+        Obtain a key from the pool or generate one, if pool is empty
+        :param algo: encryption algo of key
+        :param bits: key size for rsa (ignored for ec)
+        :return: the private key
+        """
+        kind = (str(algo), int(bits) if algo == EncAlgoCKS('rsa') else 0)
+        with KeyPool.lock:
+            queue = KeyPool.queues.get(kind)
+            future = queue.popleft() if queue else None
+            stats = KeyPool.stats.setdefault(kind, {'hits': 0, 'waits': 0, 'misses': 0, 'generation_time': 0.0})
+
+        if future:
+            outcome = 'hits' if future.done() else 'waits'
+            try:
+                (pem, generation_time) = future.result()
+                key = serialization.load_pem_private_key(pem, password=None, backend=default_backend())
+            except Exception as e:
+                sln('KeyPool: background key generation failed, generating inline [{}]'.format(str(e)))
+                future = None
+        if not future:
+            outcome = 'misses'
+            start = time.monotonic()
+            key = _new_key(kind[0], kind[1])
+            generation_time = time.monotonic() - start
+
+        with KeyPool.lock:
+            stats[outcome] += 1
+            stats['generation_time'] += generation_time
+        return key
+
+    @staticmethod
+    def shutdown() -> None:
+        """
+        Log statistics, discard unused keys and stop background processes
+        :return:
+        """
+        with KeyPool.lock:
+            for (kind, stats) in KeyPool.stats.items():
+                taken = stats['hits'] + stats['waits'] + stats['misses']
+                sli('KeyPool {}/{}: {} hits, {} waits, {} misses, mean generation time {:.2f} seconds'.format(
+                    kind[0], kind[1], stats['hits'], stats['waits'], stats['misses'],
+                    stats['generation_time'] / taken))
+            for queue in KeyPool.queues.values():
+                for future in queue:
+                    future.cancel()
+            if KeyPool.executor:
+                KeyPool.executor.shutdown(wait=True)
+            KeyPool.executor = None
+            KeyPool.queues = {}
+            KeyPool.stats = {}
+
+
+# --------------- private functions --------------
+
+def _new_key(algo: str, bits: int) -> PrivateKey:
+    """
+    Generate a private key
+    :param algo: encryption algo of key
+    :param bits: key size for rsa
+    :return: the private key
+    """
+    if algo == 'rsa':
+        return rsa.generate_private_key(public_exponent=65537, key_size=bits, backend=default_backend())
+    elif algo == 'ec':
+        return ec.generate_private_key(ec.SECP384R1(), default_backend())
+    raise ValueError('Wrong encryption_algo {} in KeyPool'.format(algo))
+
+
+def _generate_key(algo: str, bits: int) -> Tuple[bytes, float]:
+    """
+    Generate a private key in a background process
+    :param algo: encryption algo of key
+    :param bits: key size for rsa
+    :return: Tuple of PEM serialized key (key objects can't be pickled) and generation time in seconds
+    """
+    start = time.monotonic()
+    key = _new_key(algo, bits)
+    generation_time = time.monotonic() - start
+    return (key.private_bytes(encoding=serialization.Encoding.PEM,
+                              format=serialization.PrivateFormat.PKCS8,
+                              encryption_algorithm=serialization.NoEncryption()),
+            generation_time)
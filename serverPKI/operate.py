@@ -26,21 +26,25 @@ from paramiko import util
 from postgresql import driver as db_conn
 
 from serverPKI.cacert import issue_local_CAcert, LocalCaCertCache
-from serverPKI.cert import Certificate, CertType, init_module_cert
-from serverPKI.cert import read_db_encryption_key, encrypt_all_keys, decrypt_all_keys
+from serverPKI.cert import Certificate, CertKeyStore, CertType, init_module_cert
+from serverPKI.cert import read_db_encryption_key, encrypt_all_keys, decrypt_all_keys, rotate_db_key
+from serverPKI.cert import check_db_key_rotation
 
 from serverPKI.certdist import deployCerts, consolidate_TLSA, consolidate_cert, delete_TLSA, export_instance
+from serverPKI.certdist import TLSAUpdates
+from serverPKI.certdist import SSHConnectionPool
 from serverPKI.db import DbConnection as dbc
-from serverPKI.issue_LE import issue_LE_cert
-from serverPKI.issue_local import issue_local_cert
+from serverPKI.issue_LE import issue_LE_cert, issue_LE_certs
+from serverPKI.issue_local import issue_local_cert, issue_local_certs
+from serverPKI.keypool import KeyPool
 
 from serverPKI.utils import parse_options, parse_config, get_config
 
 from serverPKI.utils import get_version_string, options_set, check_actions
 from serverPKI.utils import names_of_local_certs_to_be_renewed, print_certs
-from serverPKI.utils import options_set, check_actions, updateSOAofUpdatedZones
+from serverPKI.utils import options_set, check_actions
 from serverPKI.utils import sld, sli, sln, sle
-from serverPKI.schedule import scheduleCerts
+from serverPKI.schedule import plan_actions, scheduleCerts
 
 from automatoes.register import register
 
@@ -75,152 +79,177 @@ def execute_from_command_line():
     pe = dbc('serverpki')
     db: db_conn = pe.open()
 
-    # in case of restarting serverPKI wo fresh imports (e.g. by pytest)
-    init_module_cert()
+    try:
+        # in case of restarting serverPKI wo fresh imports (e.g. by pytest)
+        init_module_cert()
+
+        LocalCaCertCache.cert = None
+        LocalCaCertCache.key = None
+        LocalCaCertCache.ci = None
+
+        read_db_encryption_key(db)
+
+        all_cert_names = Certificate.names(db)
+        all_disthost_names = Certificate.disthost_names(db)
+        # preload CMs, CIs and CKSs of our CAs
+        cas = []
+        for name in (Misc.SUBJECT_LOCAL_CA, Misc.SUBJECT_LE_CA):
+            if name in all_cert_names:      # does CA exist in DB?
+                cas.append(name)
+        Certificate.load_many(db, cas)
+
+        sli('{} certificates and CAs {} in DB'.format(len(all_cert_names), cas))
+
+        if opts.encrypt:
+            if encrypt_all_keys(db):
+                sys.exit(0)
+            sys.exit(1)
+        if opts.decrypt:
+            if decrypt_all_keys(db):
+                sys.exit(0)
+            sys.exit(1)
+        if opts.rotate_db_key:
+            if rotate_db_key(db, opts.rotate_db_key):
+                sys.exit(0)
+            sys.exit(1)
+        if opts.issue_local_cacert:
+            if issue_local_CAcert(db):
+                sys.exit(0)
+            sys.exit(1)
+
+        if (opts.schedule or opts.create or opts.distribute or opts.sync_disk or opts.cert_serial) and \
+                not opts.check_only and not check_db_key_rotation(db):
+            sle('Stopped, because keys in DB can\'t be used with the configured DB encryption key')
+            sys.exit(1)
+
+        if opts.all:
+            our_cert_names = all_cert_names
+        elif opts.remaining_days:
+            our_cert_names = names_of_local_certs_to_be_renewed(db,
+                                                                opts.remaining_days,
+                                                                opts.distribute)
+            if not opts.create:
+                opts.create = not opts.distribute
+
+        cert_name_set: set = set(our_cert_names)
 
-    LocalCaCertCache.cert = None
-    LocalCaCertCache.key = None
-    LocalCaCertCache.ci = None
+        error = False
 
-    read_db_encryption_key(db)
+        if opts.only_cert:
+            error = False
+            for i in opts.only_cert:
+                if i not in all_cert_names:
+                    sle("{} not in configuration. Can't be specified with --only".format(i))
+                    error = True
+            if not error:
+                cert_name_set = set(opts.only_cert)
 
-    all_cert_names = Certificate.names(db)
-    all_disthost_names = Certificate.disthost_names(db)
-    # preload CMs, CIs and CKSs of our CAs
-    cas = []
-    for name in (Misc.SUBJECT_LOCAL_CA, Misc.SUBJECT_LE_CA):
-        if name in all_cert_names:      # does CA exist in DB?
-            cm = Certificate.create_or_load_cert_meta(db, name)
-            cas.append(name)
+        else:
+            if opts.cert_to_be_included:
+                error = False
+                for i in opts.cert_to_be_included:
+                    if i not in all_cert_names:
+                        sle("{} not in configuration. Can't be included".format(i))
+                        error = True
+                if not error:
+                    cert_name_set = set(opts.cert_to_be_included)
+
+            if opts.cert_to_be_excluded:
+                error = False
+                for i in opts.cert_to_be_excluded:
+                    if i not in all_cert_names:
+                        sle("{} not in configuration. Can't be excluded".format(i))
+                        error = True
+                if not error:
+                    cert_name_set -= set(opts.cert_to_be_excluded)
+        if opts.only_host:
+            for i in opts.only_host:
+                if i not in all_disthost_names:
+                    sle("{} not in configuration. Can't use in --limit-to-disthost".format(i))
+                    error = True
+        if opts.skip_host:
+            for i in opts.skip_host:
+                if i not in all_disthost_names:
+                    sle("{} not in configuration. Can't use in --skip-disthost".format(i))
+                    error = True
 
-    sli('{} certificates and CAs {} in DB'.format(len(all_cert_names), cas))
+        if error:
+            sle('Stopped due to command line errors')
+            sys.exit(1)
 
-    if opts.encrypt:
-        if encrypt_all_keys(db):
-            sys.exit(0)
-        sys.exit(1)
-    if opts.decrypt:
-        if decrypt_all_keys(db):
-            sys.exit(0)
-        sys.exit(1)
-    if opts.issue_local_cacert:
-        if issue_local_CAcert(db):
-            sys.exit(0)
-        sys.exit(1)
+        our_cert_names = sorted(list(cert_name_set))
+        if opts.schedule:                       # load only certs with pending actions
+            planned = plan_actions(db, our_cert_names,
+                                   explicit_names=(opts.only_cert or []) + (opts.cert_to_be_included or []))
+            our_cert_names = [name for name in our_cert_names if name in planned]
 
-    if opts.all:
-        our_cert_names = all_cert_names
-    elif opts.remaining_days:
-        our_cert_names = names_of_local_certs_to_be_renewed(db,
-                                                            opts.remaining_days,
-                                                            opts.distribute)
-        if not opts.create:
-            opts.create = not opts.distribute
+        for name, cm in Certificate.load_many(db, our_cert_names).items():
+            if cm.in_db: our_certs[name] = cm
 
-    cert_name_set: set = set(our_cert_names)
+        if opts.check_only and not opts.schedule:
+            sli('No syntax errors found in configuration.')
+            ##sli('Selected certificates:\n\r{}'.format(our_cert_names))
+            print_certs(db, our_cert_names)
+            sys.exit(0)
 
-    error = False
+        sld('Selected certificates:\n\r{}'.format(our_cert_names))
 
-    if opts.only_cert:
-        error = False
-        for i in opts.only_cert:
-            if i not in all_cert_names:
-                sle("{} not in configuration. Can't be specified with --only".format(i))
-                error = True
-        if not error:
-            cert_name_set = set(opts.only_cert)
-
-    else:
-        if opts.cert_to_be_included:
-            error = False
-            for i in opts.cert_to_be_included:
-                if i not in all_cert_names:
-                    sle("{} not in configuration. Can't be included".format(i))
-                    error = True
-            if not error:
-                cert_name_set = set(opts.cert_to_be_included)
+        if opts.schedule:
+            sli('Scheduling actions.')
+            scheduleCerts(db, our_certs)
+        else:
+            if opts.create:
+                sli('Creating certificates.')
+                le_certs = []
+                local_certs = []
+                for c in our_certs.values():
+                    if c.cert_type == CertType('LE'):
+                        le_certs.append(c)
+                    elif  c.cert_type == CertType('local'):
+                        local_certs.append(c)
+                    else:
+                        raise AssertionError('Invalid CertType in {}'.format(c.name))
+                new_cis = {}
+                if local_certs:
+                    new_cis.update(issue_local_certs(local_certs))
+                if le_certs:
+                    new_cis.update(issue_LE_certs(le_certs, opts.parallel if opts.parallel else 1))
+                failed = [name for name, ci in new_cis.items() if not ci]
+                if failed:
+                    sle('Failed to issue {}'.format(', '.join(failed)))
+                    sle('Stopped due to error')
+                    sys.exit(1)
+
+            if opts.distribute:
+                sli('Distributing certificates.')
+                deployCerts(our_certs)
+
+        if opts.sync_disk:
+            for c in our_certs.values():
+                consolidate_cert(c)
 
-        if opts.cert_to_be_excluded:
-            error = False
-            for i in opts.cert_to_be_excluded:
-                if i not in all_cert_names:
-                    sle("{} not in configuration. Can't be excluded".format(i))
-                    error = True
-            if not error:
-                cert_name_set -= set(opts.cert_to_be_excluded)
-    if opts.only_host:
-        for i in opts.only_host:
-            if i not in all_disthost_names:
-                sle("{} not in configuration. Can't use in --limit-to-disthost".format(i))
-                error = True
-    if opts.skip_host:
-        for i in opts.skip_host:
-            if i not in all_disthost_names:
-                sle("{} not in configuration. Can't use in --skip-disthost".format(i))
-                error = True
-
-    if error:
-        sle('Stopped due to command line errors')
-        sys.exit(1)
-
-    our_cert_names = sorted(list(cert_name_set))
-
-    for name in our_cert_names:
-        cm = Certificate.create_or_load_cert_meta(db, name)
-        if cm.in_db: our_certs[name] = cm
-
-    if opts.check_only and not opts.schedule:
-        sli('No syntax errors found in configuration.')
-        ##sli('Selected certificates:\n\r{}'.format(our_cert_names))
-        print_certs(db, our_cert_names)
-        sys.exit(0)
-
-    sld('Selected certificates:\n\r{}'.format(our_cert_names))
-
-    if opts.schedule:
-        sli('Scheduling actions.')
-        scheduleCerts(db, our_certs)
-    else:
-        if opts.create:
-            sli('Creating certificates.')
+        if opts.sync_tlsas:
+            for c in our_certs.values():
+                consolidate_TLSA(c)
+            TLSAUpdates.flush()
+
+        if opts.remove_tlsas:
             for c in our_certs.values():
-                if c.cert_type == CertType('LE'):
-                    if issue_LE_cert(c):
-                        continue
-                elif  c.cert_type == CertType('local'):
-                    if issue_local_cert(c):
-                        continue
-                else:
-                    raise AssertionError('Invalid CertType in {}'.format(c.name))
-                sle('Stopped due to error')
-                sys.exit(1)
-
-        if opts.distribute:
-            sli('Distributing certificates.')
-            deployCerts(our_certs)
-
-    if opts.sync_disk:
-        for c in our_certs.values():
-            consolidate_cert(c)
-
-    if opts.sync_tlsas:
-        for c in our_certs.values():
-            consolidate_TLSA(c)
-        updateSOAofUpdatedZones()
-
-    if opts.remove_tlsas:
-        for c in our_certs.values():
-            delete_TLSA(c)
-        updateSOAofUpdatedZones()
-
-    if opts.cert_serial:
-        sli('Exporting certificate instance.')
-        export_instance(db)
-
-    if opts.register:
-        sli('Registering a new Let\'s Encrypt Account.\n With URI:{}\n'
-            ' and e-mail {}'.format(Misc.LE_SERVER, Misc.LE_EMAIL))
-        register(Misc.LE_SERVER, Pathes.le_account, Misc.LE_EMAIL, None)
+                delete_TLSA(c)
+            TLSAUpdates.flush()
+
+        if opts.cert_serial:
+            sli('Exporting certificate instance.')
+            export_instance(db)
+
+        if opts.register:
+            sli('Registering a new Let\'s Encrypt Account.\n With URI:{}\n'
+                ' and e-mail {}'.format(Misc.LE_SERVER, Misc.LE_EMAIL))
+            register(Misc.LE_SERVER, Pathes.le_account, Misc.LE_EMAIL, None)
+    finally:
+        SSHConnectionPool.close_all()       # close connections to disthosts of this run
+        KeyPool.shutdown()                  # discard unused keys
+        CertKeyStore.clear_key_cache()      # forget decrypted keys
 
 
 def issue(db: db_conn, cert_meta: Certificate) -> bool:
@@ -24,14 +24,14 @@ from datetime import datetime, timedelta, date
 from email.mime.text import MIMEText
 import smtplib
 import sys
-from typing import Optional, Dict
+from typing import Callable, Optional, Dict, Iterable, List, Tuple
 
 from postgresql import driver as db_conn
 
 import serverPKI.cert as cert
 
-from serverPKI.certdist import deployCerts, distribute_tlsa_rrs
-from serverPKI.issue_LE import issue_LE_cert
+from serverPKI.certdist import deployCerts, distribute_tlsa_rrs, check_disthosts, TLSAUpdates
+from serverPKI.issue_LE import issue_LE_certs
 from serverPKI.utils import sld, sli, sln, sle, get_config
 from serverPKI.utils import shortDateTime, get_options
 
@@ -50,13 +50,233 @@ class Action(Enum):
     expire = auto()
     archive = auto()
     delete = auto()
+    mail = auto()
 
 
 ma = Action.distribute
 
+# ---------------  prepared SQL queries  --------------
+
+# Surviving instances of a list of certs and what to do with them.
+# Mirrors the decisions of scheduleCerts and _find_to_be_deleted:
+# Of each state, only the most recent instance survives. Issued and prepublished instances survive
+# only until 1 day after not_after, deployed ones are replaced 1 day before not_after.
+q_plan = """
+WITH params AS (
+    SELECT $2::TIMESTAMP AS now,
+            $3::INT * INTERVAL '1 day' AS prepublish_ahead,
+            $4::INT * INTERVAL '1 day' AS mail_ahead
+), certs AS (
+    SELECT c.id, s.name::TEXT AS name, c.type::TEXT, c.disabled, c.authorized_until
+        FROM Certificates c, Subjects s
+        WHERE
+            s.certificate = c.id AND
+            NOT s.isaltname AND
+            s.type NOT IN ('CA', 'reserved') AND
+            s.name = ANY($1::TEXT[])
+), instances AS (
+    SELECT i.id, i.certificate, i.state::TEXT, i.not_after,
+            row_number() OVER (PARTITION BY i.certificate, i.state ORDER BY i.id DESC) AS recency
+        FROM CertInstances i, certs c
+        WHERE i.certificate = c.id
+), states AS (
+    SELECT c.id, c.name, c.type, c.disabled, c.authorized_until, count(i.id) AS surviving,
+            max(i.id) FILTER (WHERE i.state = 'issued' AND p.now < i.not_after + INTERVAL '1 day') AS issued_id,
+            max(i.not_after) FILTER (WHERE i.state = 'issued' AND p.now < i.not_after + INTERVAL '1 day')
+                AS issued_not_after,
+            max(i.id) FILTER (WHERE i.state = 'prepublished' AND p.now < i.not_after + INTERVAL '1 day')
+                AS prepublished_id,
+            max(i.id) FILTER (WHERE i.state = 'deployed' AND p.now < i.not_after + INTERVAL '1 day') AS deployed_id,
+            max(i.not_after) FILTER (WHERE i.state = 'deployed' AND p.now < i.not_after + INTERVAL '1 day')
+                AS deployed_not_after
+        FROM params p, certs c
+        LEFT JOIN instances i ON
+            i.certificate = c.id AND i.recency = 1 AND i.state NOT IN ('reserved', 'archived')
+        GROUP BY c.id, c.name, c.type, c.disabled, c.authorized_until
+), plan AS (        -- an issued instance, expiring too early to replace the deployed one, is deleted
+    SELECT s.*, p.*,
+            CASE WHEN s.issued_not_after < s.deployed_not_after + p.mail_ahead
+                THEN s.issued_id END AS obsolete_issued_id,
+            CASE WHEN s.issued_not_after < s.deployed_not_after + p.mail_ahead
+                THEN NULL ELSE s.issued_id END AS usable_issued_id,
+            s.deployed_id IS NULL OR p.now >= s.deployed_not_after - INTERVAL '1 day' AS replace_deployed
+        FROM params p, states s
+)
+"""
+
+# (cert name, instance row_id or NULL, action) of all pending actions of a list of certs.
+q_planned_actions = q_plan + """
+SELECT c.name, i.id, 'delete' AS action
+    FROM instances i, certs c
+    WHERE i.certificate = c.id AND (i.state IN ('reserved', 'archived') OR i.recency > 1)
+UNION ALL
+SELECT c.name, i.id, 'archive'
+    FROM instances i, certs c
+    WHERE i.certificate = c.id AND i.state = 'expired' AND i.recency = 1
+UNION ALL
+SELECT c.name, i.id, 'expire'
+    FROM params p, instances i, certs c
+    WHERE i.certificate = c.id AND i.state IN ('issued', 'prepublished') AND i.recency = 1 AND
+        p.now >= i.not_after + INTERVAL '1 day'
+UNION ALL
+SELECT name, obsolete_issued_id, 'delete'
+    FROM plan
+    WHERE obsolete_issued_id IS NOT NULL
+UNION ALL
+SELECT name, deployed_id, 'mail'
+    FROM plan
+    WHERE deployed_id IS NOT NULL AND type = 'local' AND authorized_until IS NULL AND
+        now >= deployed_not_after - mail_ahead
+UNION ALL
+SELECT name, coalesce(prepublished_id, usable_issued_id), 'distribute'
+    FROM plan
+    WHERE NOT disabled AND replace_deployed AND coalesce(prepublished_id, usable_issued_id) IS NOT NULL
+UNION ALL
+SELECT name, deployed_id, 'expire'
+    FROM plan
+    WHERE NOT disabled AND replace_deployed AND deployed_id IS NOT NULL
+UNION ALL
+SELECT name, NULL, 'issue'
+    FROM plan
+    WHERE NOT disabled AND replace_deployed AND type = 'LE' AND
+        coalesce(prepublished_id, usable_issued_id) IS NULL
+UNION ALL
+SELECT name, usable_issued_id, CASE WHEN usable_issued_id IS NULL THEN 'issue' ELSE 'prepublish' END
+    FROM plan
+    WHERE NOT disabled AND NOT replace_deployed AND type = 'LE' AND prepublished_id IS NULL AND
+        now >= deployed_not_after - prepublish_ahead
+ORDER BY 1, 2
+"""
+
+# Store earliest point in time after now, where one of the rules of q_planned_actions may fire,
+# for a list of certs without pending actions. 'infinity' if none.
+q_store_next_action_at = q_plan + """
+UPDATE Certificates c
+    SET next_action_at = n.next_action_at
+    FROM (
+        SELECT c.id, coalesce(min(t.at), 'infinity') AS next_action_at
+            FROM certs c
+            CROSS JOIN params p
+            LEFT JOIN instances i ON
+                i.certificate = c.id AND i.recency = 1 AND i.state IN ('issued', 'prepublished', 'deployed')
+            LEFT JOIN LATERAL (VALUES
+                    (i.not_after - p.prepublish_ahead),
+                    (i.not_after - p.mail_ahead),
+                    (i.not_after - INTERVAL '1 day'),
+                    (i.not_after + INTERVAL '1 day')
+                ) t(at) ON t.at > p.now
+            GROUP BY c.id
+    ) n
+    WHERE c.id = n.id
+"""
+
+# names of certs, whose next_action_at is unknown or reached
+q_names_due = """
+SELECT s.name::TEXT
+    FROM Certificates c, Subjects s
+    WHERE
+        s.certificate = c.id AND
+        NOT s.isaltname AND
+        (c.next_action_at IS NULL OR c.next_action_at <= $1::TIMESTAMP)
+"""
+
+# deltas, next_action_at of all certs was computed with
+q_select_next_action_deltas = """
+SELECT prePublishTimedelta, localIssueMailTimedelta FROM Revision WHERE id = 1
+"""
+
+# record new deltas and reset next_action_at of all certs
+q_reset_next_action_at = """
+WITH r AS (
+    UPDATE Revision SET prePublishTimedelta = $1::INT, localIssueMailTimedelta = $2::INT WHERE id = 1
+)
+UPDATE Certificates SET next_action_at = NULL WHERE next_action_at IS NOT NULL
+"""
+
+# postpone next evaluation of certs acted on
+q_postpone_next_action_at = """
+UPDATE Certificates c
+    SET next_action_at = $2::TIMESTAMP
+    FROM Subjects s
+    WHERE
+        s.certificate = c.id AND
+        NOT s.isaltname AND
+        s.name = ANY($1::TEXT[])
+"""
+
+ps_planned_actions = None
+ps_store_next_action_at = None
+ps_names_due = None
+ps_select_next_action_deltas = None
+ps_reset_next_action_at = None
+ps_postpone_next_action_at = None
+
+# certs acted on by scheduleCerts are not evaluated again before this
+postpone_after_action = timedelta(hours=1)
+
 
 # ---------------  public functions  --------------
 
+def plan_actions(db: db_conn,
+                 names: List[str],
+                 explicit_names: Iterable[str] = ()) -> Dict[str, List[Tuple[Optional[int], Action]]]:
+    """
+    Find the actions scheduleCerts would take, with one query and without loading any cert meta.
+    Used to load and schedule only certs with pending actions.
+    Only certs, whose next_action_at is unknown or reached, and explicit_names are considered.
+    For those without pending actions, next_action_at is computed and stored (unless --check-only).
+    If PRE_PUBLISH_TIMEDELTA or LOCAL_ISSUE_MAIL_TIMEDELTA differ from those, next_action_at was
+    computed with, all certs are considered and next_action_at of all certs is reset.
+    :param db: Open Database connection
+    :param names: names of certs to consider
+    :param explicit_names: names of certs to consider, even if their next_action_at is not reached
+    :return: dict with cert name as key and list of tuples (instance row_id or None, action) as value,
+                containing only certs with pending actions
+    """
+    global ps_planned_actions, ps_store_next_action_at, ps_names_due
+    global ps_select_next_action_deltas, ps_reset_next_action_at
+
+    (DBAccount, Misc, Pathes, X509atts) = get_config()
+    opts = get_options()
+
+    if not ps_planned_actions:
+        ps_planned_actions = db.prepare(q_planned_actions)
+    if not ps_store_next_action_at:
+        ps_store_next_action_at = db.prepare(q_store_next_action_at)
+    if not ps_names_due:
+        ps_names_due = db.prepare(q_names_due)
+    if not ps_select_next_action_deltas:
+        ps_select_next_action_deltas = db.prepare(q_select_next_action_deltas)
+    if not ps_reset_next_action_at:
+        ps_reset_next_action_at = db.prepare(q_reset_next_action_at)
+
+    now = datetime.utcnow()
+    deltas = (Misc.PRE_PUBLISH_TIMEDELTA, Misc.LOCAL_ISSUE_MAIL_TIMEDELTA)
+    planned = {}
+    with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+        if tuple(ps_select_next_action_deltas.first()) != deltas:
+            sli('PRE_PUBLISH_TIMEDELTA or LOCAL_ISSUE_MAIL_TIMEDELTA changed, considering all certs')
+            if not opts.check_only:
+                ps_reset_next_action_at(*deltas)
+            due_names = list(names)
+        else:
+            due = set(row[0] for row in ps_names_due(now)) | set(explicit_names)
+            due_names = [name for name in names if name in due]
+        for (name, row_id, action) in ps_planned_actions(due_names,
+                                                         now,
+                                                         Misc.PRE_PUBLISH_TIMEDELTA,
+                                                         Misc.LOCAL_ISSUE_MAIL_TIMEDELTA):
+            planned.setdefault(name, []).append((row_id, Action[action]))
+            sld('Planned {} of {}:{}'.format(action, name, row_id))
+        if not opts.check_only:
+            ps_store_next_action_at([name for name in due_names if name not in planned],
+                                    now,
+                                    Misc.PRE_PUBLISH_TIMEDELTA,
+                                    Misc.LOCAL_ISSUE_MAIL_TIMEDELTA)
+    sli('{} of {} certs due, {} have pending actions'.format(len(due_names), len(names), len(planned)))
+    return planned
+
+
 def scheduleCerts(db: db_conn, cert_metas: Dict[str, cert.Certificate]) -> None:
     """
     Schedule state transitions and do related actions of CertInstances
@@ -70,20 +290,38 @@ def scheduleCerts(db: db_conn, cert_metas: Dict[str, cert.Certificate]) -> None:
     (DBAccount, Misc, Pathes, X509atts) = get_config()
     opts = get_options()
 
-    def issue(cm: cert.Certificate) -> Optional[cert.CertInstance]:
+    to_be_issued = []   # list of tuples (cert meta, continuation to be called with ci of new cert or None)
+    to_be_distributed = []  # list of tuples (cert meta, ci, state of ci)
+    to_be_prepublished = []  # list of tuples (cert meta, ci), whose TLSAs are queued for DNS update
+
+    def issue(cm: cert.Certificate, then: Callable[[cert.Certificate, Optional[cert.CertInstance]], None]) -> None:
         """
-        If cert type is 'LE', issue a Letsencrypt cert
+        If cert type is 'LE', queue cm for issue of a Letsencrypt cert.
+        Queued certs are issued after all cert metas have been scheduled, concurrently with --parallel.
         :param cm: cert meta
-        :return: ci of new cert or None
+        :param then: continuation, called with cm and ci of new cert or None after issue
+        :return:
         """
         if cm.cert_type == cert.CertType('local'):
-            return None
+            return
         if opts.check_only:
             sld('Would issue {}.'.format(cm.name))
             return
         if not cm.disabled:
             sli('Requesting issue from LE for {}'.format(cm.name))
-            return issue_LE_cert(cm)
+            to_be_issued.append((cm, then))
+
+    def distribute_issued(cm: cert.Certificate, ci: Optional[cert.CertInstance]) -> None:
+        if ci: distribute(cm, ci, cert.CertState('issued'))
+
+    def prepublish_issued(cm: cert.Certificate, active_ci: cert.CertInstance,
+                          ci: Optional[cert.CertInstance]) -> None:
+        if not ci:
+            sln('Failed to issue cert for prepublishing of {}'.format(cm.name))
+            return
+        sld('scheduleCerts will call prepublish with deployed_ci={}, ci={}'.format(
+            str(active_ci), str(ci)))
+        prepublish(cm, active_ci, ci)  # and prepublish it
 
     def prepublish(cm: cert.Certificate, active_ci: cert.CertInstance, new_ci: cert.CertInstance) -> None:
         """
@@ -101,23 +339,24 @@ def scheduleCerts(db: db_conn, cert_metas: Dict[str, cert.Certificate]) -> None:
         sli('Prepublishing {}:{}:{}'.
             format(cm.name, active_ci.row_id, new_ci.row_id))
         distribute_tlsa_rrs(cm, hashes)
-        new_ci.state = cert.CertState('prepublished')
-        cm.save_instance(new_ci)
+        to_be_prepublished.append((cm, new_ci))
 
     def distribute(cm: cert.Certificate, ci: cert.CertInstance, state: cert.CertState):
+        """
+        Queue ci for distribution. Queued certs are distributed after all cert metas have been
+        scheduled and all certs have been issued, by one deployCerts, which serves their disthosts
+        concurrently with --parallel (files of one disthost are distributed in order by one worker).
+        :param cm: cert meta
+        :param ci: cert instance to distribute
+        :param state: current state of ci
+        :return:
+        """
         if opts.check_only:
             sld('Would distribute {}.'.format(ci.row_id))
             return
         sli('Distributing {}:{}'.
             format(cm.name, ci.row_id))
-        cm_dict = {cm.name: cm}
-        try:
-            deployCerts(cm_dict, (ci,), allowed_states=(state,))
-        except Exception:
-            sln('Skipping distribution of cert {} because {} [{}]'.format(
-                cm.name,
-                sys.exc_info()[0].__name__,
-                str(sys.exc_info()[1])))
+        to_be_distributed.append((cm, ci, state))
 
     def expire(cm, ci):
         if opts.check_only:
@@ -137,96 +376,106 @@ def scheduleCerts(db: db_conn, cert_metas: Dict[str, cert.Certificate]) -> None:
         ci.state = cert.CertState('archived')
         cm.save_instance(ci)
 
-    for cm in cert_metas.values():
-
-        sld('{} {} ------------------------------'.format(
-            cm.name,
-            'DISABLED' if cm.disabled else ''))
-        if cm.subject_type in (cert.SubjectType('CA'),cert.SubjectType('reserved')): continue
+    with cert.UnitOfWork(db):    # state transitions are written at end of scheduling
+        for cm in cert_metas.values():
 
-        issued_ci = None
-        prepublished_ci = None
-        deployed_ci = None
+            sld('{} {} ------------------------------'.format(
+                cm.name,
+                'DISABLED' if cm.disabled else ''))
+            if cm.subject_type in (cert.SubjectType('CA'),cert.SubjectType('reserved')): continue
 
-        surviving = _find_to_be_deleted(cm)
+            issued_ci = None
+            prepublished_ci = None
+            deployed_ci = None
 
-        if not surviving:
-            ci = issue(cm)
-            if ci: distribute(cm, ci, cert.CertState('issued'))
-            continue
+            surviving = _find_to_be_deleted(cm)
 
-        for ci in surviving:
-            if ci.state == cert.CertState('expired'):
-                archive(cm, ci)
+            if not surviving:
+                issue(cm, distribute_issued)
                 continue
-            if datetime.utcnow() >= (ci.not_after + timedelta(days=1)):
-                if ci.state != cert.CertState('deployed'):
-                    expire(cm, ci)
+
+            for ci in surviving:
+                if ci.state == cert.CertState('expired'):
+                    archive(cm, ci)
+                    continue
+                if datetime.utcnow() >= (ci.not_after + timedelta(days=1)):
+                    if ci.state != cert.CertState('deployed'):
+                        expire(cm, ci)
+                    continue
+                elif ci.state == cert.CertState('issued'):
+                    issued_ci = ci
+                elif ci.state == cert.CertState('prepublished'):
+                    prepublished_ci = ci
+                elif ci.state == cert.CertState('deployed'):
+                    deployed_ci = ci
+                else:
+                    assert (ci.state in (cert.CertState('issued'), cert.CertState('prepublished'), cert.CertState('deployed'),))
+
+            if deployed_ci and issued_ci:  # issued too old to replace deployed in future?
+                if issued_ci.not_after < (deployed_ci.not_after +
+                                          timedelta(days=Misc.LOCAL_ISSUE_MAIL_TIMEDELTA)):
+                    to_be_deleted |= set((issued_ci,))  # yes: mark for delete
+                    issued_ci = None
+                    # request issue_mail if near to expiration
+            if (deployed_ci
+                    and cm.cert_type == 'local'
+                    and not cm.authorized_until
+                    and datetime.utcnow() >= (deployed_ci.not_after -
+                                              timedelta(days=Misc.LOCAL_ISSUE_MAIL_TIMEDELTA))):
+                to_be_mailed.append(cm)
+                sld('schedule.to_be_mailed: ' + str(cm))
+
+            if cm.disabled:
                 continue
-            elif ci.state == cert.CertState('issued'):
-                issued_ci = ci
-            elif ci.state == cert.CertState('prepublished'):
-                prepublished_ci = ci
-            elif ci.state == cert.CertState('deployed'):
-                deployed_ci = ci
-            else:
-                assert (ci.state in (cert.CertState('issued'), cert.CertState('prepublished'), cert.CertState('deployed'),))
-
-        if deployed_ci and issued_ci:  # issued too old to replace deployed in future?
-            if issued_ci.not_after < (deployed_ci.not_after +
-                                      timedelta(days=Misc.LOCAL_ISSUE_MAIL_TIMEDELTA)):
-                to_be_deleted |= set((issued_ci,))  # yes: mark for delete
-                issued_ci = None
-                # request issue_mail if near to expiration
-        if (deployed_ci
-                and cm.cert_type == 'local'
-                and not cm.authorized_until
-                and datetime.utcnow() >= (deployed_ci.not_after -
-                                          timedelta(days=Misc.LOCAL_ISSUE_MAIL_TIMEDELTA))):
-            to_be_mailed.append(cm)
-            sld('schedule.to_be_mailed: ' + str(cm))
-
-        if cm.disabled:
-            continue
 
-        # deployed cert expired or no cert deployed?
-        if (not deployed_ci) or \
-                (datetime.utcnow() >= deployed_ci.not_after - timedelta(days=1)):
-            distributed = False
-            sld('scheduleCerts: no deployed cert or deployed cert'
-                'expired {}'.format(str(deployed_ci)))
-            if prepublished_ci:  # yes - distribute prepublished
-                distribute(cm, prepublished_ci, cert.CertState('prepublished'))
-                distributed = True
-            elif issued_ci:  # or issued cert?
-                distribute(cm, issued_ci, cert.CertState('issued'))  # yes - distribute it
-                distributed = True
-            if deployed_ci:
-                expire(cm, deployed_ci)  # and expire deployed cert
-            if not distributed:
-                ci = issue(cm)
-                if ci: distribute(cm, ci, cert.CertState('issued'))
-            continue
+            # deployed cert expired or no cert deployed?
+            if (not deployed_ci) or \
+                    (datetime.utcnow() >= deployed_ci.not_after - timedelta(days=1)):
+                distributed = False
+                sld('scheduleCerts: no deployed cert or deployed cert'
+                    'expired {}'.format(str(deployed_ci)))
+                if prepublished_ci:  # yes - distribute prepublished
+                    distribute(cm, prepublished_ci, cert.CertState('prepublished'))
+                    distributed = True
+                elif issued_ci:  # or issued cert?
+                    distribute(cm, issued_ci, cert.CertState('issued'))  # yes - distribute it
+                    distributed = True
+                if deployed_ci:
+                    expire(cm, deployed_ci)  # and expire deployed cert
+                if not distributed:
+                    issue(cm, distribute_issued)
+                continue
 
-        if cm.cert_type == 'local':
-            continue  # no TLSAs with local certs
-            # We have an active LE cert deployed
-        if datetime.utcnow() >= \
-                (deployed_ci.not_after - timedelta(days=Misc.PRE_PUBLISH_TIMEDELTA)):
-            # pre-publishtime reached?
-            ci = issued_ci
-            if prepublished_ci:  # yes: TLSA already pre-published?
-                continue  # yes
-            elif not issued_ci:  # do we have a cert handy?
-                ci = issue(cm)  # no: create one
-                if not ci:
-                    sln('Failed to issue cert for prepublishing of {}'.format(cm.name))
+            if cm.cert_type == 'local':
+                continue  # no TLSAs with local certs
+                # We have an active LE cert deployed
+            if datetime.utcnow() >= \
+                    (deployed_ci.not_after - timedelta(days=Misc.PRE_PUBLISH_TIMEDELTA)):
+                # pre-publishtime reached?
+                if prepublished_ci:  # yes: TLSA already pre-published?
+                    continue  # yes
+                elif not issued_ci:  # do we have a cert handy?
+                    issue(cm, lambda cm, ci, active_ci=deployed_ci: prepublish_issued(cm, active_ci, ci))  # no: create one
                     continue
-            sld('scheduleCerts will call prepublish with deployed_ci={}, ci={}'.format(
-                str(deployed_ci), str(ci)))
-            prepublish(cm, deployed_ci, ci)  # and prepublish it
+                prepublish_issued(cm, deployed_ci, issued_ci)
+
+        # end for name in cert_names
 
-    # end for name in cert_names
+        if to_be_issued:
+            new_cis = issue_LE_certs([cm for (cm, then) in to_be_issued], opts.parallel if opts.parallel else 1)
+            for (cm, then) in to_be_issued:
+                then(cm, new_cis.get(cm.name))
+
+        if to_be_distributed:
+            _distribute_all(to_be_distributed)
+
+        TLSAUpdates.flush()     # prepublished TLSAs, if not already sent by deployCerts
+        for (cm, ci) in to_be_prepublished:
+            if TLSAUpdates.failed(cm):
+                sle('DNS update of TLSA RRs of {}:{} failed. Not prepublished.'.format(cm.name, ci.row_id))
+                continue
+            ci.state = cert.CertState('prepublished')
+            cm.save_instance(ci)
 
     if opts.check_only:
         sld('Would delete and mail..')
@@ -255,9 +504,75 @@ def scheduleCerts(db: db_conn, cert_metas: Dict[str, cert.Certificate]) -> None:
         s.send_message(msg)
         s.quit()
 
+    _postpone_next_action_at(db, [cm.name for cm in cert_metas.values()])
+
 
 # ---------------  private functions  --------------
 
+def _distribute_all(to_be_distributed: List[Tuple[cert.Certificate, cert.CertInstance, cert.CertState]]) -> None:
+    """
+    Distribute cert instances of many cert metas at once.
+    Cert metas with invalid disthost configuration and instances no longer in their planned state
+    are skipped before, so they don't prevent distribution of the others.
+    If the batched distribution errors out, the instances not yet acted on are distributed
+    one cert meta at a time, so one failing cert does not prevent distribution of the others.
+    :param to_be_distributed: list of tuples (cert meta, ci, state of ci)
+    :return:
+    """
+    cert_metas = {}
+    planned_states = {}
+    for (cm, ci, state) in to_be_distributed:
+        if not check_disthosts(cm):
+            sln('Skipping distribution of cert {} because of invalid disthost configuration'.format(cm.name))
+            continue
+        if ci.state != state:
+            sln('Skipping distribution of cert {}:{} because its state changed from {} to {}'.format(
+                cm.name, ci.row_id, state, ci.state))
+            continue
+        cert_metas[cm.name] = cm
+        planned_states[ci] = state
+    if not planned_states:
+        return
+
+    try:
+        deployCerts(cert_metas, tuple(planned_states.keys()), planned_states=planned_states)
+        return
+    except Exception:
+        sln('Distributing certs one by one, because batched distribution failed with {} [{}]'.format(
+            sys.exc_info()[0].__name__,
+            str(sys.exc_info()[1])))
+
+    for cm in cert_metas.values():
+        cm_states = {ci: state for (ci, state) in planned_states.items()
+                     if ci.cm is cm and ci.state == state}
+        if not cm_states:
+            continue
+        try:
+            deployCerts({cm.name: cm}, tuple(cm_states.keys()), planned_states=cm_states)
+        except Exception:
+            sln('Skipping distribution of cert {} because {} [{}]'.format(
+                cm.name,
+                sys.exc_info()[0].__name__,
+                str(sys.exc_info()[1])))
+
+
+def _postpone_next_action_at(db: db_conn, names: List[str]) -> None:
+    """
+    Do not evaluate certs acted on before postpone_after_action has elapsed,
+    to avoid repeating failing actions with every run.
+    Any change of the certs after now invalidates this again (by DB triggers).
+    :param db: Open Database connection
+    :param names: names of certs acted on
+    :return:
+    """
+    global ps_postpone_next_action_at
+
+    if not ps_postpone_next_action_at:
+        ps_postpone_next_action_at = db.prepare(q_postpone_next_action_at)
+    with db.xact(isolation='SERIALIZABLE', mode='READ WRITE'):
+        ps_postpone_next_action_at(names, datetime.utcnow() + postpone_after_action)
+
+
 def _find_to_be_deleted(cm: cert.Certificate) -> Optional[set]:
     """
     Create set of CertInstances to be deleted.
@@ -286,14 +601,10 @@ def _find_to_be_deleted(cm: cert.Certificate) -> Optional[set]:
 
     sld('Before state loop: ' + str([i.__str__() for i in surviving]))
     for state in (cert.CertState('issued'), cert.CertState('prepublished'), cert.CertState('deployed'), cert.CertState('expired')):
-        ci_list = []
-        for ci in surviving:
-            if ci.state == state:
-                ci_list.append(ci)
-        if not ci_list:
+        sorted_list = [ci for ci in cm.instances_in_state(state) if ci in surviving]
+        if not sorted_list:
             continue
         # only the most recent (with highest row_id) survives from current state set
-        sorted_list = sorted(ci_list, key=lambda ci: ci.row_id)
         to_be_added_to_be_deleted = set(sorted_list[:-1])   # all but last to be deleted
         to_be_deleted.update(to_be_added_to_be_deleted)     # add to to_be_deleted set
         surviving = surviving - to_be_added_to_be_deleted   # remove from surviving set
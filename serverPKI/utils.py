@@ -144,6 +144,13 @@ configspec = """
     # zone update method for challenge ('ddns' or 'zone_file')
     LE_ZONE_UPDATE_METHOD = option('ddns', 'zone_file')
     
+    # zones on DNS master (default: subdirectories of zone_file_root)
+    DNS_ZONES = list(default=list())
+    
+    # max number of seconds to wait for challenges to become visible on
+    # authoritative DNS servers
+    LE_PROPAGATION_TIMEOUT = integer(min=1, default=15)
+    
     # Key size and lifetime of local CA cert
     LOCAL_CA_BITS = integer(min=3096,max=4096)
     LOCAL_CA_LIFETIME = integer(min=365)
@@ -318,6 +325,14 @@ def parse_options():
                      default=False,
                      help='Do not distribute/change TLSA resource records.')
 
+    group.add_option('--parallel', '-p', dest='parallel', action='store',
+                     type=int, default=False,
+                     help='Distribute certs to up to PARALLEL disthosts concurrently.'
+                          ' All files of one disthost are distributed in order by one worker.'
+                          ' Issue up to PARALLEL Letsencrypt certs concurrently.'
+                          ' With --schedule-actions, all certs to be distributed are'
+                          ' distributed together this way.')
+
     parser.add_option_group(group)
 
     group = optparse.OptionGroup(parser, 'Maintenance and administrative actions.')
@@ -332,6 +347,15 @@ def parse_options():
                           'Configuration parameter db_encryption_key must point '
                           'at a file, containing a usable passphrase.')
 
+    group.add_option('--rotate-db-key', dest='rotate_db_key', action='store', type='string',
+                     default=None, metavar='NEWKEYFILE',
+                     help='Re-encrypt all keys in the DB with the passphrase in NEWKEYFILE. '
+                          'Configuration parameter db_encryption_key must point '
+                          'at the file with the current passphrase. An interrupted '
+                          'rotation is resumed by repeating it with the same NEWKEYFILE. '
+                          'Until db_encryption_key has been replaced by NEWKEYFILE, '
+                          'actions using keys are refused.')
+
     group.add_option('--issue-local-CAcert', '-I', dest='issue_local_cacert', action='store_true',
                      default=False,
                      help='Issue a new local CA cert, used for issuing future '
@@ -669,21 +693,26 @@ def check_actions() -> None:
     if options.register: l.append('register')
     if options.remove_tlsas: l.append('remove_tlsas')
     if options.remaining_days: l.append('renew-local-certs')
+    if options.rotate_db_key: l.append('rotate-db-key')
     if options.schedule: l.append('schedule')
     if options.sync_disk: l.append('sync_disk')
     if options.sync_tlsas: l.append('sync_tlsas')
 
     s = set(l)
 
+    if options.parallel is not False and options.parallel < 1:
+        sle('--parallel requires a number of at least 1')
+        sys.exit(1)
+
     if len(s) > 2:
         sle('Too many actions. Only 2 actions may be combined')
         sys.exit(1)
 
     if len(s) == 2:
         if 'schedule' in s or 'extract' in s or 'issue-local-CAcert' in s or \
-                'encrypt-keys' in s or 'decrypt-keys' in s or 'register' in s:
+                'encrypt-keys' in s or 'decrypt-keys' in s or 'rotate-db-key' in s or 'register' in s:
             sle('"--schedule" or "--extract-cert-and-key" or '
-                '"--encrypt-keys" or "--decrypt-keys" or '
+                '"--encrypt-keys" or "--decrypt-keys" or "--rotate-db-key" or '
                 '"--issue-local-CAcert" or "--register" may not be combined with'
                 ' other actions.')
             sys.exit(1)
@@ -780,7 +809,7 @@ ps_names_to_be_renewed = None
 ps_certs_for_printing_insert = None
 
 q_names_to_be_renewed = """
-    SELECT S.name, I.state, I.not_before, I.not_after
+    SELECT S.name::TEXT
         FROM subjects S, certificates C, certinstances I
         WHERE
             I.state IN ('deployed', 'issued') AND
@@ -789,43 +818,31 @@ q_names_to_be_renewed = """
             c.disabled = FALSE AND
             S.type != 'CA' AND
             S.certificate = c.id AND
-            S.isaltname = FALSE;
+            S.isaltname = FALSE
+        GROUP BY S.name
+        HAVING
+            max(I.not_after) FILTER (WHERE I.state = 'deployed') < $1::TIMESTAMP AND
+            (NOT $2::BOOLEAN OR bool_or(I.state = 'issued'));
 """
 
 
-def names_of_local_certs_to_be_renewed(db: db_conn, days: int, distribute=False):
+def names_of_local_certs_to_be_renewed(db: db_conn, days: int, distribute=False) -> List[str]:
+    """
+    Obtain names of local certs, whose most recent deployed instance expires within days.
+    The aggregation per cert is done by the DB.
+    :param db: opened DB connection
+    :param days: number of days
+    :param distribute: return only those with an instance in state issued
+    :return: list of cert names
+    """
     global ps_names_to_be_renewed
 
     renew_limit = datetime.today() + timedelta(days=days)
-    distribute_limit = datetime.today() - timedelta(days=days)
 
     if not ps_names_to_be_renewed:
         ps_names_to_be_renewed = db.prepare(q_names_to_be_renewed)
 
-    deployed_names = {}
-    issued_names = {}
-
-    rows = ps_names_to_be_renewed.rows()
-    for name, state, not_before, not_after in rows:
-        if state == 'deployed':
-            if name not in deployed_names or deployed_names[name] < not_after:
-                deployed_names[name] = not_after
-        elif state == 'issued':
-            if name not in issued_names or issued_names[name] < not_before:
-                issued_names[name] = not_before
-
-    names_to_be_issued = []
-    for name, not_after in deployed_names.items():
-        if not_after < renew_limit:
-            names_to_be_issued.append(name)
-    if not distribute:
-        return names_to_be_issued
-
-    names_to_be_deployed = []
-    for name in names_to_be_issued:
-        if name in issued_names:
-            names_to_be_deployed.append(name)
-    return names_to_be_deployed
+    return [row[0] for row in ps_names_to_be_renewed(renew_limit, distribute)]
 
 
 def print_certs(db: db_conn, names) -> None:
@@ -61,6 +61,65 @@ def get_hostname():
     status, stdout = run_command('hostname')
     return stdout.strip()
 
+def insert_test_ca_cert(db_handle, name: str, remarks: str) -> None:
+    """
+    Insert a self signed CA cert meta with one issued instance (without cert key data)
+    :param db_handle:
+    :param name: name of CA cert
+    :param remarks: remarks of CA cert, to be used with delete_test_certs
+    :return:
+    """
+    db_handle.execute("""
+    INSERT INTO Certificates(type, remarks) VALUES ('local', '{remarks}-new');
+    INSERT INTO Subjects(type, name, isAltName, certificate)
+        SELECT 'CA', '{name}', FALSE, id FROM Certificates WHERE remarks = '{remarks}-new';
+    WITH n AS (SELECT nextval('certinstances_id_seq') AS id)
+        INSERT INTO CertInstances(id, certificate, state, cacert)
+            SELECT n.id, c.id, 'issued', n.id FROM n, Certificates c WHERE c.remarks = '{remarks}-new';
+    UPDATE Certificates SET remarks = '{remarks}-ca' WHERE remarks = '{remarks}-new'""".format(
+        name=name, remarks=remarks))
+
+def insert_test_cert(db_handle,
+                     name: str,
+                     cert_type: str,
+                     instances: typing.Iterable[tuple],
+                     remarks: str,
+                     ca_name: str) -> typing.List[int]:
+    """
+    Insert a server cert meta with instances (without cert key data)
+    :param db_handle:
+    :param name: name of cert
+    :param cert_type: 'LE' or 'local'
+    :param instances: iterable of tuples (state, not_before, not_after)
+    :param remarks: remarks of cert, to be used with delete_test_certs
+    :param ca_name: name of CA cert, inserted with insert_test_ca_cert
+    :return: list of row ids of instances, in order of instances
+    """
+    cert_id = db_handle.prepare("""
+    INSERT INTO Certificates(type, remarks) VALUES ($1::TEXT::dd.cert_type, $2::TEXT) RETURNING id""").first(
+        cert_type, remarks)
+    db_handle.prepare("""
+    INSERT INTO Subjects(type, name, isAltName, certificate)
+        VALUES ('server', $1::TEXT::citext, FALSE, $2::INT)""")(name, cert_id)
+    ca_id = db_handle.prepare("""
+    SELECT i.id FROM CertInstances i, Subjects s
+        WHERE i.certificate = s.certificate AND s.name = $1::TEXT::citext""").first(ca_name)
+    ps = db_handle.prepare("""
+    INSERT INTO CertInstances(certificate, state, cacert, not_before, not_after)
+        VALUES ($1::INT, $2::TEXT::dd.cert_state, $3::INT, $4::TIMESTAMP, $5::TIMESTAMP) RETURNING id""")
+    return [ps.first(cert_id, state, ca_id, not_before, not_after) for (state, not_before, not_after) in instances]
+
+def delete_test_certs(db_handle, remarks: str) -> None:
+    """
+    Delete cert metas inserted by insert_test_ca_cert and insert_test_cert
+    :param db_handle:
+    :param remarks: remarks of certs
+    :return:
+    """
+    db_handle.execute("""
+    DELETE FROM certificates WHERE remarks = '{remarks}';
+    DELETE FROM certificates WHERE remarks = '{remarks}-ca'""".format(remarks=remarks))
+
 def delete_and_cleanup_local_cert(allow_empty: bool, db_handle):
 
     result = db_handle.query.first("""
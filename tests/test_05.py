@@ -6,7 +6,7 @@ from postgresql import driver as db_conn
 from serverPKI.utils import Misc, Pathes
 
 from .conftest import (get_hostname, run_command, setup_directories, config_path_for_pytest, TEMP_DIR,
-                        insert_local_cert_meta, delete_and_cleanup_local_cert)
+                        insert_local_cert_meta, delete_and_cleanup_local_cert, insert_test_cert, delete_test_certs)
 from .parameters import CLIENT_CERT_1, TEST_PLACE_1, CA_CERT_PASS_PHASE
 
 
@@ -98,3 +98,48 @@ def test_distribute_local_cert(script_runner, setup_directories):
     assert rc==0
     print(stdout)
     assert stdout.strip()=='RSA key ok'
+
+
+BULK_CERTS = ('bulk1.example.com', 'bulk2.example.com')
+BULK_REMARKS = 'bulk'
+
+
+def test_issue_local_certs_in_bulk(db_handle, monkeypatch, script_runner):
+    """
+    Given:  A CA cert in DB
+    And:    Cert metas of two local certs without instances in DB
+    When:   operate_serverPKI --create-certs is run for both
+    Then:   Each of them gets one issued instance with cert and key, signed by the local CA cert
+    :param db_handle:
+    :param monkeypatch:
+    :param script_runner:
+    :return:
+    """
+
+    def mock_getpass(prompt: str):
+        return CA_CERT_PASS_PHASE
+
+    monkeypatch.setattr(getpass, 'getpass', mock_getpass)
+
+    delete_test_certs(db_handle, BULK_REMARKS)
+    for name in BULK_CERTS:
+        insert_test_cert(db_handle, name, 'local', (), BULK_REMARKS, Misc.SUBJECT_LOCAL_CA)
+
+    ret = script_runner.run('operate_serverPKI', '--create-certs', '-o', BULK_CERTS[0], '-o', BULK_CERTS[1],
+                            '-d', '-f', config_path_for_pytest)
+    assert ret.success
+
+    rows = db_handle.prepare("""
+    SELECT s.name, i.state, ca.name AS ca_name, count(k.id) AS keys
+        FROM Certificates c
+            JOIN Subjects s ON s.certificate = c.id
+            JOIN CertInstances i ON i.certificate = c.id
+            JOIN Subjects ca ON ca.certificate = (SELECT certificate FROM CertInstances WHERE id = i.cacert)
+            LEFT JOIN CertKeyData k ON k.certinstance = i.id
+        WHERE c.remarks = $1::TEXT
+        GROUP BY s.name, i.id, i.state, ca.name
+        ORDER BY s.name""")(BULK_REMARKS)
+    assert [(row['name'], row['state'], row['ca_name'], row['keys']) for row in rows] == [
+        (name, 'issued', Misc.SUBJECT_LOCAL_CA, 1) for name in BULK_CERTS]
+
+    delete_test_certs(db_handle, BULK_REMARKS)
@@ -1,12 +1,23 @@
 import sys, os, pty
 import getpass
+import hashlib
+from datetime import datetime, timedelta
 from pathlib import Path
 from postgresql import driver as db_conn
 
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import (BestAvailableEncryption, Encoding, PrivateFormat,
+                                                          load_pem_private_key)
+
+from serverPKI import cert
+from serverPKI.cert import DB_Encryption, check_db_key_rotation, read_db_encryption_key, rotate_db_key
 from serverPKI.utils import Misc, Pathes
 
 from .conftest import (get_hostname, run_command, setup_directories, config_path_for_pytest, TEMP_DIR,
-                        insert_local_cert_meta, delete_and_cleanup_local_cert)
+                        insert_local_cert_meta, delete_and_cleanup_local_cert,
+                        insert_test_ca_cert, insert_test_cert, delete_test_certs)
 from .parameters import CLIENT_CERT_1, TEST_PLACE_1, CA_CERT_PASS_PHASE
 
 
@@ -98,3 +109,105 @@ def test_encrypt_keys_encryption_key_available(script_runner, setup_directories)
     assert rc==0
     print(stdout)
     assert stdout.strip()=='RSA key ok'
+
+
+ROTATE_CA = 'rotate-ca.example.com'
+ROTATE_REMARKS = 'rotate'
+
+
+class _Interrupted(Exception):
+    pass
+
+
+def _insert_keys(db_handle, password: bytes) -> list:
+    """
+    Insert a cert with 3 instances, each with an ec key encrypted with password
+    :return: list of row ids of the cert key data
+    """
+    delete_test_certs(db_handle, ROTATE_REMARKS)
+    insert_test_ca_cert(db_handle, ROTATE_CA, ROTATE_REMARKS)
+    now = datetime.utcnow()
+    instance_ids = insert_test_cert(db_handle, 'rotate.example.com', 'local',
+                                    [('issued', now, now + timedelta(days=1))] * 3, ROTATE_REMARKS, ROTATE_CA)
+    ps = db_handle.prepare("""
+    INSERT INTO CertKeyData(certinstance, encryption_algo, cert, key, hash)
+        VALUES ($1::INT, 'ec', 'synthetic', $2, $3) RETURNING id""")
+    return [ps.first(ci_id,
+                     ec.generate_private_key(ec.SECP256R1(), default_backend()).private_bytes(
+                         Encoding.PEM, PrivateFormat.TraditionalOpenSSL, BestAvailableEncryption(password)),
+                     'rotate-{}'.format(ci_id))
+            for ci_id in instance_ids]
+
+
+def _decryptable_with(db_handle, cks_ids: list, password: bytes) -> list:
+    result = []
+    for key in db_handle.prepare("SELECT key FROM CertKeyData WHERE id = ANY($1::INT[]) ORDER BY id")(cks_ids):
+        try:
+            load_pem_private_key(bytes(key[0]), password=password, backend=default_backend())
+            result.append(True)
+        except (TypeError, ValueError):
+            result.append(False)
+    return result
+
+
+def _rotation(db_handle) -> tuple:
+    return tuple(db_handle.prepare("SELECT keysRotatedUntil, rotationKeyHash FROM Revision WHERE id = 1").first())
+
+
+def test_rotate_db_key_resumes_interrupted_rotation(db_handle, monkeypatch, tmp_path):
+    """
+    Given:  Keys in DB encrypted with the DB encryption key
+    When:   A rotation to a new key is interrupted after the first chunk
+    Then:   Progress up to the first chunk is recorded
+    And:    Rotating to another key and scheduling are refused
+    And:    Repeating the rotation with the same key resumes and re-encrypts all keys
+    And:    Scheduling is allowed again, after the new key has been configured
+    :param db_handle:
+    :param monkeypatch:
+    :param tmp_path:
+    :return:
+    """
+    assert read_db_encryption_key(db_handle)
+    old_key = DB_Encryption.key
+    new_key_file = tmp_path / 'new_key'
+    new_key_file.write_bytes(b'new DB encryption key')
+    other_key_file = tmp_path / 'other_key'
+    other_key_file.write_bytes(b'other DB encryption key')
+    cks_ids = _insert_keys(db_handle, old_key)
+
+    recrypt_all_keys = cert.recrypt_all_keys
+
+    def interrupted_recrypt_all_keys(db, old_password, new_password, start_after=0, on_chunk=None):
+        def interrupting_on_chunk(last_id):
+            if last_id > cks_ids[0]:
+                raise _Interrupted()
+            on_chunk(last_id)
+        return recrypt_all_keys(db, old_password, new_password, start_after=start_after, chunk_size=1,
+                                on_chunk=interrupting_on_chunk)
+
+    monkeypatch.setattr(cert.os, 'cpu_count', lambda: 1)
+    monkeypatch.setattr(cert, 'recrypt_all_keys', interrupted_recrypt_all_keys)
+    try:
+        with pytest.raises(_Interrupted):
+            rotate_db_key(db_handle, str(new_key_file))
+        assert _rotation(db_handle) == (cks_ids[0], hashlib.sha256(b'new DB encryption key').hexdigest())
+        assert _decryptable_with(db_handle, cks_ids, b'new DB encryption key') == [True, False, False]
+        assert _decryptable_with(db_handle, cks_ids, old_key) == [False, True, True]
+
+        assert not rotate_db_key(db_handle, str(other_key_file))
+        assert not check_db_key_rotation(db_handle)
+
+        monkeypatch.setattr(cert, 'recrypt_all_keys', recrypt_all_keys)
+        assert rotate_db_key(db_handle, str(new_key_file))
+        assert _decryptable_with(db_handle, cks_ids, b'new DB encryption key') == [True, True, True]
+        assert _rotation(db_handle) == (None, hashlib.sha256(b'new DB encryption key').hexdigest())
+
+        DB_Encryption.key = old_key                 # key file not yet replaced
+        assert not check_db_key_rotation(db_handle)
+
+        Path(Pathes.db_encryption_key).write_bytes(b'new DB encryption key')
+        assert read_db_encryption_key(db_handle)
+        assert check_db_key_rotation(db_handle)
+        assert _rotation(db_handle) == (None, None)
+    finally:
+        delete_test_certs(db_handle, ROTATE_REMARKS)
@@ -0,0 +1,328 @@
+import datetime
+from pathlib import Path
+import subprocess
+import sys
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+
+import pytest
+
+from serverPKI.cert import (Certificate, CertInstance, CertKeyStore, DistHost, Jail, Place, UnitOfWork,
+                            init_module_cert)
+from .conftest import insert_test_ca_cert, insert_test_cert, delete_test_certs
+
+
+BENCH_CA = 'bench-ca.example.com'
+BENCH_CERTS = 3
+BENCH_INSTANCES_PER_CERT = 4
+
+
+def _synthetic_certs(count: int):
+    """
+    Create count distinct (but otherwise identical) certs, signed by one throw away ec key
+    :param count: number of certs
+    :return: generator of PEM encoded certs
+    """
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'bench.example.com')])
+    now = datetime.datetime.utcnow()
+    for i in range(count):
+        yield x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+            key.public_key()).serial_number(i + 1).not_valid_before(now).not_valid_after(
+            now + datetime.timedelta(days=1)).sign(key, hashes.SHA256(), default_backend()).public_bytes(Encoding.PEM)
+
+
+def delete_synthetic_certs(db_handle) -> None:
+
+    db_handle.execute("""
+    DELETE FROM certificates WHERE remarks = 'bench';
+    DELETE FROM certificates WHERE id in (SELECT certificate FROM subjects WHERE name = '{}')""".format(BENCH_CA))
+
+
+def insert_synthetic_certs(db_handle) -> list:
+    """
+    Insert a CA cert and BENCH_CERTS server certs with BENCH_INSTANCES_PER_CERT instances each,
+    with one cert key data row per instance.
+    :param db_handle:
+    :return: list of names of server certs
+    """
+
+    delete_synthetic_certs(db_handle)
+
+    db_handle.execute("""
+    INSERT INTO Certificates(type, remarks) VALUES ('local', 'bench-ca');
+    INSERT INTO Subjects(type, name, isAltName, certificate)
+        SELECT 'CA', '{}', FALSE, id FROM Certificates WHERE remarks = 'bench-ca';
+    WITH n AS (SELECT nextval('certinstances_id_seq') AS id)
+        INSERT INTO CertInstances(id, certificate, state, cacert)
+            SELECT n.id, c.id, 'issued', n.id FROM n, Certificates c WHERE c.remarks = 'bench-ca';
+    UPDATE Certificates SET remarks = NULL WHERE remarks = 'bench-ca';
+
+    INSERT INTO Certificates(type, remarks)
+        SELECT 'local', 'bench' FROM generate_series(1, {});
+    INSERT INTO Subjects(type, name, isAltName, certificate)
+        SELECT 'server', 'bench' || id || '.example.com', FALSE, id FROM Certificates WHERE remarks = 'bench';
+    INSERT INTO CertInstances(certificate, state, cacert, not_before, not_after)
+        SELECT c.id, 'expired', ca.id, now() - interval '90 days', now() - interval '1 day'
+            FROM Certificates c, generate_series(1, {}),
+                (SELECT i.id FROM CertInstances i, Subjects s
+                    WHERE i.certificate = s.certificate AND s.name = '{}') ca
+            WHERE c.remarks = 'bench'""".format(BENCH_CA, BENCH_CERTS, BENCH_INSTANCES_PER_CERT, BENCH_CA))
+
+    instance_ids = [row[0] for row in db_handle.prepare("""
+    SELECT i.id FROM CertInstances i, Certificates c
+        WHERE i.certificate = c.id AND c.remarks = 'bench' ORDER BY i.id""")()]
+    ps = db_handle.prepare("""
+    INSERT INTO CertKeyData(certinstance, encryption_algo, cert, key, hash)
+        VALUES ($1::INT, 'ec', $2, 'synthetic', $3)""")
+    with db_handle.xact():
+        ps.load_rows((ci_id, pem, str(ci_id))
+                     for (ci_id, pem) in zip(instance_ids, _synthetic_certs(len(instance_ids))))
+
+    return [row[0] for row in db_handle.prepare("""
+    SELECT s.name::TEXT FROM Subjects s, Certificates c
+        WHERE s.certificate = c.id AND c.remarks = 'bench'""")()]
+
+
+@pytest.fixture
+def synthetic_certs(db_handle):
+    """
+    BENCH_CERTS synthetic server certs with BENCH_INSTANCES_PER_CERT instances each
+    """
+    names = insert_synthetic_certs(db_handle)
+    init_module_cert()
+    yield names
+    init_module_cert()
+    delete_synthetic_certs(db_handle)
+
+
+def test_load_many_of_synthetic_certs(db_handle, synthetic_certs):
+    """
+    Given:  A DB with synthetic certs, each with some cert instances
+    When:   All cert metas are loaded with Certificate.load_many
+    Then:   Each cert meta should have all its instances, each with its cert key store
+    :param db_handle:
+    :param synthetic_certs:
+    :return:
+    """
+    assert len(synthetic_certs) == BENCH_CERTS
+
+    cms = Certificate.load_many(db_handle, synthetic_certs)
+
+    assert sorted(cms.keys()) == sorted(synthetic_certs)
+    for cm in cms.values():
+        assert len(cm.cert_instances) == BENCH_INSTANCES_PER_CERT
+        for ci in cm.cert_instances:
+            assert ci.cm is cm
+            assert ci.state == 'expired'
+            assert len(ci.cksd) == 1
+    instances = [ci for cm in cms.values() for ci in cm.cert_instances]
+    assert len(CertKeyStore._cert_key_stores) == len(instances)
+
+
+def test_loaded_objects_are_slotted(db_handle, synthetic_certs):
+    """
+    Given:  A DB with synthetic certs
+    When:   Cert metas are loaded with Certificate.load_many
+    Then:   Cert metas, cert instances and cert key stores should have no __dict__
+    :param db_handle:
+    :param synthetic_certs:
+    :return:
+    """
+    cms = Certificate.load_many(db_handle, synthetic_certs)
+
+    cm = cms[synthetic_certs[0]]
+    ci = cm.cert_instances[0]
+    cks = next(iter(ci.cksd.values()))
+    for obj in (cm, ci, cks):
+        assert not hasattr(obj, '__dict__'), type(obj).__name__
+
+
+def test_config_objects_are_slotted():
+    """
+    Given:  A place, a jail and a disthost
+    When:   They are created
+    Then:   They should have no __dict__
+    :return:
+    """
+    for obj in (Place(name='bench'), Jail('bench'), DistHost('bench.example.com')):
+        assert not hasattr(obj, '__dict__'), type(obj).__name__
+
+
+class _CertMeta(object):
+    name = 'cache.example.com'
+    cert_type = 'local'
+
+
+class _CertInstance(object):
+    cm = _CertMeta()
+    row_id = 1
+
+    def __init__(self):
+        self.cksd = {}
+
+
+def _key_store(row_id: int) -> CertKeyStore:
+    """
+    A cert key store with an (encrypted) key, which is not registered and not in DB
+    """
+    cks = CertKeyStore.__new__(CertKeyStore)
+    cks.ci = _CertInstance()
+    cks.algo = 'rsa'
+    cks.row_id = row_id
+    cks._cert = b''
+    cks._key = 'key-{}'.format(row_id).encode('ascii')
+    cks.hash = 'cache-{}'.format(row_id)
+    return cks
+
+
+@pytest.fixture
+def decrypted(monkeypatch):
+    """
+    Count decryptions of keys, using a key cache with 2 entries
+    """
+    decrypted = []
+
+    def _decrypt_key(self, encrypted_key_bytes):
+        decrypted.append(self.row_id)
+        return b'clear-' + encrypted_key_bytes
+
+    monkeypatch.setattr(CertKeyStore, '_decrypt_key', _decrypt_key)
+    monkeypatch.setattr(CertKeyStore, 'max_decrypted_keys', 2)
+    CertKeyStore.clear_key_cache()
+    yield decrypted
+    CertKeyStore.clear_key_cache()
+
+
+def test_key_cache_evicts_least_recently_used(decrypted):
+    """
+    Given:  A key cache with 2 entries
+    When:   3 keys are used, the first one again before the third one
+    Then:   Each key should be decrypted once
+    And:    The key used least recently should be evicted
+    :param decrypted:
+    :return:
+    """
+    cks = [_key_store(row_id) for row_id in (1, 2, 3)]
+
+    assert cks[0].key == 'clear-key-1'
+    assert cks[1].key == 'clear-key-2'
+    assert cks[0].key == 'clear-key-1'
+    assert cks[2].key == 'clear-key-3'
+    assert decrypted == [1, 2, 3]
+    assert list(CertKeyStore._decrypted_keys.keys()) == [1, 3]
+
+    assert cks[1].key == 'clear-key-2'
+    assert decrypted == [1, 2, 3, 2]
+
+
+def test_key_cache_evicts_saved_key(decrypted, monkeypatch):
+    """
+    Given:  A cached decrypted key
+    When:   Its cert key store is saved
+    Then:   The key should be decrypted again, when used next
+    :param decrypted:
+    :param monkeypatch:
+    :return:
+    """
+    monkeypatch.setattr(UnitOfWork, 'depth', 1)              # defer the DB update
+    monkeypatch.setattr(UnitOfWork, 'dirty_key_stores', {})
+    cks = _key_store(1)
+
+    assert cks.key == 'clear-key-1'
+    cks._key = b'new-key-1'
+    cks._save()
+    assert UnitOfWork.dirty_key_stores == {1: cks}
+    assert cks.key == 'clear-new-key-1'
+    assert decrypted == [1, 1]
+
+
+UOW_CA = 'uow-ca.example.com'
+UOW_CERTS = ('uow1.example.com', 'uow2.example.com')
+UOW_REMARKS = 'uow'
+
+
+@pytest.fixture
+def uow_certs(db_handle):
+    """
+    Certs with one issued instance each, as dict with cert name as key and instance row id as value
+    """
+    now = datetime.datetime.utcnow()
+    delete_test_certs(db_handle, UOW_REMARKS)
+    insert_test_ca_cert(db_handle, UOW_CA, UOW_REMARKS)
+    row_ids = {name: insert_test_cert(db_handle, name, 'LE',
+                                      (('issued', now - datetime.timedelta(days=1),
+                                        now + datetime.timedelta(days=89)),),
+                                      UOW_REMARKS, UOW_CA)[0]
+               for name in UOW_CERTS}
+    init_module_cert()
+    yield row_ids
+    init_module_cert()
+    delete_test_certs(db_handle, UOW_REMARKS)
+
+
+def _states_in_db(db_handle, row_ids: dict) -> dict:
+    return {row[0]: row[1] for row in db_handle.prepare("""
+        SELECT id, state::TEXT FROM CertInstances WHERE id = ANY($1::INT[])""")(list(row_ids.values()))}
+
+
+def test_unit_of_work_defers_instance_updates(db_handle, uow_certs, monkeypatch):
+    """
+    Given:  Certs with one issued instance each
+    When:   Their states are changed and saved (one of them twice) inside nested units of work
+    Then:   The rows should be unchanged until the outermost unit of work exits
+    And:    They should be updated then with one flush, which writes each instance once
+    :param db_handle:
+    :param uow_certs:
+    :param monkeypatch:
+    :return:
+    """
+    flushed = []
+    flush = UnitOfWork.flush
+
+    def counting_flush():
+        flushed.append(len(UnitOfWork.dirty_instances))
+        flush()
+
+    monkeypatch.setattr(UnitOfWork, 'flush', staticmethod(counting_flush))
+    cms = Certificate.load_many(db_handle, list(UOW_CERTS))
+    cis = {name: cms[name].cert_instances[0] for name in UOW_CERTS}
+    assert {name: ci.row_id for (name, ci) in cis.items()} == uow_certs
+
+    with UnitOfWork(db_handle):
+        with UnitOfWork(db_handle):
+            for (name, state) in zip(UOW_CERTS, ('prepublished', 'deployed')):
+                cis[name].state = state
+                cms[name].save_instance(cis[name])
+        assert _states_in_db(db_handle, uow_certs) == {row_id: 'issued' for row_id in uow_certs.values()}
+        cis[UOW_CERTS[0]].state = 'deployed'
+        cms[UOW_CERTS[0]].save_instance(cis[UOW_CERTS[0]])
+        assert _states_in_db(db_handle, uow_certs) == {row_id: 'issued' for row_id in uow_certs.values()}
+        assert flushed == []
+
+    assert flushed == [2]
+    assert _states_in_db(db_handle, uow_certs) == {row_id: 'deployed' for row_id in uow_certs.values()}
+    assert UnitOfWork.depth == 0
+    assert UnitOfWork.dirty_instances == {}
+
+
+def test_init_module_cert_with_live_cert_metas():
+    """
+    Given:  A cert meta, which is only referenced by the registry of cert metas
+    When:   init_module_cert is called (like on every run of execute_from_command_line)
+    Then:   The cert meta should be dropped and the interpreter should exit cleanly
+    :return:
+    """
+    ret = subprocess.run([sys.executable, '-c', """
+from serverPKI.cert import Certificate, init_module_cert
+cm = Certificate(None, 'live.example.com', bulk=True)
+del cm
+init_module_cert()
+assert Certificate._all_CMs == {}
+"""], cwd=str(Path(__file__).parent.parent))
+    assert ret.returncode == 0
@@ -0,0 +1,170 @@
+import os
+
+from paramiko import SSHException
+
+from serverPKI import certdist
+from serverPKI.cert import Place
+from serverPKI.utils import Pathes
+
+
+def _use_own_ownership(monkeypatch) -> None:
+    monkeypatch.setattr(Pathes, 'zone_tlsa_inc_mode', 0o640, raising=False)
+    monkeypatch.setattr(Pathes, 'zone_tlsa_inc_uid', os.getuid(), raising=False)
+    monkeypatch.setattr(Pathes, 'zone_tlsa_inc_gid', os.getgid(), raising=False)
+
+
+def test_write_if_changed_new_file(tmp_path, monkeypatch):
+    """
+    Given:  No TLSA include file
+    When:   _write_if_changed is called
+    Then:   The file is written with zone_tlsa_inc_mode
+    And:    No temporary file is left behind
+    """
+    _use_own_ownership(monkeypatch)
+    dest = tmp_path / 'www.example.com.tlsa'
+
+    assert certdist._write_if_changed(dest, 'a\n')
+    assert dest.read_text() == 'a\n'
+    assert os.stat(str(dest)).st_mode & 0o7777 == 0o640
+    assert os.listdir(str(tmp_path)) == [dest.name]
+
+
+def test_write_if_changed_unchanged(tmp_path, monkeypatch):
+    """
+    Given:  A TLSA include file
+    When:   _write_if_changed is called with the same contents
+    Then:   The file is not rewritten
+    """
+    _use_own_ownership(monkeypatch)
+    dest = tmp_path / 'www.example.com.tlsa'
+    dest.write_text('a\n')
+    before = os.stat(str(dest))
+
+    assert not certdist._write_if_changed(dest, 'a\n')
+    after = os.stat(str(dest))
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+    assert os.listdir(str(tmp_path)) == [dest.name]
+
+
+def test_write_if_changed_replaces_atomically(tmp_path, monkeypatch):
+    """
+    Given:  A TLSA include file with mode 0600
+    When:   _write_if_changed is called with new contents
+    Then:   The file is replaced by a new file (rename of a temporary file)
+    And:    Mode of the old file is retained
+    """
+    _use_own_ownership(monkeypatch)
+    dest = tmp_path / 'www.example.com.tlsa'
+    dest.write_text('a\n')
+    os.chmod(str(dest), 0o600)
+    before = os.stat(str(dest))
+
+    assert certdist._write_if_changed(dest, 'b\n')
+    after = os.stat(str(dest))
+    assert dest.read_text() == 'b\n'
+    assert after.st_ino != before.st_ino
+    assert after.st_mode & 0o7777 == 0o600
+    assert os.listdir(str(tmp_path)) == [dest.name]
+
+
+TLSA = certdist.rdatatype.from_text('TLSA')
+OWNER = '_443._tcp.www.example.com.'
+HASH_1 = '3 1 1 ' + 'ab' * 32
+HASH_2 = '3 1 1 ' + 'cd' * 32
+
+
+def _rdatas(*texts) -> set:
+    return set([certdist.rdata.from_text(certdist.rdataclass.IN, TLSA, text) for text in texts])
+
+
+def _served(monkeypatch, rrsets: dict) -> None:
+    """
+    Let _reconcile_tlsa see rrsets instead of querying the DNS master
+    :param rrsets: dict with owner as key and (ttl, set of rdatas) as value
+    """
+    monkeypatch.setattr(certdist, '_query_rrset', lambda owner, rdtype: rrsets.get(owner, (0, set())))
+
+
+def test_reconcile_tlsa_in_sync(monkeypatch):
+    """
+    Given:  TLSA RRs in DNS equal to the expected ones (hex in other case)
+    When:   _reconcile_tlsa is called
+    Then:   No changes are returned
+    """
+    _served(monkeypatch, {OWNER: (3600, _rdatas(HASH_1.upper(), HASH_2))})
+    assert certdist._reconcile_tlsa([(OWNER, TLSA, 3600, [HASH_1, HASH_2])]) == []
+
+
+def test_reconcile_tlsa_add_only(monkeypatch):
+    """
+    Given:  One of two expected TLSA RRs in DNS
+    When:   _reconcile_tlsa is called
+    Then:   Only the missing RR is added and nothing is deleted
+    """
+    _served(monkeypatch, {OWNER: (3600, _rdatas(HASH_1))})
+    assert certdist._reconcile_tlsa([(OWNER, TLSA, 3600, [HASH_1, HASH_2])]) == [
+        (OWNER, TLSA, 3600, [], list(_rdatas(HASH_2)))]
+
+
+def test_reconcile_tlsa_delete_stale(monkeypatch):
+    """
+    Given:  An expected and a stale TLSA RR in DNS
+    When:   _reconcile_tlsa is called
+    Then:   Only the stale RR is deleted and nothing is added
+    """
+    _served(monkeypatch, {OWNER: (3600, _rdatas(HASH_1, HASH_2))})
+    assert certdist._reconcile_tlsa([(OWNER, TLSA, 3600, [HASH_1])]) == [
+        (OWNER, TLSA, 3600, list(_rdatas(HASH_2)), [])]
+
+
+def test_reconcile_tlsa_name_absent(monkeypatch):
+    """
+    Given:  No TLSA RRs of owner in DNS
+    When:   _reconcile_tlsa is called
+    Then:   All expected RRs are added and nothing is deleted
+    """
+    _served(monkeypatch, {})
+    result = certdist._reconcile_tlsa([(OWNER, TLSA, 3600, [HASH_1, HASH_2])])
+    assert len(result) == 1
+    (owner, rdtype, ttl, removed, added) = result[0]
+    assert (owner, rdtype, ttl, removed) == (OWNER, TLSA, 3600, [])
+    assert set(added) == _rdatas(HASH_1, HASH_2)
+
+
+def test_reconcile_tlsa_ttl_change(monkeypatch):
+    """
+    Given:  The expected TLSA RRs in DNS, but with another ttl
+    When:   _reconcile_tlsa is called
+    Then:   The RRset is replaced completely
+    """
+    _served(monkeypatch, {OWNER: (300, _rdatas(HASH_1))})
+    assert certdist._reconcile_tlsa([(OWNER, TLSA, 3600, [HASH_1])]) == [
+        (OWNER, TLSA, 3600, None, list(_rdatas(HASH_1)))]
+
+
+def test_distribute_to_hosts_contains_ssh_error(monkeypatch):
+    """
+    Given:  Two disthosts, each receiving files of two cert instances
+    When:   The ssh connection to one of them fails
+    Then:   Only the instances of the failing disthost are returned as failed
+    And:    Reload commands are executed on the other disthost only
+    """
+    place = Place(name='p', reload_command='service {} reload')
+    ci_good, ci_bad, ci_both = 'ci_good', 'ci_bad', 'ci_both'
+    host_transfers = {
+        'good.example.com': [(ci_good, 'key', '/etc', 'key.pem', place, None),
+                             (ci_good, 'cert', '/etc', 'cert.pem', place, 'j'),
+                             (ci_both, 'cert', '/etc', 'both.pem', place, 'j')],
+        'bad.example.com': [(ci_bad, 'cert', '/etc', 'cert.pem', place, 'j'),
+                            (ci_both, 'cert', '/etc', 'both.pem', place, 'j')],
+    }
+
+    def distribute_cert(fd, dest_host, dest_dir, file_name, place):
+        if dest_host == 'bad.example.com':
+            raise SSHException('Authentication failed')
+    executed = []
+    monkeypatch.setattr(certdist, 'distribute_cert', distribute_cert)
+    monkeypatch.setattr(certdist, 'remote_execute', lambda dest_host, cmd: executed.append((dest_host, cmd)))
+
+    assert certdist._distribute_to_hosts(host_transfers, 2) == {ci_bad, ci_both}
+    assert executed == [('good.example.com', 'service j reload')]
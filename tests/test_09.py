@@ -0,0 +1,92 @@
+import pytest
+
+from serverPKI.cert import Certificate, init_module_cert
+from serverPKI.utils import Misc, Pathes
+
+
+@pytest.fixture
+def zone_file_root(tmp_path, monkeypatch):
+    """
+    zone_file_root with zones example.com and sub.example.com and no configured DNS_ZONES
+    """
+    for zone in ('example.com', 'sub.example.com'):
+        (tmp_path / zone).mkdir()
+    monkeypatch.setattr(Pathes, 'zone_file_root', tmp_path, raising=False)
+    monkeypatch.setattr(Misc, 'DNS_ZONES', [], raising=False)
+    init_module_cert()
+    yield tmp_path
+    init_module_cert()
+
+
+def _cert_meta(name: str, *altnames) -> Certificate:
+    cm = Certificate(None, name, bulk=True)
+    cm.altnames.extend(altnames)
+    return cm
+
+
+def test_zone_of_nested_zone(zone_file_root):
+    """
+    Given:  Zones example.com and sub.example.com
+    When:   Zones of fqdns in both are looked up
+    Then:   The longest matching zone is found
+    """
+    cm = _cert_meta('www.sub.example.com', 'www.example.com')
+    assert cm.zone_and_FQDN_from_altnames() == [
+        ('sub.example.com', 'www.sub.example.com'), ('example.com', 'www.example.com')]
+
+
+def test_zone_matches_at_label_boundary(zone_file_root):
+    """
+    Given:  Zone example.com
+    When:   Zone of www.badexample.com is looked up
+    Then:   No zone is found
+    """
+    assert _cert_meta('www.badexample.com').zone_and_FQDN_from_altnames() == []
+
+
+def test_zone_of_apex(zone_file_root):
+    """
+    Given:  Zone example.com
+    When:   Zone of example.com is looked up
+    Then:   example.com is found
+    """
+    assert _cert_meta('example.com').zone_and_FQDN_from_altnames() == [('example.com', 'example.com')]
+
+
+def test_zone_not_found(zone_file_root):
+    """
+    Given:  Zones example.com and sub.example.com
+    When:   Zone of a fqdn in another domain is looked up
+    Then:   No zone is found
+    """
+    assert _cert_meta('www.example.org').zone_and_FQDN_from_altnames() == []
+
+
+def test_zones_memoized(zone_file_root):
+    """
+    Given:  Zones discovered from zone_file_root
+    When:   A zone directory is added during the run
+    Then:   It is not seen before init_module_cert
+    And:    Results are memoized per cert meta
+    """
+    assert Certificate.zones() == {'example.com', 'sub.example.com'}
+    (zone_file_root / 'example.org').mkdir()
+    cm = _cert_meta('www.example.org')
+    assert cm.zone_and_FQDN_from_altnames() == []
+    assert cm.zone_and_FQDN_from_altnames() is cm.zone_and_FQDN_from_altnames()
+
+    del cm
+    init_module_cert()
+    assert 'example.org' in Certificate.zones()
+
+
+def test_zones_configured(zone_file_root, monkeypatch):
+    """
+    Given:  DNS_ZONES configured
+    When:   Zones are looked up
+    Then:   Only configured zones are used (trailing dot ignored)
+    """
+    monkeypatch.setattr(Misc, 'DNS_ZONES', ['example.net.'])
+    assert Certificate.zones() == {'example.net'}
+    assert _cert_meta('www.example.net', 'www.example.com').zone_and_FQDN_from_altnames() == [
+        ('example.net', 'www.example.net')]
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+from serverPKI.utils import names_of_local_certs_to_be_renewed
+from .conftest import insert_test_ca_cert, insert_test_cert, delete_test_certs
+
+RENEW_CA = 'renew-ca.example.com'
+RENEW_REMARKS = 'renew'
+RENEW_DAYS = 30
+
+
+def _days(days: int) -> datetime:
+    return datetime.utcnow() + timedelta(days=days)
+
+
+def insert_renew_certs(db_handle) -> None:
+    """
+    Insert a CA cert and local server certs in all combinations relevant for renewal
+    :param db_handle:
+    :return:
+    """
+    delete_test_certs(db_handle, RENEW_REMARKS)
+    insert_test_ca_cert(db_handle, RENEW_CA, RENEW_REMARKS)
+
+    for (name, instances) in (
+            ('renew-valid.example.com', (
+                ('deployed', _days(-10), _days(80)),)),
+            ('renew-expiring.example.com', (
+                ('deployed', _days(-80), _days(10)),)),
+            ('renew-expiring-issued.example.com', (
+                ('deployed', _days(-80), _days(10)),
+                ('issued', _days(-1), _days(89)))),
+            ('renew-expiring-issued-long-ago.example.com', (
+                ('deployed', _days(-80), _days(10)),
+                ('issued', _days(-60), _days(30)))),
+            ('renew-renewed.example.com', (
+                ('deployed', _days(-80), _days(10)),
+                ('deployed', _days(-1), _days(89)))),
+            ('renew-issued-only.example.com', (
+                ('issued', _days(-1), _days(89)),))):
+        insert_test_cert(db_handle, name, 'local', instances, RENEW_REMARKS, RENEW_CA)
+
+
+def _renew_names(db_handle, distribute: bool) -> list:
+    return sorted(name for name in names_of_local_certs_to_be_renewed(db_handle, RENEW_DAYS, distribute)
+                  if name.startswith('renew-'))
+
+
+def test_names_to_be_renewed(db_handle):
+    """
+    Given:  Local certs with deployed and issued instances
+    When:   Names of local certs to be renewed are queried
+    Then:   Certs, whose most recent deployed instance expires within days, should be returned
+    :param db_handle:
+    :return:
+    """
+    insert_renew_certs(db_handle)
+    try:
+        assert _renew_names(db_handle, False) == [
+            'renew-expiring-issued-long-ago.example.com',
+            'renew-expiring-issued.example.com',
+            'renew-expiring.example.com']
+    finally:
+        delete_test_certs(db_handle, RENEW_REMARKS)
+
+
+def test_names_to_be_renewed_and_distributed(db_handle):
+    """
+    Given:  Local certs with deployed and issued instances
+    When:   Names of local certs to be renewed and distributed are queried
+    Then:   Certs to be renewed with an issued instance should be returned, regardless of its age
+    :param db_handle:
+    :return:
+    """
+    insert_renew_certs(db_handle)
+    try:
+        assert _renew_names(db_handle, True) == [
+            'renew-expiring-issued-long-ago.example.com',
+            'renew-expiring-issued.example.com']
+    finally:
+        delete_test_certs(db_handle, RENEW_REMARKS)
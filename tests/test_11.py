@@ -0,0 +1,377 @@
+from datetime import datetime, timedelta
+
+from serverPKI import schedule
+from serverPKI.cert import Certificate, init_module_cert
+from serverPKI.certdist import TLSAUpdates
+from serverPKI.utils import get_config
+from .conftest import insert_test_ca_cert, insert_test_cert, delete_test_certs
+
+PLAN_CA = 'plan-ca.example.com'
+PLAN_REMARKS = 'plan'
+
+
+class _CertMeta(object):
+    def __init__(self, name: str):
+        self.name = name
+
+
+class _CertInstance(object):
+    def __init__(self, cm: _CertMeta, row_id: int, state: str):
+        self.cm = cm
+        self.row_id = row_id
+        self.state = state
+
+
+def test_distribute_all_falls_back_to_one_cert_at_a_time(monkeypatch):
+    """
+    Given:  Three cert metas with one issued instance each
+    When:   The batched distribution errors out and distribution of one cert errors out too
+    Then:   The other two certs are distributed one at a time
+    """
+    cms = [_CertMeta('{}.example.com'.format(name)) for name in ('a', 'b', 'c')]
+    cis = [_CertInstance(cm, row_id, 'issued') for (row_id, cm) in enumerate(cms)]
+    calls = []
+
+    def deployCerts(cert_metas, cert_instances, planned_states=None):
+        calls.append(sorted(cert_metas.keys()))
+        if len(cert_metas) > 1 or 'b.example.com' in cert_metas:
+            raise Exception('Bad host key')
+        assert planned_states == {cert_instances[0]: 'issued'}
+        return True
+
+    monkeypatch.setattr(schedule, 'deployCerts', deployCerts)
+    monkeypatch.setattr(schedule, 'check_disthosts', lambda cm: True)
+
+    schedule._distribute_all([(ci.cm, ci, 'issued') for ci in cis])
+
+    assert calls == [['a.example.com', 'b.example.com', 'c.example.com'],
+                     ['a.example.com'], ['b.example.com'], ['c.example.com']]
+
+
+def test_distribute_all_skips_instances_acted_on(monkeypatch):
+    """
+    Given:  Two cert metas with one issued instance each
+    When:   The batched distribution deploys one instance and then errors out
+    Then:   Only the instance still in its planned state is distributed again
+    """
+    cms = [_CertMeta('{}.example.com'.format(name)) for name in ('a', 'b')]
+    cis = [_CertInstance(cm, row_id, 'issued') for (row_id, cm) in enumerate(cms)]
+    calls = []
+
+    def deployCerts(cert_metas, cert_instances, planned_states=None):
+        calls.append(sorted(cert_metas.keys()))
+        if len(cert_metas) > 1:
+            cis[0].state = 'deployed'
+            raise Exception('DNS update failed')
+        return True
+
+    monkeypatch.setattr(schedule, 'deployCerts', deployCerts)
+    monkeypatch.setattr(schedule, 'check_disthosts', lambda cm: True)
+
+    schedule._distribute_all([(ci.cm, ci, 'issued') for ci in cis])
+
+    assert calls == [['a.example.com', 'b.example.com'], ['b.example.com']]
+
+
+def _at(days: float) -> datetime:
+    return datetime.utcnow() + timedelta(days=days)
+
+
+def insert_plan_certs(db_handle) -> dict:
+    """
+    Insert a CA cert and certs with instances, which trigger the rules of scheduleCerts
+    :param db_handle:
+    :return: dict with cert name as key and list of row ids of its instances as value
+    """
+    (DBAccount, Misc, Pathes, X509atts) = get_config()
+    prepublish = Misc.PRE_PUBLISH_TIMEDELTA
+    mail = Misc.LOCAL_ISSUE_MAIL_TIMEDELTA
+    later = prepublish + mail + 30           # not_after of an issued instance usable as replacement
+
+    delete_test_certs(db_handle, PLAN_REMARKS)
+    insert_test_ca_cert(db_handle, PLAN_CA, PLAN_REMARKS)
+
+    row_ids = {}
+    for (name, cert_type, instances) in (
+            ('plan-valid.example.com', 'LE', (
+                ('deployed', _at(-10), _at(prepublish + 10)),)),
+            ('plan-expired-deployed.example.com', 'LE', (
+                ('deployed', _at(-92), _at(-2)),
+                ('issued', _at(-1), _at(later)))),
+            ('plan-expired-deployed-only.example.com', 'LE', (
+                ('deployed', _at(-92), _at(-2)),)),
+            ('plan-deployed-expiring.example.com', 'LE', (
+                ('deployed', _at(-90), _at(0.5)),
+                ('issued', _at(-1), _at(later)))),
+            ('plan-prepublish.example.com', 'LE', (
+                ('deployed', _at(-60), _at(prepublish - 1)),
+                ('issued', _at(-1), _at(later)))),
+            ('plan-prepublish-issue.example.com', 'LE', (
+                ('deployed', _at(-60), _at(prepublish - 1)),)),
+            ('plan-prepublished.example.com', 'LE', (
+                ('deployed', _at(-60), _at(prepublish - 1)),
+                ('prepublished', _at(-1), _at(later)))),
+            ('plan-issued-only.example.com', 'LE', (
+                ('issued', _at(-1), _at(later)),)),
+            ('plan-issued-expired.example.com', 'LE', (
+                ('deployed', _at(-10), _at(prepublish + 10)),
+                ('issued', _at(-92), _at(-2)))),
+            ('plan-issued-obsolete.example.com', 'LE', (
+                ('deployed', _at(-10), _at(prepublish + 10)),
+                ('issued', _at(-1), _at(prepublish + 10)))),
+            ('plan-archive-and-delete.example.com', 'LE', (
+                ('expired', _at(-100), _at(-10)),
+                ('deployed', _at(-20), _at(prepublish + 5)),
+                ('deployed', _at(-10), _at(prepublish + 10)),
+                ('archived', _at(-200), _at(-100)))),
+            ('plan-local-valid.example.com', 'local', (
+                ('deployed', _at(-10), _at(mail + 10)),)),
+            ('plan-local-mail.example.com', 'local', (
+                ('deployed', _at(-80), _at(mail - 1)),)),
+            ('plan-local-issued-only.example.com', 'local', (
+                ('issued', _at(-1), _at(later)),)),):
+        row_ids[name] = insert_test_cert(db_handle, name, cert_type, instances, PLAN_REMARKS, PLAN_CA)
+    return row_ids
+
+
+class _SMTP(object):
+    def __init__(self, relay):
+        pass
+
+    def send_message(self, msg):
+        pass
+
+    def quit(self):
+        pass
+
+
+def _planned_actions(db_handle, names: list) -> set:
+    """
+    Actions planned by plan_actions, as set of tuples (cert name, instance row_id or None, action name)
+    """
+    return set((name, None if action in (schedule.Action.issue, schedule.Action.mail) else row_id, action.name)
+               for (name, actions) in schedule.plan_actions(db_handle, names).items()
+               for (row_id, action) in actions)
+
+
+def _scheduled_actions(db_handle, monkeypatch, names: list) -> set:
+    """
+    Actions taken by scheduleCerts, as set of tuples (cert name, instance row_id or None, action name).
+    Issue, distribution, DNS updates and mails are recorded instead of done, state transitions
+    and deletions are found by comparing instance states in DB before and after.
+    """
+    actions = set()
+
+    def issue_LE_certs(cert_metas, workers):
+        actions.update((cm.name, None, 'issue') for cm in cert_metas)
+        return {}
+
+    def distribute_all(to_be_distributed):
+        actions.update((cm.name, ci.row_id, 'distribute') for (cm, ci, state) in to_be_distributed)
+
+    monkeypatch.setattr(schedule, 'issue_LE_certs', issue_LE_certs)
+    monkeypatch.setattr(schedule, '_distribute_all', distribute_all)
+    monkeypatch.setattr(schedule, 'distribute_tlsa_rrs', lambda cm, hashes: None)
+    monkeypatch.setattr(TLSAUpdates, 'flush', staticmethod(lambda: set()))
+    monkeypatch.setattr(TLSAUpdates, 'failed', staticmethod(lambda cm: False))
+    monkeypatch.setattr(schedule, 'to_be_mailed', [])
+    monkeypatch.setattr(schedule, 'to_be_deleted', set())
+    monkeypatch.setattr(schedule.smtplib, 'SMTP', _SMTP)
+
+    cms = Certificate.load_many(db_handle, names)
+    names_of_instances = {ci.row_id: cm.name for cm in cms.values() for ci in cm.cert_instances}
+    states_before = {ci.row_id: ci.state for cm in cms.values() for ci in cm.cert_instances}
+
+    schedule.scheduleCerts(db_handle, cms)
+
+    states_after = {row[0]: row[1] for row in db_handle.prepare("""
+        SELECT id, state::TEXT FROM CertInstances WHERE id = ANY($1::INT[])""")(list(states_before.keys()))}
+    transitions = {'expired': 'expire', 'archived': 'archive', 'prepublished': 'prepublish'}
+    for (row_id, state) in states_before.items():
+        name = names_of_instances[row_id]
+        if row_id not in states_after:
+            actions.add((name, row_id, 'delete'))
+        elif states_after[row_id] != state:
+            actions.add((name, row_id, transitions[states_after[row_id]]))
+    actions.update((cm.name, None, 'mail') for cm in schedule.to_be_mailed)
+    return actions
+
+
+def test_plan_actions_matches_scheduleCerts(db_handle, monkeypatch):
+    """
+    Given:  Certs with instances, which trigger each rule of scheduleCerts
+    When:   Their actions are planned with plan_actions and then taken by scheduleCerts
+    Then:   plan_actions should return exactly the actions taken by scheduleCerts
+    :param db_handle:
+    :param monkeypatch:
+    :return:
+    """
+    row_ids = insert_plan_certs(db_handle)
+    names = sorted(row_ids.keys())
+    init_module_cert()
+    try:
+        planned = _planned_actions(db_handle, names)
+        scheduled = _scheduled_actions(db_handle, monkeypatch, names)
+        assert planned == scheduled
+    finally:
+        init_module_cert()
+        delete_test_certs(db_handle, PLAN_REMARKS)
+
+
+def test_plan_actions_of_each_rule(db_handle):
+    """
+    Given:  Certs with instances, which trigger each rule of scheduleCerts
+    When:   Their actions are planned with plan_actions
+    Then:   Each cert should have the actions of its rule
+    :param db_handle:
+    :return:
+    """
+    row_ids = insert_plan_certs(db_handle)
+    try:
+        planned = schedule.plan_actions(db_handle, sorted(row_ids.keys()))
+    finally:
+        delete_test_certs(db_handle, PLAN_REMARKS)
+
+    def actions(name):
+        return sorted((row_id, action.name) for (row_id, action) in planned.get(name, []))
+
+    def row_id(name, index):
+        return row_ids[name][index]
+
+    assert actions('plan-valid.example.com') == []
+    assert actions('plan-expired-deployed.example.com') == [
+        (row_id('plan-expired-deployed.example.com', 1), 'distribute')]
+    assert actions('plan-expired-deployed-only.example.com') == [(None, 'issue')]
+    assert actions('plan-deployed-expiring.example.com') == [
+        (row_id('plan-deployed-expiring.example.com', 0), 'expire'),
+        (row_id('plan-deployed-expiring.example.com', 1), 'distribute')]
+    assert actions('plan-prepublish.example.com') == [
+        (row_id('plan-prepublish.example.com', 1), 'prepublish')]
+    assert actions('plan-prepublish-issue.example.com') == [(None, 'issue')]
+    assert actions('plan-prepublished.example.com') == []
+    assert actions('plan-issued-only.example.com') == [
+        (row_id('plan-issued-only.example.com', 0), 'distribute')]
+    assert actions('plan-issued-expired.example.com') == [
+        (row_id('plan-issued-expired.example.com', 1), 'expire')]
+    assert actions('plan-issued-obsolete.example.com') == [
+        (row_id('plan-issued-obsolete.example.com', 1), 'delete')]
+    assert actions('plan-archive-and-delete.example.com') == sorted([
+        (row_id('plan-archive-and-delete.example.com', 0), 'archive'),
+        (row_id('plan-archive-and-delete.example.com', 1), 'delete'),
+        (row_id('plan-archive-and-delete.example.com', 3), 'delete')])
+    assert actions('plan-local-valid.example.com') == []
+    assert [action for (row_id, action) in actions('plan-local-mail.example.com')] == ['mail']
+    assert actions('plan-local-issued-only.example.com') == [
+        (row_id('plan-local-issued-only.example.com', 0), 'distribute')]
+
+
+def _next_action_at(db_handle, name: str) -> datetime:
+    return db_handle.prepare("""
+        SELECT c.next_action_at FROM Certificates c, Subjects s
+            WHERE s.certificate = c.id AND s.name = $1::TEXT::citext""").first(name)
+
+
+def _not_after(db_handle, row_id: int) -> datetime:
+    return db_handle.prepare("SELECT not_after FROM CertInstances WHERE id = $1::INT").first(row_id)
+
+
+def test_next_action_at_stored(db_handle):
+    """
+    Given:  Certs with and without pending actions
+    When:   Their actions are planned
+    Then:   next_action_at of the cert without pending actions should be the earliest future time,
+            where a rule may fire
+    And:    next_action_at of certs with pending actions should not be set
+    :param db_handle:
+    :return:
+    """
+    (DBAccount, Misc, Pathes, X509atts) = get_config()
+    row_ids = insert_plan_certs(db_handle)
+    try:
+        now = datetime.utcnow()
+        schedule.plan_actions(db_handle, sorted(row_ids.keys()))
+        not_after = _not_after(db_handle, row_ids['plan-valid.example.com'][0])
+        expected = min(at for at in (not_after - timedelta(days=Misc.PRE_PUBLISH_TIMEDELTA),
+                                     not_after - timedelta(days=Misc.LOCAL_ISSUE_MAIL_TIMEDELTA),
+                                     not_after - timedelta(days=1),
+                                     not_after + timedelta(days=1)) if at > now)
+        assert _next_action_at(db_handle, 'plan-valid.example.com') == expected
+        assert _next_action_at(db_handle, 'plan-issued-only.example.com') is None
+    finally:
+        delete_test_certs(db_handle, PLAN_REMARKS)
+
+
+def test_next_action_at_reset_by_triggers(db_handle):
+    """
+    Given:  A cert with stored next_action_at
+    When:   An instance is added, or the cert is disabled
+    Then:   next_action_at should be reset
+    :param db_handle:
+    :return:
+    """
+    row_ids = insert_plan_certs(db_handle)
+    name = 'plan-valid.example.com'
+    try:
+        schedule.plan_actions(db_handle, [name])
+        assert _next_action_at(db_handle, name) is not None
+        db_handle.prepare("""
+            INSERT INTO CertInstances(certificate, state, cacert, not_before, not_after)
+                SELECT certificate, 'issued', cacert, not_before, not_after
+                    FROM CertInstances WHERE id = $1::INT""")(row_ids[name][0])
+        assert _next_action_at(db_handle, name) is None
+
+        schedule.plan_actions(db_handle, [name])
+        assert _next_action_at(db_handle, name) is not None
+        db_handle.prepare("""
+            UPDATE Certificates SET disabled = TRUE
+                WHERE id = (SELECT certificate FROM CertInstances WHERE id = $1::INT)""")(row_ids[name][0])
+        assert _next_action_at(db_handle, name) is None
+    finally:
+        delete_test_certs(db_handle, PLAN_REMARKS)
+
+
+def test_postponed_cert_only_planned_if_explicit(db_handle):
+    """
+    Given:  A cert with pending actions, acted on by scheduleCerts
+    When:   Its actions are planned again
+    Then:   It should not be considered for one hour
+    And:    It should be considered, if named explicitly
+    :param db_handle:
+    :return:
+    """
+    insert_plan_certs(db_handle)
+    name = 'plan-issued-only.example.com'
+    try:
+        now = datetime.utcnow()
+        schedule._postpone_next_action_at(db_handle, [name])
+        postponed_until = _next_action_at(db_handle, name)
+        assert now + timedelta(minutes=59) < postponed_until < now + timedelta(minutes=61)
+
+        assert name not in schedule.plan_actions(db_handle, [name])
+        assert name in schedule.plan_actions(db_handle, [name], explicit_names=[name])
+    finally:
+        delete_test_certs(db_handle, PLAN_REMARKS)
+
+
+def test_changed_deltas_reset_next_action_at(db_handle, monkeypatch):
+    """
+    Given:  A cert with stored next_action_at before its prepublish time
+    When:   PRE_PUBLISH_TIMEDELTA is increased, so that its prepublish time has been reached
+    Then:   It should be considered and have a pending action
+    :param db_handle:
+    :param monkeypatch:
+    :return:
+    """
+    (DBAccount, Misc, Pathes, X509atts) = get_config()
+    insert_plan_certs(db_handle)
+    name = 'plan-valid.example.com'
+    try:
+        schedule.plan_actions(db_handle, [name])
+        assert _next_action_at(db_handle, name) > datetime.utcnow()
+
+        monkeypatch.setattr(Misc, 'PRE_PUBLISH_TIMEDELTA', Misc.PRE_PUBLISH_TIMEDELTA + 20)
+        assert schedule.plan_actions(db_handle, [name]) == {name: [(None, schedule.Action.issue)]}
+    finally:
+        monkeypatch.undo()
+        schedule.plan_actions(db_handle, [])        # record configured deltas again
+        delete_test_certs(db_handle, PLAN_REMARKS)
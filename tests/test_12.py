@@ -0,0 +1,86 @@
+import datetime
+
+from serverPKI import issue_LE
+from serverPKI.cert import Certificate
+
+
+class _CertMeta(object):
+    def __init__(self, name: str, zone: str):
+        self.name = name
+        self.zone = zone
+        self.encryption_algo = 'rsa'
+
+
+class _Challenge(object):
+    def __init__(self, domain: str, token: str):
+        self.domain = domain
+        self.contents = {'token': token}
+        self.key = 'key-' + token
+
+
+def _prepare(monkeypatch, fail_create: bool):
+    """
+    Replace ACME and DNS access of _authorize_many, recording published and removed challenges
+    """
+    calls = {'created': None, 'deleted': None}
+
+    def new_order(cert_meta, acme):
+        return ('order-' + cert_meta.name, [_Challenge(cert_meta.name, 'token-' + cert_meta.name),
+                                            _Challenge(cert_meta.name, 'token-' + cert_meta.name)])
+
+    def create(zones, fqdn_challenges):
+        calls['created'] = {fqdn: [c.contents['token'] for c in challenges]
+                            for (fqdn, challenges) in fqdn_challenges.items()}
+        if fail_create:
+            raise Exception('DNS update failed for zone b.example with rcode: REFUSED')
+
+    def delete(zones):
+        calls['deleted'] = sorted(zones.keys())
+
+    def verify(cert_meta, acme, order, challenges):
+        return (order, datetime.datetime(2030, 1, 1))
+
+    monkeypatch.setattr(issue_LE, 'AcmeV2', lambda server, account: None)
+    monkeypatch.setattr(issue_LE, '_new_order', new_order)
+    monkeypatch.setattr(issue_LE, 'create_challenge_responses_in_dns', create)
+    monkeypatch.setattr(issue_LE, 'delete_challenge_responses_in_dns', delete)
+    monkeypatch.setattr(issue_LE, '_wait_for_propagation', lambda zones, fqdn_challenges: None)
+    monkeypatch.setattr(issue_LE, '_verify_challenges', verify)
+    monkeypatch.setattr(Certificate, 'zone_and_FQDN_from_altnames',
+                        lambda cert_meta: [(cert_meta.zone, cert_meta.name)])
+    return calls
+
+
+def test_authorize_many_publishes_each_token_once(monkeypatch):
+    """
+    Given:  Two certs in two zones, each with a challenge listed twice
+    When:   They are authorized
+    Then:   Each challenge token is published once
+    And:    Both certs are authorized and the challenge responses are removed
+    """
+    calls = _prepare(monkeypatch, fail_create=False)
+    cms = [_CertMeta('www.a.example', 'a.example'), _CertMeta('www.b.example', 'b.example')]
+
+    authorizations = issue_LE._authorize_many(cms, None)
+
+    assert calls['created'] == {'www.a.example': ['token-www.a.example'],
+                                'www.b.example': ['token-www.b.example']}
+    assert calls['deleted'] == ['a.example', 'b.example']
+    assert authorizations == {'www.a.example': (['order-www.a.example'], datetime.datetime(2030, 1, 1)),
+                              'www.b.example': (['order-www.b.example'], datetime.datetime(2030, 1, 1))}
+
+
+def test_authorize_many_cleans_up_failed_dns_update(monkeypatch):
+    """
+    Given:  Two certs in two zones
+    When:   Publishing the challenge responses in DNS fails
+    Then:   The challenge responses of all zones are removed
+    And:    No cert is authorized, without raising an exception
+    """
+    calls = _prepare(monkeypatch, fail_create=True)
+    cms = [_CertMeta('www.a.example', 'a.example'), _CertMeta('www.b.example', 'b.example')]
+
+    authorizations = issue_LE._authorize_many(cms, None)
+
+    assert calls['deleted'] == ['a.example', 'b.example']
+    assert authorizations == {'www.a.example': ([], None), 'www.b.example': ([], None)}
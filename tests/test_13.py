@@ -0,0 +1,122 @@
+from concurrent.futures import wait
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from serverPKI import keypool
+from serverPKI.cert import EncAlgoCKS
+from serverPKI.keypool import KeyPool
+
+EC = EncAlgoCKS('ec')
+KIND = ('ec', 0)
+
+
+def _reset():
+    KeyPool.shutdown()
+
+
+def test_take_from_empty_pool_is_a_miss():
+    """
+    Given:  An empty KeyPool
+    When:   An ec key is taken
+    Then:   It is generated inline, counted as miss and no background process is started
+    """
+    _reset()
+    key = KeyPool.take(EC, 2048)
+    assert isinstance(key, ec.EllipticCurvePrivateKey)
+    assert KeyPool.stats[KIND]['misses'] == 1
+    assert KeyPool.stats[KIND]['hits'] == 0
+    assert KeyPool.executor is None
+    _reset()
+
+
+def test_prefilled_keys_are_hits():
+    """
+    Given:  A KeyPool prefilled with 2 ec keys
+    When:   The background generation has finished and 3 keys are taken
+    Then:   The first 2 are hits, the 3rd one is a miss
+    And:    The pool uses no more processes than keys requested
+    """
+    _reset()
+    KeyPool.prefill(EC, 2048, 2)
+    assert KeyPool.executor._max_workers <= 2
+    wait(KeyPool.queues[KIND])
+    keys = [KeyPool.take(EC, 2048) for i in range(3)]
+    assert all(isinstance(key, ec.EllipticCurvePrivateKey) for key in keys)
+    assert len({key.private_numbers().private_value for key in keys}) == 3
+    assert KeyPool.stats[KIND]['hits'] == 2
+    assert KeyPool.stats[KIND]['misses'] == 1
+    _reset()
+
+
+def test_prefill_single_key_uses_one_process():
+    """
+    Given:  An empty KeyPool
+    When:   One key is prefilled (like issue_local_cert does)
+    Then:   The pool uses one background process
+    And:    Prefilling again does not queue more keys than requested
+    """
+    _reset()
+    KeyPool.prefill(EC, 2048, 1)
+    assert KeyPool.executor._max_workers == 1
+    KeyPool.prefill(EC, 2048, 1)
+    assert len(KeyPool.queues[KIND]) == 1
+    _reset()
+
+
+def test_pending_key_is_a_wait(monkeypatch):
+    """
+    Given:  A KeyPool with a key still being generated
+    When:   The key is taken
+    Then:   take() waits for it and counts a wait
+    """
+    _reset()
+
+    class _Pending(object):
+        def done(self):
+            return False
+
+        def result(self):
+            return keypool._generate_key('ec', 0)
+
+    KeyPool.queues[KIND] = keypool.deque([_Pending()])
+    key = KeyPool.take(EC, 2048)
+    assert isinstance(key, ec.EllipticCurvePrivateKey)
+    assert KeyPool.stats[KIND]['waits'] == 1
+    _reset()
+
+
+def test_failed_background_generation_falls_back_to_miss():
+    """
+    Given:  A KeyPool whose background key generation failed
+    When:   The key is taken
+    Then:   A key is generated inline and counted as miss
+    """
+    _reset()
+
+    class _Failed(object):
+        def done(self):
+            return True
+
+        def result(self):
+            raise RuntimeError('worker died')
+
+    KeyPool.queues[KIND] = keypool.deque([_Failed()])
+    key = KeyPool.take(EC, 2048)
+    assert isinstance(key, ec.EllipticCurvePrivateKey)
+    assert KeyPool.stats[KIND]['misses'] == 1
+    _reset()
+
+
+def test_shutdown_discards_keys_and_stats():
+    """
+    Given:  A KeyPool with queued keys and statistics
+    When:   It is shut down
+    Then:   Executor, queues and statistics are reset
+    """
+    _reset()
+    KeyPool.prefill(EC, 2048, 3)
+    KeyPool.take(EC, 2048)
+    KeyPool.shutdown()
+    assert KeyPool.executor is None
+    assert KeyPool.queues == {}
+    assert KeyPool.stats == {}
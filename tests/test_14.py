@@ -0,0 +1,110 @@
+import datetime
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+from serverPKI import issue_local
+
+CA_NAME = 'Test local CA'
+
+
+def _ca():
+    """
+    Create a self signed CA cert with SubjectKeyIdentifier
+    :return: Tuple of CA cert and CA key
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, CA_NAME)])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        now).not_valid_after(now + datetime.timedelta(days=10)).add_extension(
+        x509.BasicConstraints(ca=True, path_length=None), critical=True).add_extension(
+        x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False).sign(
+        key, hashes.SHA256(), default_backend())
+    return (cert, key)
+
+
+def _assert_signed_by(cert: x509.Certificate, cacert: x509.Certificate) -> None:
+    cacert.public_key().verify(cert.signature, cert.tbs_certificate_bytes,
+                               padding.PKCS1v15(), cert.signature_hash_algorithm)
+    assert cert.issuer == cacert.subject
+    aki = cert.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier).value
+    ski = cacert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value
+    assert aki.key_identifier == ski.digest
+
+
+def test_build_server_cert():
+    """
+    Given:  A local CA cert and a key
+    When:   A server cert with altnames is built
+    Then:   It is signed by the CA, has the key, DNS altnames, server auth and the requested lifetime
+    """
+    (cacert, cakey) = _ca()
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+
+    (cert, not_before, not_after, serial) = issue_local._build_cert(
+        'www.example.com', 'server', ['example.com'], key, cacert, cakey, 30)
+
+    _assert_signed_by(cert, cacert)
+    assert cert.serial_number == serial
+    assert cert.public_key().public_numbers() == key.public_key().public_numbers()
+    assert cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value == 'www.example.com'
+    assert cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(
+        x509.DNSName) == ['www.example.com', 'example.com']
+    assert list(cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value) == [
+        ExtendedKeyUsageOID.SERVER_AUTH]
+    assert cert.extensions.get_extension_for_class(x509.KeyUsage).value.key_encipherment
+    assert not cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+    assert (not_after - not_before).days == 31
+
+
+def test_build_client_cert():
+    """
+    Given:  A local CA cert and a key
+    When:   A client cert is built
+    Then:   It has e-mail altnames, client auth and no key encipherment
+    """
+    (cacert, cakey) = _ca()
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+
+    (cert, not_before, not_after, serial) = issue_local._build_cert(
+        'user@example.com', 'client', [], key, cacert, cakey, 30)
+
+    _assert_signed_by(cert, cacert)
+    assert cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(
+        x509.RFC822Name) == ['user@example.com']
+    assert list(cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value) == [
+        ExtendedKeyUsageOID.CLIENT_AUTH]
+    assert not cert.extensions.get_extension_for_class(x509.KeyUsage).value.key_encipherment
+
+
+def test_issue_in_worker(monkeypatch):
+    """
+    Given:  A process of issue_local_certs, initialized with CA cert and key in PEM format
+    When:   A cert is issued in it
+    Then:   Cert and key are returned in PEM format, the key belongs to the cert
+    And:    The cert is signed by the CA and has key size and lifetime of the initialization
+    """
+    (cacert, cakey) = _ca()
+    monkeypatch.setattr(issue_local, 'worker_ca', None)
+    issue_local._init_worker(cacert.public_bytes(serialization.Encoding.PEM),
+                             cakey.private_bytes(encoding=serialization.Encoding.PEM,
+                                                 format=serialization.PrivateFormat.PKCS8,
+                                                 encryption_algorithm=serialization.NoEncryption()),
+                             2048,
+                             20)
+
+    (cert_pem, key_pem, not_before, not_after, serial) = issue_local._issue_in_worker(
+        'www.example.com', 'server', [])
+
+    cert = x509.load_pem_x509_certificate(cert_pem, default_backend())
+    key = serialization.load_pem_private_key(key_pem, password=None, backend=default_backend())
+    _assert_signed_by(cert, cacert)
+    assert cert.serial_number == serial
+    assert key.key_size == 2048
+    assert cert.public_key().public_numbers() == key.public_key().public_numbers()
+    assert (not_after - not_before).days == 21